@@ -2,12 +2,14 @@
 import time
 import argparse
 # Import custom modules
-from task.preprocessing.data_preprocessing import data_preprocessing, benchmark_preprocessing
+from task.preprocessing.data_preprocessing import data_preprocessing, benchmark_preprocessing, ragged_converting, \
+    streaming_preprocessing
+from task.preprocessing.preprocess_cache import cache_listing, cache_evicting
 from task.preprocessing.topic_modeling import topic_modeling
 from task.training import training
 from task.testing.seq2seq_testing import seq2seq_testing
 # Utils
-from utils import str2bool, path_check, set_random_seed
+from utils import str2bool, positive_int, path_check, set_random_seed
 
 def main(args):
     # Set random seed
@@ -20,12 +22,24 @@ def main(args):
     # Path setting
     path_check(args)
 
+    if args.list_cache:
+        cache_listing(args)
+
+    if args.evict_cache is not None:
+        cache_evicting(args, args.evict_cache)
+
     if args.preprocessing:
         # if args.data_name.split('_')[:-1]:
         #     benchmark_preprocessing(args)
         # else:
         #     data_preprocessing(args)
-        data_preprocessing(args)
+        if args.streaming_preprocessing:
+            streaming_preprocessing(args)
+        else:
+            data_preprocessing(args)
+
+    if args.convert_ragged:
+        ragged_converting(args)
 
     if args.topic_modeling:
         topic_modeling(args)
@@ -48,6 +62,10 @@ if __name__=='__main__':
     parser.add_argument('--task', default='translation', choices=task_list,
                         help='')
     parser.add_argument('--preprocessing', action='store_true')
+    parser.add_argument('--convert_ragged', action='store_true')
+    parser.add_argument('--list_cache', action='store_true')
+    parser.add_argument('--evict_cache', default=None, type=str,
+                        help='Remove preprocessing cache entries starting with this name, or every entry with all; Default is None')
     parser.add_argument('--topic_modeling', action='store_true')
     parser.add_argument('--training', action='store_true')
     parser.add_argument('--testing', action='store_true')
@@ -95,6 +113,20 @@ if __name__=='__main__':
     parser.add_argument('--with_eda', action='store_true')
     parser.add_argument('--src_trg_identical', default=False, type=str2bool,
                         help='Use source and target tokenizer same; Default is False')
+    parser.add_argument('--tokenizing_workers', default=8, type=int,
+                        help='Number of processes encoding sentences; Default is 8')
+    parser.add_argument('--ragged_format', default=False, type=str2bool,
+                        help='Save tokens without padding and attention mask; Default is False')
+    parser.add_argument('--hdf5_compression', default='none', choices=['none', 'gzip', 'lzf'],
+                        help='Compression filter of preprocessed HDF5 arrays; Default is none')
+    parser.add_argument('--vocab_trimming', default=False, type=str2bool,
+                        help='Keep only the pretrained tokenizer indices used in the corpus and remap them; Default is False')
+    parser.add_argument('--streaming_preprocessing', default=False, type=str2bool,
+                        help='Read, tokenize and save line corpora chunk by chunk with bounded memory; Default is False')
+    parser.add_argument('--stream_chunk_size', default=100000, type=int,
+                        help='Number of lines processed at a time in streaming preprocessing; Default is 100000')
+    parser.add_argument('--preprocess_cache', default=True, type=str2bool,
+                        help='Reuse SentencePiece models and preprocessed files made with the same data and config; Default is True')
     # Topic-modeling setting
     parser.add_argument('--topic_modeling_model', default='ctm', type=str,
                         help='Topic Modeling method select; Default is ctm')
@@ -138,6 +170,10 @@ if __name__=='__main__':
                         help='Weight sharing between encoder embedding and decoder embedding; Default is False')
     parser.add_argument('--parallel', default=False, type=str2bool,
                         help='Transformer Encoder and Decoder parallel mode; Default is False')
+    parser.add_argument('--gradient_checkpointing', default=False, type=str2bool,
+                        help='Recompute encoder and decoder layer activations in backward instead of keeping them; Default is False')
+    parser.add_argument('--checkpoint_every', default=1, type=int,
+                        help='Number of layers in one gradient checkpointing segment; Default is 1')
     parser.add_argument('--num_common_layer', default=8, type=int, 
                         help="Number of common layers; Default is 8")
     # 2) Variational model
@@ -161,6 +197,19 @@ if __name__=='__main__':
                         help='')
     parser.add_argument('--d_latent', default=128, type=int, 
                         help='Latent variable dimension; Default is 128')
+    parser.add_argument('--batched_src_trg_encoding', default=False, type=str2bool,
+                        help='Encode source and target for the variational model in one encoder pass; '
+                             'custom_transformer with shared target encoder only; Default is False')
+    parser.add_argument('--trg_encoder_mode', default='shared', choices=['shared', 'no_grad', 'ema', 'cache'], type=str,
+                        help='Target encoder for the variational_with_target posterior; shared backpropagates through it, no_grad stops the gradient, ema uses an EMA snapshot and cache reads the posteriors written to disk at the start of every epoch; Default is shared')
+    parser.add_argument('--trg_encoder_ema_decay', default=0.999, type=float,
+                        help='EMA decay of the target encoder snapshot, 0 copies the live weights; Default is 0.999')
+    parser.add_argument('--trg_encoder_ema_interval', default=1, type=positive_int,
+                        help='Training steps between target encoder snapshot updates; Default is 1')
+    parser.add_argument('--parallel_layer_latent', default=False, type=str2bool,
+                        help='Latent variable of every parallel encoder layer from its own output instead of the source embedding output; Default is False')
+    parser.add_argument('--mmd_block_size', default=0, type=int,
+                        help='Rows of the WAE MMD kernel matrix computed at a time, 0 is all rows; Default is 0')
     # Optimizer & LR_Scheduler setting
     optim_list = ['AdamW', 'Adam', 'SGD', 'Ralamb']
     scheduler_list = ['constant', 'warmup', 'reduce_train', 'reduce_valid', 'lambda']
@@ -181,14 +230,36 @@ if __name__=='__main__':
                         help='Num CPU Workers; Default is 8')
     parser.add_argument('--batch_size', default=16, type=int,    
                         help='Batch size; Default is 16')
+    parser.add_argument('--dynamic_padding', default=False, type=str2bool,
+                        help='Trim each batch to its longest sequence; Default is False')
+    parser.add_argument('--bucket_batch', default=False, type=str2bool,
+                        help='Make batches of similar length sentences; Default is False')
+    parser.add_argument('--max_tokens', default=0, type=int,
+                        help='Maximum padded source and target tokens of a batch instead of batch_size; Default is 0 (not used)')
+    parser.add_argument('--lazy_loading', default=False, type=str2bool,
+                        help='Read preprocessed data from memory-mapped .npy files on demand; Default is False')
+    parser.add_argument('--batch_fetch', default=True, type=str2bool,
+                        help='Index the dataset arrays once per batch instead of once per sentence; Default is True')
+    parser.add_argument('--packing', default=False, type=str2bool,
+                        help='Pack several short sentence pairs into one row for training; Default is False')
     parser.add_argument('--lr', default=5e-5, type=float,
                         help='Maximum learning rate of warmup scheduler; Default is 5e-5')
     parser.add_argument('--w_decay', default=1e-5, type=float,
                         help="Ralamb's weight decay; Default is 1e-5")
     parser.add_argument('--clip_grad_norm', default=5, type=int, 
                         help='Graddient clipping norm; Default is 5')
+    parser.add_argument('--label_smoothing', default=False, type=str2bool,
+                        help='Train with label smoothing of label_smoothing_eps; Default is False')
     parser.add_argument('--label_smoothing_eps', default=0.05, type=float,
                         help='')
+    parser.add_argument('--output_head', default='softmax', choices=['softmax', 'adaptive', 'sampled'], type=str,
+                        help='Training output layer of custom_transformer and bart; adaptive and sampled softmax are built from the training token counts; Default is softmax')
+    parser.add_argument('--adaptive_cutoffs', default=[2000, 10000], nargs='+', type=int,
+                        help='Frequency rank cutoffs of the adaptive softmax clusters; Default is 2000 10000')
+    parser.add_argument('--num_sampled', default=8192, type=int,
+                        help='Negative tokens of the sampled softmax for each batch; Default is 8192')
+    parser.add_argument('--loss_chunk_size', default=0, type=int,
+                        help='Target tokens of one vocabulary projection and cross entropy chunk, 0 computes the full logits; Default is 0')
     # Testing setting
     parser.add_argument('--test_batch_size', default=32, type=int, 
                         help='Test batch size; Default is 32')
@@ -197,7 +268,19 @@ if __name__=='__main__':
     parser.add_argument('--beam_alpha', default=0.7, type=float, 
                         help='Beam search length normalization; Default is 0.7')
     parser.add_argument('--repetition_penalty', default=1.3, type=float, 
-                        help='Beam search repetition penalty term; Default is 1.3')
+                        help='Beam search repetition penalty term for every generated token; Default is 1.3')
+    parser.add_argument('--no_repeat_ngram_size', default=0, type=int, 
+                        help='Block n-grams of this size that already exist in the hypothesis; Default is 0')
+    parser.add_argument('--min_decoding_len', default=0, type=int, 
+                        help='Minimum number of generated tokens before end token; Default is 0')
+    parser.add_argument('--incremental_decoding', default=True, type=str2bool,
+                        help='Decode only the newest token with cached decoder keys and values; Default is True')
+    parser.add_argument('--max_len_a', default=0, type=float,
+                        help='Decoding length limit is max_len_a * source length + max_len_b; Default is 0')
+    parser.add_argument('--max_len_b', default=None, type=int,
+                        help='Decoding length limit is max_len_a * source length + max_len_b; Default is trg_max_len')
+    parser.add_argument('--latent_sampling', default=False, type=str2bool,
+                        help='Sample the latent variable seeded with seed instead of the posterior mean in decoding; Default is False')
     # Seed & Logging setting
     parser.add_argument('--seed', default=42, type=int,
                         help='Random seed; Default is 42')
@@ -0,0 +1,100 @@
+# Import PyTorch
+import torch
+
+def beam_search(decode_step, reorder_state, batch_size: int, beam_size: int,
+                bos_idx: int, eos_idx: int, max_len: int, beam_alpha: float = 0.7,
+                logits_processor=None, max_len_per_source: torch.Tensor = None, device=None):
+    """
+    Beam search on fixed-shape tensors shared by the generate functions.
+    Every beam slot saves the first hypothesis that ends with eos token in that slot, and a slot which never
+    ends by the length limit saves its hypothesis at the limit. A source sentence is removed from the active batch
+    as soon as all of its slots are saved, and decoding stops when no source sentence is left.
+
+    Args:
+        decode_step (callable): (seqs, step) -> log-probabilities of the next token (active * k, vocab_num)
+            seqs is (active * k, step + 1) and includes bos token
+        reorder_state (callable): (beam_index, sentence_index) -> None
+            Re-order decoder state with beam_index (active * k) which is the previous row of each selected beam.
+            sentence_index is (active,) index of the source sentences which are still decoded, or None if no sentence is removed.
+        logits_processor (callable): (seqs, step, scores) -> processed scores; see model/logits_processor.py
+        max_len_per_source (torch.Tensor): (batch_size,) maximum decoding length of each source; Default is max_len
+    Returns:
+        predicted (list): token index list of the best hypothesis of each source sentence
+    """
+    k = beam_size
+    if max_len_per_source is None:
+        max_len_per_source = torch.full((batch_size,), max_len, dtype=torch.long, device=device)
+    max_len_per_source = max_len_per_source.clamp(1, max_len)
+
+    # Active hypotheses setting
+    seqs = torch.zeros(batch_size * k, max_len + 1, dtype=torch.long, device=device) # (batch_size * k, max_len + 1)
+    seqs[:, 0] = bos_idx
+    top_k_scores = torch.zeros(batch_size * k, device=device) # (batch_size * k)
+    active = torch.arange(batch_size, device=device) # Source index of active sentences
+    beam_offset = torch.arange(batch_size, device=device).unsqueeze(1) * k # (batch_size, 1)
+    beam_slot = torch.arange(k, device=device).unsqueeze(0) # (1, k)
+
+    # Finished hypotheses setting
+    finished_seqs = torch.zeros(batch_size, k, max_len + 1, dtype=torch.long, device=device)
+    finished_scores = torch.zeros(batch_size, k, device=device)
+    finished_len = torch.zeros(batch_size, k, dtype=torch.long, device=device)
+    finished = torch.zeros(batch_size, k, dtype=torch.bool, device=device)
+
+    for step in range(max_len):
+        n_active = active.size(0)
+        scores = decode_step(seqs[:, :step + 1], step) # (active * k, vocab_num)
+        vocab_num = scores.size(-1)
+
+        # Repetition penalty, n-gram blocking, minimum length
+        if logits_processor is not None:
+            scores = logits_processor(seqs[:, :step + 1], step, scores)
+
+        # Add score
+        scores = top_k_scores.unsqueeze(1) + scores # (active * k, vocab_num)
+        if step == 0:
+            scores = scores[::k] # (active, vocab_num)
+        top_k_scores, top_k_words = scores.view(n_active, -1).topk(k, 1, True, True) # (active, k)
+
+        # Previous and Next word extract
+        prev_word_inds = top_k_words // vocab_num # (active, k)
+        next_word_inds = top_k_words % vocab_num # (active, k)
+        beam_index = (prev_word_inds + beam_offset[:n_active]).view(-1) # (active * k)
+        seqs = seqs.index_select(0, beam_index)
+        seqs[:, step + 1] = next_word_inds.view(-1)
+        top_k_scores = top_k_scores.view(-1)
+
+        # Save hypotheses which newly end with eos token or reach the length limit
+        active_finished = finished[active] # (active, k)
+        reach_limit = (step + 1 >= max_len_per_source[active]).unsqueeze(1) # (active, 1)
+        save = ~active_finished & ((next_word_inds == eos_idx) | reach_limit) # (active, k)
+        finished_seqs[active] = torch.where(save.unsqueeze(2), seqs.view(n_active, k, -1), finished_seqs[active])
+        finished_scores[active] = torch.where(save, top_k_scores.view(n_active, k), finished_scores[active])
+        finished_len[active] = finished_len[active].masked_fill(save, step + 2)
+        active_finished = active_finished | save
+        finished[active] = active_finished
+
+        # Remove source sentences of which every beam slot is saved
+        done = active_finished.all(dim=1) # (active)
+        if done.any():
+            sentence_index = (~done).nonzero(as_tuple=False).view(-1)
+            if sentence_index.numel() == 0:
+                break
+            active = active[sentence_index]
+            row_index = (sentence_index.unsqueeze(1) * k + beam_slot).view(-1)
+            seqs = seqs.index_select(0, row_index)
+            top_k_scores = top_k_scores.index_select(0, row_index)
+            reorder_state(beam_index.index_select(0, row_index), sentence_index)
+        else:
+            reorder_state(beam_index, None)
+
+    # Beam Length Normalization
+    lp = ((finished_len + k) ** beam_alpha) / ((k + 1) ** beam_alpha)
+    finished_scores = finished_scores / lp
+
+    # Best hypothesis of each source sentence
+    _, best = finished_scores.max(1) # (batch_size)
+    batch_index = torch.arange(batch_size, device=device)
+    best_seqs = finished_seqs[batch_index, best].tolist()
+    best_len = finished_len[batch_index, best].tolist()
+    predicted = [seq[:length] for seq, length in zip(best_seqs, best_len)]
+    return predicted
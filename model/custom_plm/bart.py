@@ -3,18 +3,35 @@ from collections import defaultdict
 # Import PyTorch
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 from torch.autograd import Variable
 # Import Huggingface
 from transformers import BartModel, BartConfig
 #
 from ..latent_module.latent import Latent_module 
+from ..beam_search import beam_search
+from ..logits_processor import build_logits_processor
+from ..output_head import build_output_head
+from .utils import trim_embedding, trimmed_index
+
+def reorder_past_key_values(past_key_values, beam_index):
+    """
+    Re-order the decoder key, value cache of Huggingface to the rows of beam_index (active * k).
+    Newer transformers versions return a Cache object and older versions a tuple of per-layer tuples.
+    """
+    if hasattr(past_key_values, 'reorder_cache'):
+        past_key_values.reorder_cache(beam_index)
+        return past_key_values
+    return tuple(tuple(past_state.index_select(0, beam_index) for past_state in layer_past) \
+                     for layer_past in past_key_values)
 
 class custom_Bart(nn.Module):
     def __init__(self, task: str = 'translation', isPreTrain: bool = True, 
                  src_language: str = 'en', trg_language: str = 'en',
                  variational: bool = True, variational_mode_dict: dict = dict(),
                  src_max_len: int = 768, trg_max_len: int = 300,
-                 emb_src_trg_weight_sharing: bool = True, dropout: float = 0.2):
+                 emb_src_trg_weight_sharing: bool = True, dropout: float = 0.2,
+                 output_head_dict: dict = dict(), vocab_map=None):
         super().__init__()
 
         """
@@ -35,6 +52,7 @@ class custom_Bart(nn.Module):
         self.src_language = src_language
         self.trg_language = trg_language
         self.emb_src_trg_weight_sharing = emb_src_trg_weight_sharing
+        self.trg_max_len = trg_max_len
         self.model_config = BartConfig.from_pretrained(('facebook/bart-large'))
         # self.model_config.use_cache = False
 
@@ -48,6 +66,16 @@ class custom_Bart(nn.Module):
         else:
             self.model = BartModel(config=self.model_config)
 
+        # Corpus vocabulary trimming; vocab_map is the original index of each trimmed index
+        if vocab_map is not None:
+            trim_embedding(self.model.shared, vocab_map)
+            # Encoder and decoder use the trimmed shared embedding
+            self.model.set_input_embeddings(self.model.shared)
+            self.model.config.vocab_size = len(vocab_map)
+            self.pad_idx = trimmed_index(vocab_map, self.pad_idx)
+            self.bos_idx = trimmed_index(vocab_map, self.bos_idx)
+            self.eos_idx = trimmed_index(vocab_map, self.eos_idx)
+
         self.encoder_model = self.model.get_encoder()
         self.decoder_model = self.model.get_decoder()
         # Shared embedding setting
@@ -59,7 +87,13 @@ class custom_Bart(nn.Module):
         # Target linear part
         self.trg_output_linear = nn.Linear(self.model_config.d_model, 256)
         self.trg_output_norm = nn.LayerNorm(256, eps=1e-12)
-        self.trg_output_linear2 = nn.Linear(256, self.model.shared.num_embeddings)
+
+        # Adaptive or sampled softmax head for large vocabularies
+        self.output_head = output_head_dict.get('output_head', 'softmax')
+        self.vocab_head = build_output_head(output_head_dict, 256, self.model.shared.num_embeddings)
+        # The adaptive softmax head has its own projection instead of 'trg_output_linear2'
+        if self.output_head != 'adaptive':
+            self.trg_output_linear2 = nn.Linear(256, self.model.shared.num_embeddings)
 
         # Variational mode setting
         if variational:
@@ -71,6 +105,9 @@ class custom_Bart(nn.Module):
             self.latent_add_encoder_out = variational_mode_dict['latent_add_encoder_out']
             self.z_var = variational_mode_dict['z_var']
             self.d_latent = variational_mode_dict['d_latent']
+            if variational_mode_dict.get('batched_src_trg_encoding', False):
+                # The target pass runs under no_grad, which one shared encoder pass with the source cannot do
+                raise Exception('batched_src_trg_encoding is not available for bart')
 
             self.latent_module = Latent_module(d_model=self.d_hidden, d_latent=self.d_latent, 
                                                variational_model=self.variational_model, 
@@ -82,8 +119,11 @@ class custom_Bart(nn.Module):
 
     def forward(self, src_input_ids, src_attention_mask, src_img,
                 trg_label, trg_input_ids, trg_attention_mask,
-                non_pad_position=None, tgt_subsqeunt_mask=None):
-
+                non_pad_position=None, tgt_subsqeunt_mask=None, return_hidden: bool = False):
+        """
+        With 'return_hidden', the hidden states before the vocabulary projection 'trg_output_linear2' are returned
+        instead of the logits
+        """
         # Pre_setting for variational model and translation task
         trg_input_ids_copy = trg_input_ids.clone().detach()
         trg_attention_mask_copy = trg_attention_mask.clone().detach()
@@ -129,8 +169,13 @@ class custom_Bart(nn.Module):
                 trg_encoder_out = None
 
             src_encoder_out, dist_loss = self.latent_module(encoder_out_src=src_encoder_out, 
-                                                            encoder_out_trg=trg_encoder_out)
+                                                            encoder_out_trg=trg_encoder_out,
+                                                            src_key_padding_mask=~src_attention_mask.bool(),
+                                                            trg_key_padding_mask=~trg_attention_mask_copy.bool())
             src_encoder_out = src_encoder_out.transpose(0,1)
+            if src_encoder_out.size(1) != src_attention_mask.size(1):
+                # Single latent memory slot is not padded
+                src_attention_mask = src_attention_mask.new_ones(src_encoder_out.size(0), src_encoder_out.size(1))
         else:
             dist_loss = torch.tensor(0, dtype=torch.float)
 
@@ -144,115 +189,112 @@ class custom_Bart(nn.Module):
                                            encoder_hidden_states = src_encoder_out,
                                            encoder_attention_mask = src_attention_mask)
         model_out = self.dropout(F.gelu(self.trg_output_linear(model_out['last_hidden_state'])))
-        model_out = self.trg_output_linear2(self.trg_output_norm(model_out))
+        model_out = self.trg_output_norm(model_out)
 
         if non_pad_position is not None:
             model_out = model_out[non_pad_position]
 
+        if return_hidden:
+            return model_out, dist_loss
+        if self.output_head == 'adaptive':
+            # Log-probabilities work as logits for the cross entropy and accuracy
+            return self.output_log_prob(model_out), dist_loss
+        model_out = self.trg_output_linear2(model_out)
+
         return model_out, dist_loss
 
-    def generate(self, src_input_ids, src_attention_mask, beam_size: int = 5, beam_alpha: float = 0.7, repetition_penalty: float = 0.7):
+    def output_log_prob(self, hidden):
+        """
+        Full vocabulary log-probabilities of hidden (tokens, 256) for any output head
+        """
+        if self.output_head == 'adaptive':
+            return self.vocab_head.log_prob(hidden)
+        return F.log_softmax(self.trg_output_linear2(hidden), dim=-1)
+
+    def output_loss(self, hidden, gold):
+        """
+        Training loss and correct prediction count of the adaptive or sampled softmax head
+        from the hidden states of forward with 'return_hidden'
+        """
+        return self.vocab_head(hidden, gold, getattr(self, 'trg_output_linear2', None))
+
+    def generate(self, src_input_ids, src_attention_mask, beam_size: int = 5, beam_alpha: float = 0.7,
+                 repetition_penalty: float = 0.7, device=None, incremental_decoding: bool = True,
+                 max_len_a: float = 0, max_len_b: int = None, no_repeat_ngram_size: int = 0, min_len: int = 0,
+                 latent_sampling: bool = False, latent_seed: int = None, src_latent=None, return_latent: bool = False):
+        """
+        Latent variables are made once per source sentence before beam expansion; see Transformer.generate
+        """
 
         # Pre_setting
         device = src_input_ids.device
         batch_size = src_input_ids.size(0)
-        src_seq_size = src_input_ids.size(1)
-        every_batch = torch.arange(0, beam_size * batch_size, beam_size, device=device)
 
         src_encoder_out = self.encoder_model(input_ids=src_input_ids,
                                              attention_mask=src_attention_mask)
-        src_encoder_out = src_encoder_out['last_hidden_state']
-
-        src_encoder_out = src_encoder_out.transpose(0,1)
+        src_encoder_out = src_encoder_out['last_hidden_state'] # [batch, seq_len, d_model]
 
         if self.variational:
             # Tensor dimension transpose
             src_encoder_out = src_encoder_out.transpose(0,1) # [seq_len, batch, d_model]
-
-            src_encoder_out = self.latent_module.generate(src_encoder_out)
-
-        # Duplicate
-        src_encoder_out = src_encoder_out.view(-1, batch_size, 1, self.d_hidden)
-        src_encoder_out = src_encoder_out.repeat(1, 1, beam_size, 1)
-        src_encoder_out = src_encoder_out.view(src_seq_size, -1, self.d_hidden)
-
-        src_attention_mask = src_attention_mask.view(batch_size, 1, -1)
-        src_attention_mask = src_attention_mask.repeat(1, beam_size, 1)
-        src_attention_mask = src_attention_mask.view(-1, src_seq_size)
-
-        # Decoding start token setting
-        seqs = torch.tensor([[self.bos_idx]], dtype=torch.long, device=device) 
-        seqs = seqs.repeat(beam_size * batch_size, 1).contiguous() # (batch_size * k, 1)
-
-        # Scores save vector & decoding list setting
-        scores_save = torch.zeros(beam_size * batch_size, 1).to(device) # (batch_size * k, 1)
-        top_k_scores = torch.zeros(beam_size * batch_size, 1).to(device) # (batch_size * k, 1)
-        complete_seqs = defaultdict(list)
-        complete_ind = set()
-
-        for step in range(300):
-            model_out = self.decoder_model(input_ids = seqs, 
-                                           encoder_hidden_states = src_encoder_out,
-                                           encoder_attention_mask = src_attention_mask)
-            model_out = self.lm_head(model_out['last_hidden_state'])
-
-            scores = model_out[:,-1,] # Last token
-
-            # Repetition Penalty
-            if step >= 1 and repetition_penalty != 0:
-                next_ix = next_word_inds.view(-1)
-                for ix_ in range(len(next_ix)):
-                    if scores[ix_][next_ix[ix_]] < 0:
-                        scores[ix_][next_ix[ix_]] *= repetition_penalty
-                    else:
-                        scores[ix_][next_ix[ix_]] /= repetition_penalty
-
-            # Add score
-            scores = top_k_scores.expand_as(scores) + scores
-
-            if step == 0:
-                scores = scores[::beam_size] # (batch_size, vocab_num)
-                scores[:, self.eos_idx] = float('-inf') # set eos token probability zero in first step
-                top_k_scores, top_k_words = scores.topk(beam_size, 1, True, True)  # (batch_size, k) , (batch_size, k)
+            # Latent sampling setting; a seeded generator makes the sampled latent variables reproducible
+            latent_kwargs = {'sampling': latent_sampling, 'src_latent': src_latent, 'return_latent': True}
+            if latent_sampling and latent_seed is not None:
+                latent_kwargs['generator'] = torch.Generator(device=device).manual_seed(latent_seed)
+            src_encoder_out, src_latent = self.latent_module.generate(src_encoder_out, ~src_attention_mask.bool(),
+                                                                      **latent_kwargs)
+            src_encoder_out = src_encoder_out.transpose(0,1) # [batch, seq_len, d_model]
+
+        # Maximum decoding length of each source sentence (max_len_a * src_len + max_len_b)
+        if max_len_b is None:
+            max_len_b = self.trg_max_len
+        max_len_per_source = (max_len_a * src_attention_mask.sum(dim=1).float() + max_len_b).long()
+
+        if src_encoder_out.size(1) != src_attention_mask.size(1):
+            # Single latent memory slot is not padded
+            src_attention_mask = src_attention_mask.new_ones(batch_size, src_encoder_out.size(1))
+
+        # Duplicate; the Huggingface decoder takes encoder hidden states of the same batch size as its input,
+        # so the encoder output is repeated per beam instead of being shared as in Transformer.generate
+        beam_index = torch.arange(batch_size, device=device).repeat_interleave(beam_size) # (batch_size * k)
+        decoding_state = {
+            'encoder_out': src_encoder_out.index_select(0, beam_index), # (batch_size * k, seq_len, d_model)
+            'attention_mask': src_attention_mask.index_select(0, beam_index), # (batch_size * k, seq_len)
+            'past_key_values': None
+        }
+
+        def decode_step(seqs, step):
+            if incremental_decoding:
+                model_out = self.decoder_model(input_ids = seqs[:, -1:], 
+                                               encoder_hidden_states = decoding_state['encoder_out'],
+                                               encoder_attention_mask = decoding_state['attention_mask'],
+                                               past_key_values = decoding_state['past_key_values'],
+                                               use_cache = True)
+                decoding_state['past_key_values'] = model_out['past_key_values']
             else:
-                top_k_scores, top_k_words = scores.view(batch_size, -1).topk(beam_size, 1, True, True)
-
-            # Previous and Next word extract
-            prev_word_inds = top_k_words // self.model_config.vocab_size # (batch_size * k, out_seq)
-            next_word_inds = top_k_words % self.model_config.vocab_size # (batch_size * k, out_seq)
-            top_k_scores = top_k_scores.view(batch_size * beam_size, -1) # (batch_size * k, out_seq)
-            top_k_words = top_k_words.view(batch_size * beam_size, -1) # (batch_size * k, out_seq)
-            seqs = seqs[prev_word_inds.view(-1) + every_batch.unsqueeze(1).repeat(1, beam_size).view(-1)] # (batch_size * k, out_seq)
-            seqs = torch.cat([seqs, next_word_inds.view(beam_size * batch_size, -1)], dim=1) # (batch_size * k, out_seq + 1)
-
-            # Find and Save Complete Sequences Score
-            if self.eos_idx in next_word_inds:
-                eos_ind = torch.where(next_word_inds.view(-1) == self.eos_idx)
-                eos_ind = eos_ind[0].tolist()
-                complete_ind_add = set(eos_ind) - complete_ind
-                complete_ind_add = list(complete_ind_add)
-                complete_ind.update(eos_ind)
-                if len(complete_ind_add) > 0:
-                    scores_save[complete_ind_add] = top_k_scores[complete_ind_add]
-                    for ix in complete_ind_add:
-                        complete_seqs[ix] = seqs[ix].tolist()
-
-        # If eos token doesn't exist in sequence
-        if 0 in scores_save:
-            score_save_pos = torch.where(scores_save == 0)
-            for ix in score_save_pos[0].tolist():
-                complete_seqs[ix] = seqs[ix].tolist()
-            scores_save[score_save_pos] = top_k_scores[score_save_pos]
-
-        # Beam Length Normalization
-        lp = torch.tensor([len(complete_seqs[i]) for i in range(batch_size * beam_size)], device=device)
-        lp = (((lp + beam_size) ** beam_alpha) / ((beam_size + 1) ** beam_alpha)).unsqueeze(1)
-        scores_save = scores_save / lp
-
-        # Predicted and Label processing
-        _, ind = scores_save.view(batch_size, beam_size, -1).max(1)
-        predicted = ind.view(-1) + every_batch
-        
+                model_out = self.decoder_model(input_ids = seqs, 
+                                               encoder_hidden_states = decoding_state['encoder_out'],
+                                               encoder_attention_mask = decoding_state['attention_mask'])
+            model_out = self.dropout(F.gelu(self.trg_output_linear(model_out['last_hidden_state'][:, -1])))
+            return self.output_log_prob(self.trg_output_norm(model_out)) # (batch_size * k, vocab_num)
+
+        def reorder_state(beam_index, sentence_index):
+            if incremental_decoding:
+                decoding_state['past_key_values'] = reorder_past_key_values(decoding_state['past_key_values'],
+                                                                            beam_index)
+            # Duplicated encoder output is identical across the beams of a source, so previous rows can be used
+            if sentence_index is not None:
+                decoding_state['encoder_out'] = decoding_state['encoder_out'].index_select(0, beam_index)
+                decoding_state['attention_mask'] = decoding_state['attention_mask'].index_select(0, beam_index)
+
+        logits_processor = build_logits_processor(self.eos_idx, repetition_penalty=repetition_penalty,
+                                                  no_repeat_ngram_size=no_repeat_ngram_size, min_len=min_len)
+        predicted = beam_search(decode_step, reorder_state, batch_size=batch_size, beam_size=beam_size,
+                                bos_idx=self.bos_idx, eos_idx=self.eos_idx, max_len=self.trg_max_len,
+                                beam_alpha=beam_alpha, logits_processor=logits_processor,
+                                max_len_per_source=max_len_per_source, device=device)
+        if return_latent:
+            return predicted, src_latent
         return predicted
 
     @staticmethod
@@ -6,6 +6,7 @@ import torch.nn as nn
 from transformers import BertConfig, BertModel
 from transformers import ViTFeatureExtractor, ViTModel
 from ..latent_module.latent import Latent_module 
+from .utils import trim_embedding, trimmed_index
 
 class custom_Bert(nn.Module):
     def __init__(self, task: str = 'classification', num_class: int = None,
@@ -13,7 +14,7 @@ class custom_Bert(nn.Module):
                  src_language: str = 'en', trg_language: str = 'en',
                  variational: bool = True, variational_mode_dict: dict = dict(),
                  src_max_len: int = 768, trg_max_len: int = 300,
-                 emb_src_trg_weight_sharing: bool = True):
+                 emb_src_trg_weight_sharing: bool = True, vocab_map=None):
         super().__init__()
 
         """
@@ -51,6 +52,14 @@ class custom_Bert(nn.Module):
         else:
             self.txt_model = BertModel(config=self.model_config)
 
+        # Corpus vocabulary trimming; vocab_map is the original index of each trimmed index
+        if vocab_map is not None:
+            trim_embedding(self.txt_model.embeddings.word_embeddings, vocab_map)
+            self.txt_model.config.vocab_size = len(vocab_map)
+            self.pad_idx = trimmed_index(vocab_map, self.pad_idx)
+            self.bos_idx = trimmed_index(vocab_map, self.bos_idx)
+            self.eos_idx = trimmed_index(vocab_map, self.eos_idx)
+
         self.txt_embedding = self.txt_model.embeddings
         self.encoder = self.txt_model.encoder
         self.pooler = self.txt_model.pooler
@@ -0,0 +1,22 @@
+import numpy as np
+# Import PyTorch
+import torch
+import torch.nn as nn
+
+def trimmed_index(vocab_map, index):
+    # Trimmed index of an original token index; vocab_map is sorted
+    if index is None:
+        return None
+    trimmed = int(np.searchsorted(vocab_map, index))
+    if trimmed == len(vocab_map) or vocab_map[trimmed] != index:
+        raise Exception(f'Token index {index} is not kept in vocab_map')
+    return trimmed
+
+def trim_embedding(embedding: nn.Embedding, vocab_map):
+    """
+    Keep the pretrained rows of the original token indices in 'vocab_map'.
+    The embedding module is changed in place, so modules holding it keep sharing it.
+    """
+    embedding.weight = nn.Parameter(embedding.weight.data[torch.as_tensor(vocab_map, dtype=torch.long)].clone())
+    embedding.num_embeddings = len(vocab_map)
+    embedding.padding_idx = trimmed_index(vocab_map, embedding.padding_idx)
@@ -22,8 +22,10 @@ class PositionalEncoding(nn.Module):
         pe = pe.unsqueeze(0)
         self.register_buffer('pe', pe)
 
-    def forward(self, x):
-        return self.pe[:, :x.size(1)]
+    def forward(self, x, start_pos=0, position_ids=None):
+        if position_ids is not None:
+            return self.pe[0, position_ids] # (batch, seq_len, d_model)
+        return self.pe[:, start_pos:start_pos + x.size(1)]
 
 class TransformerEmbedding(nn.Module):
     """
@@ -46,8 +48,12 @@ class TransformerEmbedding(nn.Module):
         self.embed_norm = nn.LayerNorm(d_model, eps=1e-12)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, sequence):
+    def forward(self, sequence, start_pos=0, position_ids=None):
+        """
+        :param start_pos: position of the first token; used by incremental decoding
+        :param position_ids: (batch, seq_len) position of each token; used by packed examples
+        """
         x = self.dropout(F.gelu(self.linear_layer(self.token(sequence))))
-        x = self.embed_norm(x + self.position(sequence))
+        x = self.embed_norm(x + self.position(sequence, start_pos, position_ids))
         return x
     
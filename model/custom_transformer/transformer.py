@@ -1,4 +1,5 @@
 # Import modules
+import copy
 from collections import defaultdict
 # Import PyTorch
 import torch
@@ -6,9 +7,13 @@ from torch import nn
 from torch.autograd import Variable
 from torch.nn import functional as F
 from torch.nn.modules.activation import MultiheadAttention
+from torch.utils.checkpoint import checkpoint
 
 # Import custom modules
 from .embedding import TransformerEmbedding
+from ..beam_search import beam_search
+from ..logits_processor import build_logits_processor
+from ..output_head import build_output_head
 from ..latent_module.latent import Latent_module 
 
 class Transformer(nn.Module):
@@ -23,7 +28,8 @@ class Transformer(nn.Module):
                  emb_src_trg_weight_sharing: bool = False,
                  dropout: float = 0.1, embedding_dropout: float = 0.1,
                  variational: bool = True, variational_mode_dict: dict = dict(), 
-                 parallel: bool = False):
+                 parallel: bool = False, gradient_checkpointing: bool = False, checkpoint_every: int = 1,
+                 output_head_dict: dict = dict()):
 
         super(Transformer, self).__init__()
 
@@ -44,6 +50,10 @@ class Transformer(nn.Module):
             self.num_common_layer = num_common_layer
             self.num_encoder_nonparallel = num_encoder_layer - num_common_layer
 
+        # Gradient checkpointing setting
+        self.gradient_checkpointing = gradient_checkpointing
+        self.checkpoint_every = checkpoint_every
+
         # Dropout setting
         self.dropout = nn.Dropout(dropout)
 
@@ -71,7 +81,13 @@ class Transformer(nn.Module):
         # Target linear part
         self.trg_output_linear = nn.Linear(d_model, d_embedding)
         self.trg_output_norm = nn.LayerNorm(d_embedding, eps=1e-12)
-        self.trg_output_linear2 = nn.Linear(d_embedding, trg_vocab_num)
+
+        # Adaptive or sampled softmax head for large vocabularies
+        self.output_head = output_head_dict.get('output_head', 'softmax')
+        self.vocab_head = build_output_head(output_head_dict, d_embedding, trg_vocab_num)
+        # The adaptive softmax head has its own projection instead of 'trg_output_linear2'
+        if self.output_head != 'adaptive':
+            self.trg_output_linear2 = nn.Linear(d_embedding, trg_vocab_num)
 
         # Variational mode setting
         if variational:
@@ -83,17 +99,24 @@ class Transformer(nn.Module):
             self.latent_add_encoder_out = variational_mode_dict['latent_add_encoder_out']
             self.z_var = variational_mode_dict['z_var']
             self.d_latent = variational_mode_dict['d_latent']
+            self.batched_src_trg_encoding = variational_mode_dict.get('batched_src_trg_encoding', False)
+            self.trg_encoder_mode = variational_mode_dict.get('trg_encoder_mode', 'shared')
+            self.trg_encoder_ema_decay = variational_mode_dict.get('trg_encoder_ema_decay', 0.999)
+            self.parallel_layer_latent = variational_mode_dict.get('parallel_layer_latent', False)
 
-            self.latent_module = Latent_module(d_model=self.d_hidden, d_latent=self.d_latent, 
+            self.latent_module = Latent_module(d_model=self.d_model, d_latent=self.d_latent, 
                                                variational_model=self.variational_model, 
                                                variational_token_processing=self.variational_token_processing,
                                                variational_with_target=self.variational_with_target,
                                                cnn_encoder=self.cnn_encoder, cnn_decoder=self.cnn_decoder,
                                                latent_add_encoder_out=self.latent_add_encoder_out,
-                                               z_var=self.z_var, src_max_len=src_max_len, trg_max_len=trg_max_len)
+                                               z_var=self.z_var, src_max_len=src_max_len, trg_max_len=trg_max_len,
+                                               mmd_block_size=variational_mode_dict.get('mmd_block_size', 0))
         
         # Weight sharing
         self.x_logit_scale = 1.
+        if trg_emb_prj_weight_sharing and self.output_head == 'adaptive':
+            raise Exception('trg_emb_prj_weight_sharing is not available with the adaptive softmax head')
         if trg_emb_prj_weight_sharing:
             # Share the weight between target word embedding & last dense layer
             self.trg_output_linear2.weight = self.trg_embedding.token.weight
@@ -102,105 +125,238 @@ class Transformer(nn.Module):
         if emb_src_trg_weight_sharing:
             assert src_vocab_num == trg_vocab_num
             self.src_embedding.token.weight = self.trg_embedding.token.weight
+
+        # EMA snapshot of the target embedding and encoders for the target posterior
+        if variational and self.trg_encoder_mode == 'ema':
+            self.ema_trg_encoder = nn.ModuleDict({
+                'embedding': copy.deepcopy(self.trg_embedding),
+                'encoders': copy.deepcopy(self.encoders)})
+            for param in self.ema_trg_encoder.parameters():
+                param.requires_grad_(False)
             
     def forward(self, src_input_ids, src_attention_mask, src_img,
                 trg_label, trg_input_ids, trg_attention_mask,
-                non_pad_position=None, tgt_subsqeunt_mask=None):
+                non_pad_position=None, tgt_subsqeunt_mask=None,
+                src_segment_ids=None, trg_segment_ids=None, return_hidden: bool = False, trg_posterior=None):
+        """
+        With 'return_hidden', the hidden states before the vocabulary projection 'trg_output_linear2' are returned
+        instead of the logits; see ChunkedCrossEntropyLoss in model/loss.py
+        'trg_posterior' is the cached output of 'target_posterior' used instead of the target encoder pass
+        (non-parallel Transformer only)
+        """
 
         # Pre_setting for variational model and translation task
         trg_input_ids_copy = trg_input_ids.clone().detach()
         trg_input_ids = trg_input_ids[:, :-1]
+        if tgt_subsqeunt_mask is not None:
+            # Batches can be shorter than trg_max_len with dynamic padding
+            tgt_subsqeunt_mask = tgt_subsqeunt_mask[:trg_input_ids.size(1), :trg_input_ids.size(1)]
 
         # Key padding mask setting
         src_key_padding_mask = ~src_attention_mask.bool()
         tgt_key_padding_mask = ~trg_input_ids.bool()
         tgt_key_padding_mask_ = ~trg_input_ids_copy.bool()
 
+        # Layers in a segment of 'checkpoint_every' keep no activations for backward while training
+        checkpoint_every = self.checkpoint_every if self.gradient_checkpointing and self.training else 0
+
+        # Packed examples setting; attention is restricted to the same example and positions restart
+        src_mask, memory_mask, trg_encoder_mask = None, None, None
+        src_position_ids, trg_position_ids, trg_copy_position_ids = None, None, None
+        if src_segment_ids is not None:
+            n_head = self.encoders[0].self_attn.num_heads
+            trg_input_segment_ids = trg_segment_ids[:, :-1]
+            src_mask = packed_attention_mask(src_segment_ids, src_segment_ids, n_head)
+            tgt_subsqeunt_mask = packed_attention_mask(trg_input_segment_ids, trg_input_segment_ids, n_head,
+                                                       causal=True)
+            memory_mask = packed_attention_mask(trg_input_segment_ids, src_segment_ids, n_head)
+            trg_encoder_mask = packed_attention_mask(trg_segment_ids, trg_segment_ids, n_head)
+            src_position_ids = segment_position_ids(src_segment_ids)
+            trg_position_ids = segment_position_ids(trg_input_segment_ids)
+            trg_copy_position_ids = segment_position_ids(trg_segment_ids)
+            # Padding is already masked by the segment masks
+            src_key_padding_mask, tgt_key_padding_mask, tgt_key_padding_mask_ = None, None, None
+
         # Embedding
-        encoder_out = self.src_embedding(src_input_ids).transpose(0, 1) # (token, batch, d_model)
-        decoder_out = self.trg_embedding(trg_input_ids).transpose(0, 1) # (token, batch, d_model)
+        encoder_out = self.src_embedding(src_input_ids, 
+                                         position_ids=src_position_ids).transpose(0, 1) # (token, batch, d_model)
+        decoder_out = self.trg_embedding(trg_input_ids, 
+                                         position_ids=trg_position_ids).transpose(0, 1) # (token, batch, d_model)
 
         # Parallel Transformer
         if self.parallel:
-            for i, encoder in enumerate(self.encoders):
-                if i == 0:
-                    encoder_out_cat = encoder(encoder_out, 
-                        src_key_padding_mask=src_key_padding_mask).unsqueeze(0)
-                else:
-                    encoder_out_ = encoder(encoder_out_cat[-1], 
-                        src_key_padding_mask=src_key_padding_mask).unsqueeze(0)
-                    encoder_out_cat = torch.cat((encoder_out_cat, encoder_out_), dim=0)
+            # Output of every encoder layer
+            embedding_out = encoder_out
+            encoder_out_list = list()
+            for encoder in self.encoders:
+                encoder_out = run_layers([encoder], encoder_out, checkpoint_every, src_mask=src_mask,
+                                         src_key_padding_mask=src_key_padding_mask)
+                encoder_out_list.append(encoder_out)
 
             if self.variational:
                 # Target sentence latent mapping
-                for i, encoder in enumerate(self.encoders):
-                    if i == 0:
-                        if self.variational_with_target:
-                            encoder_out_trg = self.trg_embedding(trg_input_ids_copy).transpose(0, 1)
-                            encoder_out_trg_cat = encoder(encoder_out_trg, 
-                                                        src_key_padding_mask=tgt_key_padding_mask_).unsqueeze(0)
-                        else:
-                            encoder_out_trg_cat = list()
-                            encoder_out_trg_cat[i] = None
-                        encoder_out_pre, dist_loss = self.latent_module(encoder_out_cat[i], encoder_out_trg_cat[i])
-                        encoder_out_cat[i] = encoder_out_pre
-                    else:
-                        if self.variational_with_target:
-                            encoder_out_trg_pre = encoder(encoder_out_trg_cat[-1], 
-                                                        src_key_padding_mask=tgt_key_padding_mask_).unsqueeze(0)
-                            encoder_out_trg_cat = torch.cat((encoder_out_trg_cat, encoder_out_trg_pre), dim=0)
-                        else:
-                            encoder_out_trg_cat[i] = None
-
-                        encoder_out_pre, dist_loss_pre = self.latent_module(encoder_out, encoder_out_trg_cat[i])
-                        dist_loss += dist_loss_pre
-                        encoder_out_cat[i] = encoder_out_pre
-
+                encoder_out_trg_list = [None] * len(self.encoders)
+                if self.variational_with_target:
+                    encoder_out_trg = self.trg_embedding(trg_input_ids_copy, 
+                                                         position_ids=trg_copy_position_ids).transpose(0, 1)
+                    for i, encoder in enumerate(self.encoders):
+                        encoder_out_trg = run_layers([encoder], encoder_out_trg, checkpoint_every,
+                                                     src_mask=trg_encoder_mask,
+                                                     src_key_padding_mask=tgt_key_padding_mask_)
+                        encoder_out_trg_list[i] = encoder_out_trg
+
+                # Latent input of the layers after the first is the source embedding output
+                # unless 'parallel_layer_latent' gives every layer its own output
+                if not self.parallel_layer_latent:
+                    encoder_out_list = encoder_out_list[:1] + [embedding_out] * (len(encoder_out_list) - 1)
+
+                encoder_out_list, dist_loss = self.latent_module.layerwise_forward(encoder_out_list, encoder_out_trg_list,
+                                                                                   src_segment_ids, trg_segment_ids,
+                                                                                   src_key_padding_mask, tgt_key_padding_mask_)
             else:
                 dist_loss = torch.tensor(0, dtype=torch.float)
 
+            # Single latent memory slot is not padded
+            memory_key_padding_mask = src_key_padding_mask
+            if src_key_padding_mask is not None and encoder_out_list[0].size(0) != src_key_padding_mask.size(1):
+                memory_key_padding_mask = None
+
             for i, decoder in enumerate(self.decoders):
-                decoder_out = decoder(decoder_out, encoder_out_cat[i], tgt_mask=tgt_subsqeunt_mask,
-                    memory_key_padding_mask=src_key_padding_mask, tgt_key_padding_mask=tgt_key_padding_mask)
+                decoder_out = run_layers([decoder], decoder_out, checkpoint_every,
+                    memory=encoder_out_list[i], tgt_mask=tgt_subsqeunt_mask, memory_mask=memory_mask,
+                    memory_key_padding_mask=memory_key_padding_mask, tgt_key_padding_mask=tgt_key_padding_mask)
 
         # Non-parallel Transformer
         else:
+            # Source and target encoder in one batch
+            batched_encoding = self.variational and self.variational_with_target and self.batched_src_trg_encoding \
+                and src_segment_ids is None and self.trg_encoder_mode == 'shared'
+            if batched_encoding:
+                encoder_out_trg = self.trg_embedding(trg_input_ids_copy).transpose(0, 1)
+                encoder_out, encoder_out_trg = batched_src_trg_encoding(self.encoders, encoder_out, encoder_out_trg,
+                                                                        src_key_padding_mask, tgt_key_padding_mask_,
+                                                                        checkpoint_every=checkpoint_every)
             # Encoder
-            for encoder in self.encoders:
-                encoder_out = encoder(encoder_out, src_key_padding_mask=src_key_padding_mask)
+            else:
+                encoder_out = run_layers(self.encoders, encoder_out, checkpoint_every,
+                                         src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
 
             # Variational
             if self.variational:
-                encoder_out_trg = self.trg_embedding(trg_input_ids_copy).transpose(0, 1)
-                # Target sentence latent mapping
-                for encoder in self.encoders:
-                    encoder_out_trg = encoder(encoder_out_trg, 
-                                              src_key_padding_mask=tgt_key_padding_mask_)
-
-                encoder_out, dist_loss = self.latent_module(encoder_out, encoder_out_trg)
+                if not self.variational_with_target or trg_posterior is not None:
+                    # Target sentence is not used by the latent mapping, or its posterior is cached
+                    encoder_out_trg = None
+                elif not batched_encoding:
+                    # Target sentence latent mapping
+                    encoder_out_trg = self.target_encoding(trg_input_ids_copy, trg_copy_position_ids,
+                                                           trg_encoder_mask, tgt_key_padding_mask_,
+                                                           checkpoint_every=checkpoint_every)
+
+                encoder_out, dist_loss = self.latent_module(encoder_out, encoder_out_trg,
+                                                            src_segment_ids, trg_segment_ids,
+                                                            src_key_padding_mask, tgt_key_padding_mask_,
+                                                            trg_posterior=trg_posterior)
             else:
                 dist_loss = torch.tensor(0, dtype=torch.float)
 
+            # Single latent memory slot is not padded
+            memory_key_padding_mask = src_key_padding_mask
+            if src_key_padding_mask is not None and encoder_out.size(0) != src_key_padding_mask.size(1):
+                memory_key_padding_mask = None
+
             # Decoder
-            for decoder in self.decoders:
-                decoder_out = decoder(decoder_out, encoder_out, tgt_mask=tgt_subsqeunt_mask,
-                    memory_key_padding_mask=src_key_padding_mask, tgt_key_padding_mask=tgt_key_padding_mask)
+            decoder_out = run_layers(self.decoders, decoder_out, checkpoint_every,
+                memory=encoder_out, tgt_mask=tgt_subsqeunt_mask, memory_mask=memory_mask,
+                memory_key_padding_mask=memory_key_padding_mask, tgt_key_padding_mask=tgt_key_padding_mask)
 
         decoder_out = decoder_out.transpose(0, 1).contiguous()
         if non_pad_position is not None:
             decoder_out = decoder_out[non_pad_position]
 
         decoder_out = self.trg_output_norm(self.dropout(F.gelu(self.trg_output_linear(decoder_out))))
+        if return_hidden:
+            return decoder_out, dist_loss
+        if self.output_head == 'adaptive':
+            # Log-probabilities work as logits for the cross entropy and accuracy
+            return self.output_log_prob(decoder_out), dist_loss
         decoder_out = self.trg_output_linear2(decoder_out)
         decoder_out = decoder_out * self.x_logit_scale
         return decoder_out, dist_loss
 
-    def generate(self, src_input_ids, src_attention_mask, beam_size, beam_alpha, repetition_penalty, device):
+    def output_log_prob(self, hidden):
+        """
+        Full vocabulary log-probabilities of hidden (tokens, d_embedding) for any output head
+        """
+        if self.output_head == 'adaptive':
+            return self.vocab_head.log_prob(hidden)
+        return F.log_softmax(self.trg_output_linear2(hidden) * self.x_logit_scale, dim=-1)
+
+    def output_loss(self, hidden, gold):
+        """
+        Training loss and correct prediction count of the adaptive or sampled softmax head
+        from the hidden states of forward with 'return_hidden'
+        """
+        return self.vocab_head(hidden, gold, getattr(self, 'trg_output_linear2', None), logit_scale=self.x_logit_scale)
+
+    def target_encoding(self, trg_input_ids, position_ids=None, src_mask=None, src_key_padding_mask=None,
+                        checkpoint_every: int = 0):
+        """
+        Target sentence encoding for the latent posterior. 'shared' backpropagates through the live encoders,
+        'no_grad' uses the live weights without keeping activations and 'ema' uses the EMA snapshot.
+        'cache' uses the live weights without keeping activations when no cached posterior is given.
+        """
+        if self.trg_encoder_mode == 'ema':
+            embedding, encoders = self.ema_trg_encoder['embedding'], self.ema_trg_encoder['encoders']
+        else:
+            embedding, encoders = self.trg_embedding, self.encoders
+
+        with torch.set_grad_enabled(torch.is_grad_enabled() and self.trg_encoder_mode == 'shared'):
+            encoder_out_trg = embedding(trg_input_ids, position_ids=position_ids).transpose(0, 1)
+            encoder_out_trg = run_layers(encoders, encoder_out_trg, checkpoint_every,
+                                         src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
+
+        return encoder_out_trg
+
+    @torch.no_grad()
+    def target_posterior(self, trg_input_ids, trg_attention_mask):
+        """
+        Target posterior of each sentence from the live target embedding and encoders, to be cached for
+        'forward' with trg_encoder_mode 'cache'; see Latent_module.target_posterior
+        """
+        trg_key_padding_mask = ~trg_attention_mask.bool()
+        encoder_out_trg = self.trg_embedding(trg_input_ids).transpose(0, 1) # (trg_seq, batch_size, d_model)
+        encoder_out_trg = run_layers(self.encoders, encoder_out_trg, src_key_padding_mask=trg_key_padding_mask)
+        return self.latent_module.target_posterior(encoder_out_trg, trg_key_padding_mask)
+
+    @torch.no_grad()
+    def update_trg_encoder(self, decay: float = None):
+        """
+        Move the EMA snapshot toward the live target embedding and encoders; 'decay=0' copies the live weights
+        """
+        if not self.variational or self.trg_encoder_mode != 'ema':
+            return
+        decay = self.trg_encoder_ema_decay if decay is None else decay
+        live_modules = [self.trg_embedding, self.encoders]
+        ema_modules = [self.ema_trg_encoder['embedding'], self.ema_trg_encoder['encoders']]
+        for live_module, ema_module in zip(live_modules, ema_modules):
+            for ema_param, param in zip(ema_module.parameters(), live_module.parameters()):
+                ema_param.mul_(decay).add_(param.detach(), alpha=1 - decay)
+            for ema_buffer, buffer in zip(ema_module.buffers(), live_module.buffers()):
+                ema_buffer.copy_(buffer)
+
+    def generate(self, src_input_ids, src_attention_mask, beam_size, beam_alpha, repetition_penalty, device,
+                 incremental_decoding: bool = True, max_len_a: float = 0, max_len_b: int = None,
+                 no_repeat_ngram_size: int = 0, min_len: int = 0, latent_sampling: bool = False,
+                 latent_seed: int = None, src_latent=None, return_latent: bool = False):
+        """
+        Latent variables are made once per source sentence before beam expansion; the posterior mean by default
+        or a sample seeded with 'latent_seed' with 'latent_sampling'. With 'return_latent', the latent variable of
+        each source is returned with the predictions and it can be given back as 'src_latent'.
+        """
         # Input, output setting
         batch_size = src_input_ids.size(0)
         src_seq_size = src_input_ids.size(1)
         encoder_out_dict = defaultdict(list)
-        every_batch = torch.arange(0, beam_size * batch_size, beam_size, device=device)
 
         # Encoding
         encoder_out = self.src_embedding(src_input_ids).transpose(0, 1) # (src_seq, batch_size, d_model)
@@ -214,111 +370,110 @@ class Transformer(nn.Module):
                 encoder_out = self.encoders[i](encoder_out, 
                                 src_key_padding_mask=src_key_padding_mask) # (src_seq, batch_size, d_model)
 
-        # Expanding
-        src_key_padding_mask = src_key_padding_mask.view(batch_size, 1, -1)
-        src_key_padding_mask = src_key_padding_mask.repeat(1, beam_size, 1)
-        src_key_padding_mask = src_key_padding_mask.view(-1, src_seq_size)
-        if self.parallel:
-            for i in encoder_out_dict:
-                encoder_out_dict[i] = encoder_out_dict[i].view(-1, batch_size, 1, self.d_model)
-                encoder_out_dict[i] = encoder_out_dict[i].repeat(1, 1, beam_size, 1)
-                encoder_out_dict[i] = encoder_out_dict[i].view(src_seq_size, -1, self.d_model)
-        else:
-            encoder_out = encoder_out.view(-1, batch_size, 1, self.d_model)
-            encoder_out = encoder_out.repeat(1, 1, beam_size, 1)
-            encoder_out = encoder_out.view(src_seq_size, -1, self.d_model)
+        # Maximum decoding length of each source sentence (max_len_a * src_len + max_len_b)
+        if max_len_b is None:
+            max_len_b = self.trg_max_len
+        src_len = (~src_key_padding_mask).sum(dim=1) # (batch_size)
+        max_len_per_source = (max_len_a * src_len.float() + max_len_b).long()
 
         if self.variational:
-            encoder_out = self.latent_module.generate(encoder_out)
-
-        # Scores save vector & decoding list setting
-        scores_save = torch.zeros(beam_size * batch_size, 1).to(device) # (batch_size * k, 1)
-        top_k_scores = torch.zeros(beam_size * batch_size, 1).to(device) # (batch_size * k, 1)
-        complete_seqs = defaultdict(list)
-        complete_ind = set()
-
-        # Decoding start token setting
-        seqs = torch.tensor([[self.bos_idx]], dtype=torch.long, device=device) 
-        seqs = seqs.repeat(beam_size * batch_size, 1).contiguous() # (batch_size * k, 1)
-
-        for step in range(self.trg_max_len):
+            # Latent sampling setting; a seeded generator makes the sampled latent variables reproducible
+            latent_kwargs = {'sampling': latent_sampling, 'src_latent': src_latent, 'return_latent': True}
+            if latent_sampling and latent_seed is not None:
+                latent_kwargs['generator'] = torch.Generator(device=src_input_ids.device).manual_seed(latent_seed)
+            encoder_out, src_latent = self.latent_module.generate(encoder_out, src_key_padding_mask, **latent_kwargs)
+            if encoder_out.size(0) != src_seq_size and not self.parallel:
+                # Single latent memory slot is not padded; parallel decoders read the full-length encoder_out_dict
+                src_seq_size = encoder_out.size(0)
+                src_key_padding_mask = src_key_padding_mask.new_zeros(batch_size, src_seq_size)
+
+        # Self-attention key, value cache of each decoder layer
+        decoder_cache = [dict() for _ in range(len(self.decoders))]
+
+        if incremental_decoding:
+            # Memory key, value are projected once per source sentence and shared by its beams
+            for i in range(len(self.decoders)):
+                memory = encoder_out_dict[i] if self.parallel else encoder_out
+                self.decoders[i].precompute_memory(memory, decoder_cache[i])
+        else:
+            # Expanding
+            src_key_padding_mask = src_key_padding_mask.view(batch_size, 1, -1)
+            src_key_padding_mask = src_key_padding_mask.repeat(1, beam_size, 1)
+            src_key_padding_mask = src_key_padding_mask.view(-1, src_seq_size)
+            if self.parallel:
+                for i in encoder_out_dict:
+                    encoder_out_dict[i] = encoder_out_dict[i].view(-1, batch_size, 1, self.d_model)
+                    encoder_out_dict[i] = encoder_out_dict[i].repeat(1, 1, beam_size, 1)
+                    encoder_out_dict[i] = encoder_out_dict[i].view(src_seq_size, -1, self.d_model)
+            else:
+                encoder_out = encoder_out.view(-1, batch_size, 1, self.d_model)
+                encoder_out = encoder_out.repeat(1, 1, beam_size, 1)
+                encoder_out = encoder_out.view(src_seq_size, -1, self.d_model)
+
+        # Decoder state which is re-ordered by beam search
+        decoding_state = {
+            'src_key_padding_mask': src_key_padding_mask,
+            'encoder_out': encoder_out,
+            'encoder_out_dict': encoder_out_dict
+        }
+
+        def decode_step(seqs, step):
             # Decoder setting
-            tgt_mask = self.generate_square_subsequent_mask(seqs.size(1), device) # (out_seq)
-            tgt_mask = tgt_mask.to(device, non_blocking=True)
-            tgt_key_padding_mask = (seqs == self.pad_idx) # (batch_size * k, out_seq)
+            tgt_key_padding_mask = (seqs == self.pad_idx) # (active * k, out_seq)
+            src_key_padding_mask = decoding_state['src_key_padding_mask']
 
             # Decoding sentence
-            decoder_out = self.trg_embedding(seqs).transpose(0, 1) # (out_seq, batch_size * k, d_model)
-            if self.parallel:
+            if incremental_decoding:
+                # Only the newest token is decoded; previous positions are in decoder_cache
+                decoder_out = self.trg_embedding(seqs[:, -1:], start_pos=step).transpose(0, 1) # (1, active * k, d_model)
                 for i in range(len(self.decoders)):
-                    decoder_out = self.decoders[i](decoder_out, encoder_out_dict[i], tgt_mask=tgt_mask, 
+                    decoder_out = self.decoders[i].incremental_forward(decoder_out, decoder_cache[i],
                                     memory_key_padding_mask=src_key_padding_mask,
-                                    tgt_key_padding_mask=tgt_key_padding_mask) # (out_seq, batch_size * k, d_model)
+                                    tgt_key_padding_mask=tgt_key_padding_mask) # (1, active * k, d_model)
             else:
+                tgt_mask = self.generate_square_subsequent_mask(seqs.size(1), device) # (out_seq)
+                tgt_mask = tgt_mask.to(device, non_blocking=True)
+                decoder_out = self.trg_embedding(seqs).transpose(0, 1) # (out_seq, active * k, d_model)
                 for i in range(len(self.decoders)):
-                    decoder_out = self.decoders[i](decoder_out, encoder_out, tgt_mask=tgt_mask, 
+                    if self.parallel:
+                        memory = decoding_state['encoder_out_dict'][i]
+                    else:
+                        memory = decoding_state['encoder_out']
+                    decoder_out = self.decoders[i](decoder_out, memory, tgt_mask=tgt_mask, 
                                     memory_key_padding_mask=src_key_padding_mask,
-                                    tgt_key_padding_mask=tgt_key_padding_mask) # (out_seq, batch_size * k, d_model)
+                                    tgt_key_padding_mask=tgt_key_padding_mask) # (out_seq, active * k, d_model)
 
             # Score calculate
-            scores = F.gelu(self.trg_output_linear(decoder_out[-1])) # (batch_size * k, d_embedding)
-            scores = self.trg_output_linear2(self.trg_output_norm(scores)) # (batch_size * k, vocab_num)
-            scores = F.log_softmax(scores, dim=1) # (batch_size * k, vocab_num)
-
-            # Repetition Penalty
-            if step >= 1 and repetition_penalty != 0:
-                next_ix = next_word_inds.view(-1)
-                for ix_ in range(len(next_ix)):
-                    if scores[ix_][next_ix[ix_]] < 0:
-                        scores[ix_][next_ix[ix_]] *= repetition_penalty
-                    else:
-                        scores[ix_][next_ix[ix_]] /= repetition_penalty
-
-            # Add score
-            scores = top_k_scores.expand_as(scores) + scores  # (batch_size * k, vocab_num)
-            if step == 0:
-                scores = scores[::beam_size] # (batch_size, vocab_num)
-                scores[:, self.eos_idx] = float('-inf') # set eos token probability zero in first step
-                top_k_scores, top_k_words = scores.topk(beam_size, 1, True, True)  # (batch_size, k) , (batch_size, k)
-            else:
-                top_k_scores, top_k_words = scores.view(batch_size, -1).topk(beam_size, 1, True, True)
-
-            # Previous and Next word extract
-            prev_word_inds = top_k_words // self.trg_vocab_num # (batch_size * k, out_seq)
-            next_word_inds = top_k_words % self.trg_vocab_num # (batch_size * k, out_seq)
-            top_k_scores = top_k_scores.view(batch_size * beam_size, -1) # (batch_size * k, out_seq)
-            top_k_words = top_k_words.view(batch_size * beam_size, -1) # (batch_size * k, out_seq)
-            seqs = seqs[prev_word_inds.view(-1) + every_batch.unsqueeze(1).repeat(1, beam_size).view(-1)] # (batch_size * k, out_seq)
-            seqs = torch.cat([seqs, next_word_inds.view(beam_size * batch_size, -1)], dim=1) # (batch_size * k, out_seq + 1)
-
-            # Find and Save Complete Sequences Score
-            if self.eos_idx in next_word_inds:
-                eos_ind = torch.where(next_word_inds.view(-1) == self.eos_idx)
-                eos_ind = eos_ind[0].tolist()
-                complete_ind_add = set(eos_ind) - complete_ind
-                complete_ind_add = list(complete_ind_add)
-                complete_ind.update(eos_ind)
-                if len(complete_ind_add) > 0:
-                    scores_save[complete_ind_add] = top_k_scores[complete_ind_add]
-                    for ix in complete_ind_add:
-                        complete_seqs[ix] = seqs[ix].tolist()
-
-        # If eos token doesn't exist in sequence
-        if 0 in scores_save:
-            score_save_pos = torch.where(scores_save == 0)
-            for ix in score_save_pos[0].tolist():
-                complete_seqs[ix] = seqs[ix].tolist()
-            scores_save[score_save_pos] = top_k_scores[score_save_pos]
-
-        # Beam Length Normalization
-        lp = torch.tensor([len(complete_seqs[i]) for i in range(batch_size * beam_size)], device=device)
-        lp = (((lp + beam_size) ** beam_alpha) / ((beam_size + 1) ** beam_alpha)).unsqueeze(1)
-        scores_save = scores_save / lp
-
-        # Predicted and Label processing
-        _, ind = scores_save.view(batch_size, beam_size, -1).max(1)
-        ind_expand = ind.view(-1) + every_batch
-        predicted = [complete_seqs[i] for i in ind_expand.tolist()]
+            scores = F.gelu(self.trg_output_linear(decoder_out[-1])) # (active * k, d_embedding)
+            scores = self.output_log_prob(self.trg_output_norm(scores)) # (active * k, vocab_num)
+            return scores
+
+        def reorder_state(beam_index, sentence_index):
+            if incremental_decoding:
+                for layer_cache in decoder_cache:
+                    reorder_attention_cache(layer_cache, beam_index, sentence_index)
+                if sentence_index is not None:
+                    decoding_state['src_key_padding_mask'] = \
+                        decoding_state['src_key_padding_mask'].index_select(0, sentence_index)
+            elif sentence_index is not None:
+                # Expanded memory is identical across the beams of a source, so previous rows can be used
+                decoding_state['src_key_padding_mask'] = \
+                    decoding_state['src_key_padding_mask'].index_select(0, beam_index)
+                if self.parallel:
+                    for i in decoding_state['encoder_out_dict']:
+                        decoding_state['encoder_out_dict'][i] = \
+                            decoding_state['encoder_out_dict'][i].index_select(1, beam_index)
+                else:
+                    decoding_state['encoder_out'] = decoding_state['encoder_out'].index_select(1, beam_index)
+
+        logits_processor = build_logits_processor(self.eos_idx, repetition_penalty=repetition_penalty,
+                                                  no_repeat_ngram_size=no_repeat_ngram_size, min_len=min_len)
+        predicted = beam_search(decode_step, reorder_state, batch_size=batch_size, beam_size=beam_size,
+                                bos_idx=self.bos_idx, eos_idx=self.eos_idx, max_len=self.trg_max_len,
+                                beam_alpha=beam_alpha, logits_processor=logits_processor,
+                                max_len_per_source=max_len_per_source, device=device)
+        if return_latent:
+            return predicted, src_latent
         return predicted
 
     @staticmethod
@@ -327,6 +482,150 @@ class Transformer(nn.Module):
         mask = mask.masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, 0.0)
         return mask
 
+def segment_position_ids(segment_ids):
+    """
+    Position of each token from the start of its packed example
+    segment_ids: (batch, seq_len)
+    """
+    positions = torch.arange(segment_ids.size(1), device=segment_ids.device).unsqueeze(0).expand_as(segment_ids)
+    is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+    is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    start = torch.where(is_start, positions, torch.zeros_like(positions)).cummax(dim=1)[0]
+    return positions - start
+
+def packed_attention_mask(query_segment_ids, key_segment_ids, n_head, causal=False):
+    """
+    Block-diagonal attention mask of packed examples; (batch * n_head, query_len, key_len) and True is not allowed.
+    Padding queries (segment 0) attend every key so that no row is fully masked.
+    """
+    allowed = query_segment_ids.unsqueeze(2) == key_segment_ids.unsqueeze(1) # (batch, query_len, key_len)
+    if causal:
+        allowed = allowed & torch.ones(allowed.size(1), allowed.size(2), dtype=torch.bool,
+                                       device=allowed.device).tril().unsqueeze(0)
+    allowed = allowed | (query_segment_ids == 0).unsqueeze(2)
+    return (~allowed).repeat_interleave(n_head, dim=0)
+
+def run_layers(layers, hidden, checkpoint_every: int = 0, **kwargs):
+    """
+    Run a stack of encoder or decoder layers on hidden (seq_len, batch, d_model).
+    With 'checkpoint_every' > 0, each segment of that many layers keeps only its input for backward and
+    is recomputed in backward with the same autocast state and dropout random state.
+    """
+    if checkpoint_every <= 0 or not torch.is_grad_enabled():
+        for layer in layers:
+            hidden = layer(hidden, **kwargs)
+        return hidden
+
+    for start in range(0, len(layers), checkpoint_every):
+        hidden = checkpoint(run_layers, layers[start:start + checkpoint_every], hidden,
+                            use_reentrant=False, **kwargs)
+    return hidden
+
+def batched_src_trg_encoding(encoders, src, trg, src_key_padding_mask, trg_key_padding_mask,
+                             checkpoint_every: int = 0):
+    """
+    Encode source and target (seq_len, batch, d_model) in one pass of the encoder stack.
+    Both are padded to a common length and concatenated on the batch dimension, then split back.
+    """
+    src_len, trg_len, batch_size = src.size(0), trg.size(0), src.size(1)
+    seq_len = max(src_len, trg_len)
+    src = torch.cat((src, src.new_zeros(seq_len - src_len, batch_size, src.size(2))), dim=0)
+    trg = torch.cat((trg, trg.new_zeros(seq_len - trg_len, batch_size, trg.size(2))), dim=0)
+    src_key_padding_mask = torch.cat((src_key_padding_mask,
+                                      src_key_padding_mask.new_ones(batch_size, seq_len - src_len)), dim=1)
+    trg_key_padding_mask = torch.cat((trg_key_padding_mask,
+                                      trg_key_padding_mask.new_ones(batch_size, seq_len - trg_len)), dim=1)
+
+    encoder_out = torch.cat((src, trg), dim=1) # (seq_len, batch * 2, d_model)
+    key_padding_mask = torch.cat((src_key_padding_mask, trg_key_padding_mask), dim=0) # (batch * 2, seq_len)
+    encoder_out = run_layers(encoders, encoder_out, checkpoint_every, src_key_padding_mask=key_padding_mask)
+    return encoder_out[:src_len, :batch_size], encoder_out[:trg_len, batch_size:]
+
+def split_heads(x, n_head):
+    """
+    (seq_len, batch, d_model) -> (batch, n_head, seq_len, head_dim)
+    """
+    seq_len, batch_size, d_model = x.size()
+    x = x.contiguous().view(seq_len, batch_size, n_head, d_model // n_head)
+    return x.permute(1, 2, 0, 3)
+
+def attention_output(attn, q, k, v, key_padding_mask=None):
+    """
+    Scaled dot-product attention followed by the output projection of 'attn'
+    q: (batch, n_head, q_len, head_dim) which is already scaled
+    k, v: (batch, n_head, k_len, head_dim)
+    key_padding_mask: (batch, k_len)
+    """
+    batch_size, n_head, q_len, head_dim = q.size()
+    attn_weights = torch.matmul(q, k.transpose(-2, -1)) # (batch, n_head, q_len, k_len)
+    if key_padding_mask is not None:
+        attn_weights = attn_weights.masked_fill(key_padding_mask.view(batch_size, 1, 1, -1), float('-inf'))
+    attn_weights = F.softmax(attn_weights, dim=-1)
+    attn_weights = F.dropout(attn_weights, p=attn.dropout, training=attn.training)
+    attn_out = torch.matmul(attn_weights, v) # (batch, n_head, q_len, head_dim)
+    attn_out = attn_out.permute(2, 0, 1, 3).reshape(q_len, batch_size, n_head * head_dim)
+    return attn.out_proj(attn_out) # (q_len, batch, d_model)
+
+def in_projection(attn, x, start, end):
+    """
+    Input projection of 'attn' restricted to rows [start, end) of its packed query, key, value weight
+    """
+    bias = attn.in_proj_bias[start:end] if attn.in_proj_bias is not None else None
+    return F.linear(x, attn.in_proj_weight[start:end], bias)
+
+def incremental_self_attention(attn, x, layer_cache, key_padding_mask=None):
+    """
+    Self-attention of the newest token over all decoded tokens with the same weights as 'attn'.
+    Keys and values of previous tokens are read from 'layer_cache' and the new ones are appended.
+    x: (1, batch, d_model)
+    layer_cache: dict with 'self_key', 'self_value' of (batch, n_head, seq_len, head_dim)
+    """
+    q, k, v = in_projection(attn, x, 0, 3 * attn.embed_dim).chunk(3, dim=-1)
+    q = split_heads(q, attn.num_heads) * (attn.head_dim ** -0.5)
+    k = split_heads(k, attn.num_heads)
+    v = split_heads(v, attn.num_heads)
+    if 'self_key' in layer_cache:
+        k = torch.cat((layer_cache['self_key'], k), dim=2)
+        v = torch.cat((layer_cache['self_value'], v), dim=2)
+    layer_cache['self_key'] = k
+    layer_cache['self_value'] = v
+    return attention_output(attn, q, k, v, key_padding_mask=key_padding_mask)
+
+def precompute_memory_attention(attn, memory, layer_cache):
+    """
+    Project encoder output to the keys and values of 'attn' once before decoding
+    memory: (src_seq, batch, d_model)
+    layer_cache: 'memory_key', 'memory_value' of (batch, n_head, src_seq, head_dim) are added
+    """
+    k, v = in_projection(attn, memory, attn.embed_dim, 3 * attn.embed_dim).chunk(2, dim=-1)
+    layer_cache['memory_key'] = split_heads(k, attn.num_heads)
+    layer_cache['memory_value'] = split_heads(v, attn.num_heads)
+
+def incremental_memory_attention(attn, x, layer_cache, key_padding_mask=None):
+    """
+    Encoder-decoder attention of every beam over one memory copy of its source sentence.
+    Beams of the same source are handled as query positions, so memory is broadcast instead of repeated.
+    x: (1, batch * k, d_model)
+    key_padding_mask: (batch, src_seq)
+    """
+    batch_size = layer_cache['memory_key'].size(0)
+    q = in_projection(attn, x, 0, attn.embed_dim) # (1, batch * k, d_model)
+    q = q.view(batch_size, -1, attn.embed_dim).transpose(0, 1) # (k, batch, d_model)
+    q = split_heads(q, attn.num_heads) * (attn.head_dim ** -0.5) # (batch, n_head, k, head_dim)
+    attn_out = attention_output(attn, q, layer_cache['memory_key'], layer_cache['memory_value'],
+                                key_padding_mask=key_padding_mask) # (k, batch, d_model)
+    return attn_out.transpose(0, 1).reshape(1, -1, attn.embed_dim) # (1, batch * k, d_model)
+
+def reorder_attention_cache(layer_cache, beam_index, sentence_index=None):
+    """
+    Self-attention cache follows the selected beams and memory cache follows the source sentences left
+    """
+    for key in ['self_key', 'self_value']:
+        layer_cache[key] = layer_cache[key].index_select(0, beam_index)
+    if sentence_index is not None:
+        for key in ['memory_key', 'memory_value']:
+            layer_cache[key] = layer_cache[key].index_select(0, sentence_index)
+
 class TransformerEncoderLayer(nn.Module):
     def __init__(self, d_model, self_attn, dim_feedforward=2048, dropout=0.1):
         super(TransformerEncoderLayer, self).__init__()
@@ -382,4 +681,26 @@ class TransformerDecoderLayer(nn.Module):
         tgt2 = self.linear2(self.dropout(F.gelu(self.linear1(tgt))))
         tgt = tgt + self.dropout3(tgt2)
         tgt = self.norm3(tgt)
+        return tgt
+
+    def precompute_memory(self, memory, layer_cache):
+        precompute_memory_attention(self.multihead_attn, memory, layer_cache)
+
+    def incremental_forward(self, tgt, layer_cache, tgt_key_padding_mask=None, memory_key_padding_mask=None):
+        """
+        Same computation as forward for the last token only. 'tgt' is (1, batch * k, d_model),
+        'tgt_key_padding_mask' covers every decoded token and 'layer_cache' keeps self-attention keys, values
+        and the memory keys, values from precompute_memory, which has one copy per source sentence.
+        """
+        tgt2 = incremental_self_attention(self.self_attn, tgt, layer_cache,
+                                          key_padding_mask=tgt_key_padding_mask)
+        tgt = tgt + self.dropout1(tgt2)
+        tgt = self.norm1(tgt)
+        tgt2 = incremental_memory_attention(self.multihead_attn, tgt, layer_cache,
+                                            key_padding_mask=memory_key_padding_mask)
+        tgt = tgt + self.dropout2(tgt2)
+        tgt = self.norm2(tgt)
+        tgt2 = self.linear2(self.dropout(F.gelu(self.linear1(tgt))))
+        tgt = tgt + self.dropout3(tgt2)
+        tgt = self.norm3(tgt)
         return tgt
\ No newline at end of file
@@ -1,10 +1,19 @@
+import numpy as np
 import torch
+from torch.utils.data import Sampler
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataloader import default_collate
 
 import albumentations as A
 from skimage import io
 
 class Seq2SeqDataset(Dataset):
+    """
+    Sequence-to-sequence dataset on the padded arrays from the preprocessed HDF5 file.
+    Arrays (or read-only memory maps) are kept as they are; filtered examples are skipped through 'keep_index'
+    and each example is a torch.from_numpy view of its rows.
+    'index' can also be an index list, and then the whole batch is made by one fancy-index per array.
+    """
     def __init__(self, src_list: list, src_att_list: list, src_img_path: list = None,
                  trg_list: list = None, trg_att_list: list = None,
                  src_max_len: int = 300, trg_max_len: int = 360,
@@ -12,82 +21,333 @@ class Seq2SeqDataset(Dataset):
                  image_transform: A.core.composition.Compose = None):
         # Stop index list
         stop_ix_list = [pad_idx, eos_idx]
-        self.tensor_list = []
-        for src, src_att, trg, trg_att in zip(src_list, src_att_list, trg_list, trg_att_list):
-            if src[src_max_len-1] in stop_ix_list and trg[trg_max_len-1] in stop_ix_list:
-                # Source tensor
-                src_tensor = torch.tensor(src[:src_max_len], dtype=torch.long)
-                src_att_tensor = torch.tensor(src_att[:src_max_len], dtype=torch.long)
-                # Target tensor
-                trg_tensor = torch.tensor(trg[:trg_max_len], dtype=torch.long)
-                trg_att_tensor = torch.tensor(trg_att[:trg_max_len], dtype=torch.long)
-                # tensor list
-                self.tensor_list.append((src_tensor, src_att_tensor, trg_tensor, trg_att_tensor))
-
-        self.num_data = len(self.tensor_list)
+        src_array = np.asarray(src_list)[:, :src_max_len]
+        src_att_array = np.asarray(src_att_list)[:, :src_max_len]
+        trg_array = np.asarray(trg_list)[:, :trg_max_len]
+        trg_att_array = np.asarray(trg_att_list)[:, :trg_max_len]
+
+        # Keep sentences which end in the maximum length
+        keep = np.isin(src_array[:, src_max_len-1], stop_ix_list) & np.isin(trg_array[:, trg_max_len-1], stop_ix_list)
+        self.keep_index = None if keep.all() else np.flatnonzero(keep)
+        self.src_array = src_array
+        self.src_att_array = src_att_array
+        self.trg_array = trg_array
+        self.trg_att_array = trg_att_array
+
+        # Length without padding
+        self.src_lengths = src_att_array.sum(axis=1)
+        self.trg_lengths = trg_att_array.sum(axis=1)
+        if self.keep_index is not None:
+            self.src_lengths = self.src_lengths[self.keep_index]
+            self.trg_lengths = self.trg_lengths[self.keep_index]
+
+        self.num_data = len(self.src_lengths)
 
     def __getitem__(self, index):
-        return self.tensor_list[index]
+        if self.keep_index is not None:
+            index = self.keep_index[index]
+        return (array_to_tensor(self.src_array[index]), array_to_tensor(self.src_att_array[index]),
+                array_to_tensor(self.trg_array[index]), array_to_tensor(self.trg_att_array[index]))
 
     def __len__(self):
         return self.num_data
 
 class Seq2LabelDataset(Dataset):
+    """
+    Classification dataset on the padded arrays from the preprocessed HDF5 file.
+    'index' can be an index list to make the whole batch at once.
+    """
     def __init__(self, src_list: list, src_att_list: list, src_img_path: list = None,
                  trg_list: list = None, trg_att_list: list = None,
                  min_len: int = 4, src_max_len: int = 300, trg_max_len: int = None,
                  pad_idx: int = 0, eos_idx: int = 2,
                  image_transform: A.core.composition.Compose = None):
-        self.tensor_list = []
-        for src, src_att, trg in zip(src_list, src_att_list, trg_list):
-            if min_len <= len(src) <= src_max_len:
-                # Source tensor
-                src_tensor = torch.zeros(src_max_len, dtype=torch.long)
-                src_tensor[:len(src)] = torch.tensor(src, dtype=torch.long)
-                src_att_tensor = torch.tensor(src_att, dtype=torch.long)
-                # Target tensor
-                trg_tensor = torch.tensor(trg, dtype=torch.long)
-                #
-                self.tensor_list.append((src_tensor, src_att_tensor, trg_tensor))
-
-        self.num_data = len(self.tensor_list)
+        self.src_array, self.src_att_array, keep_index = padded_source_array(src_list, src_att_list,
+                                                                             min_len, src_max_len)
+        self.trg_array = np.asarray(trg_list)[keep_index]
+
+        # Length without padding
+        self.src_lengths = self.src_att_array.sum(axis=1)
+
+        self.num_data = len(self.src_array)
 
     def __getitem__(self, index):
-        return self.tensor_list[index]
+        return (array_to_tensor(self.src_array[index]), array_to_tensor(self.src_att_array[index]),
+                torch.as_tensor(self.trg_array[index]).long())
 
     def __len__(self):
         return self.num_data
 
 class MutlimodalClassificationDataset(Dataset):
+    """
+    Classification dataset of text arrays and image paths. Images are loaded when they are indexed.
+    'index' can be an index list to make the whole batch at once.
+    """
     def __init__(self, src_list: list, src_att_list: list, src_img_path: list = None, 
                  trg_list: list = None, trg_att_list: list = None,
                  min_len: int = 4, src_max_len: int = 300, 
                  pad_idx: int = 0, eos_idx: int = 2,
                  image_transform: A.core.composition.Compose = None):
-        self.tensor_list = []
         self.image_transform = image_transform
         # For Inference
         if trg_list is None:
-            trg_list = [0 for _ in range(len(src_list))]
-        for src, src_att, img_path, trg in zip(src_list, src_att_list, src_img_path, trg_list):
-            if min_len <= len(src) <= src_max_len:
-                # Source text tensor
-                src_tensor = torch.zeros(src_max_len, dtype=torch.long)
-                src_tensor[:len(src)] = torch.tensor(src, dtype=torch.long)
-                src_att_tensor = torch.tensor(src_att, dtype=torch.long)
-                # Target tensor
-                trg_tensor = torch.tensor(trg, dtype=torch.long)
-                # tensor list
-                self.tensor_list.append((src_tensor, src_att_tensor, img_path, trg_tensor))
-
-        self.num_data = len(self.tensor_list)
+            trg_list = np.zeros(len(src_list), dtype=np.int64)
+        self.src_array, self.src_att_array, keep_index = padded_source_array(src_list, src_att_list,
+                                                                             min_len, src_max_len)
+        self.src_img_path = np.asarray(src_img_path)[keep_index]
+        self.trg_array = np.asarray(trg_list)[keep_index]
+
+        self.num_data = len(self.src_array)
+
+    def load_image(self, img_path):
+        image = io.imread(img_path.decode('utf-8'))
+        return self.image_transform(image=image)['image']
 
     def __getitem__(self, index):
-        src_tensor, src_att_tensor, img_path, trg_tensor = self.tensor_list[index]
+        src_tensor = array_to_tensor(self.src_array[index])
+        src_att_tensor = array_to_tensor(self.src_att_array[index])
+        trg_tensor = torch.as_tensor(self.trg_array[index]).long()
         # Image load
-        image = io.imread(img_path.decode('utf-8'))
-        transformed_image = self.image_transform(image=image)['image']
+        if np.ndim(index) == 0:
+            transformed_image = self.load_image(self.src_img_path[index])
+        else:
+            transformed_image = torch.stack([self.load_image(img_path) for img_path in self.src_img_path[index]])
         return src_tensor, src_att_tensor, transformed_image, trg_tensor
 
     def __len__(self):
-        return self.num_data
\ No newline at end of file
+        return self.num_data
+
+def padded_source_array(src_list, src_att_list, min_len: int = 4, src_max_len: int = 300):
+    """
+    Source arrays padded to 'src_max_len' and the kept row index.
+    Every row has the padded length of the preprocessed array, so rows are kept or dropped together
+    by 'min_len <= length <= src_max_len'.
+    """
+    src_array = np.asarray(src_list)
+    src_att_array = np.asarray(src_att_list)
+    if min_len <= src_array.shape[1] <= src_max_len:
+        keep_index = np.arange(len(src_array))
+    else:
+        keep_index = np.arange(0)
+        src_array, src_att_array = src_array[:0], src_att_array[:0]
+    if src_array.shape[1] < src_max_len:
+        pad_width = ((0, 0), (0, src_max_len - src_array.shape[1]))
+        src_array = np.pad(src_array, pad_width)
+        src_att_array = np.pad(src_att_array, pad_width)
+    return src_array, src_att_array, keep_index
+
+class PackedSeq2SeqDataset(Dataset):
+    """
+    Seq2SeqDataset of which several source / target pairs are concatenated into one row.
+    Examples are packed in (shuffled) order while both the sources and the targets fit in src_max_len and trg_max_len.
+    Each item is (src, src_att, trg, trg_att, src_segment, trg_segment) where segment is 1, 2, ... for each packed
+    example and 0 for padding. The packing is made once, so rows keep the same examples in every epoch.
+    """
+    def __init__(self, dataset: Seq2SeqDataset, src_max_len: int = 300, trg_max_len: int = 360,
+                 shuffle: bool = True):
+        self.dataset = dataset
+        self.src_max_len = src_max_len
+        self.trg_max_len = trg_max_len
+
+        if shuffle:
+            order = np.random.permutation(len(dataset))
+        else:
+            order = np.arange(len(dataset))
+
+        self.pack_list = []
+        self.src_lengths = []
+        self.trg_lengths = []
+        pack, src_len, trg_len = [], 0, 0
+        for ix in order:
+            if pack and (src_len + dataset.src_lengths[ix] > src_max_len or \
+                         trg_len + dataset.trg_lengths[ix] > trg_max_len):
+                self.pack_list.append(pack)
+                self.src_lengths.append(src_len)
+                self.trg_lengths.append(trg_len)
+                pack, src_len, trg_len = [], 0, 0
+            pack.append(int(ix))
+            src_len += dataset.src_lengths[ix]
+            trg_len += dataset.trg_lengths[ix]
+        if pack:
+            self.pack_list.append(pack)
+            self.src_lengths.append(src_len)
+            self.trg_lengths.append(trg_len)
+
+        self.num_data = len(self.pack_list)
+
+    def __getitem__(self, index):
+        src_tensor = torch.zeros(self.src_max_len, dtype=torch.long)
+        src_segment = torch.zeros(self.src_max_len, dtype=torch.long)
+        trg_tensor = torch.zeros(self.trg_max_len, dtype=torch.long)
+        trg_segment = torch.zeros(self.trg_max_len, dtype=torch.long)
+
+        src_start, trg_start = 0, 0
+        for segment, ix in enumerate(self.pack_list[index], 1):
+            src, _, trg, _ = self.dataset[ix]
+            src_len, trg_len = self.dataset.src_lengths[ix], self.dataset.trg_lengths[ix]
+            src_tensor[src_start:src_start + src_len] = src[:src_len]
+            src_segment[src_start:src_start + src_len] = segment
+            trg_tensor[trg_start:trg_start + trg_len] = trg[:trg_len]
+            trg_segment[trg_start:trg_start + trg_len] = segment
+            src_start += src_len
+            trg_start += trg_len
+
+        src_att_tensor = (src_segment > 0).long()
+        trg_att_tensor = (trg_segment > 0).long()
+        return src_tensor, src_att_tensor, trg_tensor, trg_att_tensor, src_segment, trg_segment
+
+    def __len__(self):
+        return self.num_data
+
+class TargetPosteriorDataset(Dataset):
+    """
+    Seq2SeqDataset of which each item also has the cached target posterior of the example,
+    (src, src_att, trg, trg_att, trg_posterior). The posterior array of (num_data, 2 or 1, d_latent) is replaced
+    by 'set_posterior' before every epoch; see Transformer.target_posterior.
+    'index' can be an index list as in Seq2SeqDataset.
+    """
+    def __init__(self, dataset: Seq2SeqDataset):
+        self.dataset = dataset
+        self.src_lengths = dataset.src_lengths
+        self.trg_lengths = dataset.trg_lengths
+        self.trg_posterior = None
+
+        self.num_data = len(dataset)
+
+    def set_posterior(self, trg_posterior):
+        self.trg_posterior = trg_posterior
+
+    def __getitem__(self, index):
+        trg_posterior = self.trg_posterior[index]
+        if not trg_posterior.flags.writeable:
+            trg_posterior = np.array(trg_posterior)
+        return (*self.dataset[index], torch.from_numpy(trg_posterior).float())
+
+    def __len__(self):
+        return self.num_data
+
+def array_to_tensor(array):
+    # Rows of a read-only memory map are copied since torch.from_numpy needs a writable array
+    if not array.flags.writeable:
+        array = np.array(array)
+    return torch.from_numpy(array).long()
+
+def trim_seq2seq_batch(batch):
+    """
+    Trim the padding columns which no example in a (src, src_att, trg, trg_att) batch uses.
+    Segment ids of packed examples (src_segment, trg_segment) are trimmed as well,
+    and the cached target posterior (trg_posterior) is passed as it is.
+    """
+    src, src_att, trg, trg_att, *extra = batch
+    src_len = int(src_att.sum(dim=1).max())
+    trg_len = int(trg_att.sum(dim=1).max())
+    if len(extra) == 2:
+        extra = [extra[0][:, :src_len], extra[1][:, :trg_len]]
+    return (src[:, :src_len], src_att[:, :src_len], trg[:, :trg_len], trg_att[:, :trg_len], *extra)
+
+def trim_seq2label_batch(batch):
+    """
+    Trim the padding columns which no example in a (src, src_att, trg_label) batch uses
+    """
+    src, src_att, trg = batch
+    src_len = int(src_att.sum(dim=1).max())
+    return src[:, :src_len], src_att[:, :src_len], trg
+
+def seq2seq_collate(batch):
+    return trim_seq2seq_batch(default_collate(batch))
+
+def seq2label_collate(batch):
+    return trim_seq2label_batch(default_collate(batch))
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar length.
+    Indices are (shuffled and) split into buckets of 'batch_size * bucket_size_multiplier' examples,
+    sorted by source and target length in each bucket and cut into batches. With shuffle, the order of the batches
+    is shuffled again, so only the examples in a bucket share batches.
+    If 'max_tokens' is given, a batch is cut when its padded source + target token count would exceed 'max_tokens'
+    instead of at 'batch_size' examples. The number of batches then changes from epoch to epoch, so the batches
+    of the coming epoch are sampled ahead and len() is the exact count of the epoch being iterated, or of the
+    coming epoch once the last one is finished. DataLoader workers finish the sampler a few batches early.
+    """
+    def __init__(self, src_lengths: list, trg_lengths: list = None, batch_size: int = 16,
+                 drop_last: bool = False, shuffle: bool = True, bucket_size_multiplier: int = 100,
+                 max_tokens: int = 0):
+        self.src_lengths = np.asarray(src_lengths)
+        self.trg_lengths = np.asarray(trg_lengths) if trg_lengths is not None else np.zeros_like(self.src_lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.max_tokens = max_tokens
+        # Token budget batches of the coming epoch and of the epoch being iterated
+        self.next_batch_list = None
+        self.epoch_batch_list = None
+
+    def _split_bucket(self, bucket):
+        if self.max_tokens <= 0:
+            return [bucket[start:start + self.batch_size] for start in range(0, len(bucket), self.batch_size)]
+
+        batch_list = []
+        start = 0
+        max_src_len, max_trg_len = 0, 0
+        for end, ix in enumerate(bucket):
+            new_src_len = max(max_src_len, self.src_lengths[ix])
+            new_trg_len = max(max_trg_len, self.trg_lengths[ix])
+            # An example longer than max_tokens is still made into a batch of its own
+            if end > start and (end - start + 1) * (new_src_len + new_trg_len) > self.max_tokens:
+                batch_list.append(bucket[start:end])
+                start = end
+                new_src_len, new_trg_len = self.src_lengths[ix], self.trg_lengths[ix]
+            max_src_len, max_trg_len = new_src_len, new_trg_len
+        if start < len(bucket):
+            batch_list.append(bucket[start:])
+        return batch_list
+
+    def _batch_list(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.src_lengths))
+        else:
+            indices = np.arange(len(self.src_lengths))
+
+        batch_list = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.lexsort((self.trg_lengths[bucket], self.src_lengths[bucket]))]
+            batch_list.extend(self._split_bucket(bucket))
+
+        # The last batch is the remainder of the last bucket
+        if self.drop_last and len(batch_list) > 1:
+            if self.max_tokens > 0 or len(batch_list[-1]) < self.batch_size:
+                batch_list = batch_list[:-1]
+        if self.shuffle:
+            batch_list = [batch_list[i] for i in np.random.permutation(len(batch_list))]
+        return batch_list
+
+    def _next_batch_list(self):
+        if self.next_batch_list is None:
+            self.next_batch_list = self._batch_list()
+        return self.next_batch_list
+
+    def __iter__(self):
+        if self.max_tokens <= 0:
+            for batch in self._batch_list():
+                yield batch.tolist()
+            return
+
+        self.epoch_batch_list = self._next_batch_list()
+        self.next_batch_list = None
+        try:
+            for batch in self.epoch_batch_list:
+                yield batch.tolist()
+        finally:
+            self.epoch_batch_list = None
+
+    def __len__(self):
+        if self.max_tokens > 0:
+            if self.epoch_batch_list is not None:
+                return len(self.epoch_batch_list)
+            return len(self._next_batch_list())
+        if self.drop_last:
+            return len(self.src_lengths) // self.batch_size
+        return (len(self.src_lengths) + self.batch_size - 1) // self.batch_size
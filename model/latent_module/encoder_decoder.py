@@ -1,56 +1,6 @@
 import torch
 import torch.nn as nn
-
-class full_cnn_latent_encoder(nn.Module):
-    def __init__(self, d_model, d_latent, token_length):
-
-        super(full_cnn_latent_encoder, self).__init__()
-        self.encoder = nn.Sequential(
-                    nn.Conv1d(in_channels=d_model, out_channels=d_model, kernel_size=3, stride=3), # (batch_size, d_model, 256)
-                    nn.GELU(),
-                    nn.Conv1d(in_channels=d_model, out_channels=512, kernel_size=3, stride=3), # (batch_size, d_model, 85)
-                    nn.GELU(),
-                    nn.Conv1d(in_channels=512, out_channels=256, kernel_size=3, stride=3), # (batch_size, d_model, 28)
-                    nn.GELU(),
-                    nn.Conv1d(in_channels=256, out_channels=256, kernel_size=3, stride=3), # (batch_size, d_model, 9)
-                    nn.GELU(),
-                    nn.Conv1d(in_channels=256, out_channels=d_latent, kernel_size=3, stride=3), # (batch_size, d_model, 3)
-                    nn.GELU(),
-                    nn.Conv1d(in_channels=d_latent, out_channels=d_latent, kernel_size=3, stride=3), # (batch_size, d_model, 1)
-                    nn.GELU()
-                )
-
-    def forward(self, src):
-        src = src.permute(1, 2, 0) # (batch, d_model, seq_len)
-        latent = self.encoder(src) # (batch, d_latent, 1)
-        latent = latent.squeeze(2)
-        
-        return latent
-
-class full_cnn_latent_decoder(nn.Module):
-    def __init__(self, d_model, d_latent, token_length):
-
-        super(full_cnn_latent_decoder, self).__init__()
-        self.decoder = nn.Sequential(
-            nn.ConvTranspose1d(in_channels=d_latent, out_channels=d_latent, kernel_size=3, stride=3),
-            nn.GELU(),
-            nn.ConvTranspose1d(in_channels=d_latent, out_channels=256, kernel_size=3, stride=3),
-            nn.GELU(),
-            nn.ConvTranspose1d(in_channels=256, out_channels=256, kernel_size=3, stride=3, output_padding=1),
-            nn.GELU(),
-            nn.ConvTranspose1d(in_channels=256, out_channels=512, kernel_size=3, stride=3, output_padding=1),
-            nn.GELU(),
-            nn.ConvTranspose1d(in_channels=512, out_channels=d_model, kernel_size=3, stride=3, output_padding=1),
-            nn.GELU(),
-            nn.ConvTranspose1d(in_channels=d_model, out_channels=d_model, kernel_size=3, stride=3),
-            nn.GELU(),
-        )
-
-    def forward(self, src):
-        latent = self.decoder(src) # [batch, d_model, seq_len]
-        latent = latent.permute(2, 0, 1) # [seq_len, batch, d_model]
-
-        return latent
+import torch.nn.functional as F
 
 class cnn_latent_encoder(nn.Module):
     def __init__(self, d_model, d_latent):
@@ -83,4 +33,80 @@ class cnn_latent_decoder(nn.Module):
         latent = self.decoder(src) # [batch, d_model, 1]
         latent = latent.permute(2, 0, 1) # [1, batch, d_model]
 
-        return latent
\ No newline at end of file
+        return latent
+
+class adaptive_cnn_latent_encoder(nn.Module):
+    """
+    CNN latent encoder for any sequence length.
+    Every layer halves the sequence length, and the outputs past the halved length of each sentence
+    are zeroed and left out of the last max pooling, so padding does not change the latent variable.
+    """
+    def __init__(self, d_model, d_latent, num_layers=3):
+        super(adaptive_cnn_latent_encoder, self).__init__()
+
+        channels = [d_model] * num_layers + [d_latent]
+        self.encoder = nn.ModuleList([
+            nn.Conv1d(in_channels=channels[i], out_channels=channels[i + 1], kernel_size=3, stride=2, padding=1) \
+                for i in range(num_layers)])
+
+    def forward(self, src, src_key_padding_mask=None):
+        latent = src.permute(1, 2, 0) # [batch, d_model, seq_len]
+        lengths = sequence_lengths(src_key_padding_mask, latent.size(0), latent.size(2), latent.device) # [batch]
+
+        for conv in self.encoder:
+            valid = length_mask(lengths, latent.size(2)).to(latent.dtype) # [batch, 1, seq_len]
+            latent = F.gelu(conv(latent * valid)) # [batch, channel, ceil(seq_len / 2)]
+            # Same output length as the convolution of the sentence alone
+            lengths = (lengths + 1) // 2
+
+        latent = latent.masked_fill(~length_mask(lengths, latent.size(2)), float('-inf'))
+        latent, _ = torch.max(latent, dim=2) # [batch, d_latent]
+
+        return latent
+
+class adaptive_cnn_latent_decoder(nn.Module):
+    """
+    CNN latent decoder to any sequence length.
+    The latent variable is upsampled by transposed convolutions and linearly interpolated to the length
+    of each sentence; padding positions are zero.
+    """
+    def __init__(self, d_model, d_latent, num_layers=3):
+        super(adaptive_cnn_latent_decoder, self).__init__()
+
+        channels = [d_latent] + [d_model] * num_layers
+        self.decoder = nn.ModuleList([
+            nn.ConvTranspose1d(in_channels=channels[i], out_channels=channels[i + 1], kernel_size=2, stride=2) \
+                for i in range(num_layers)])
+
+    def forward(self, src, seq_len, src_key_padding_mask=None):
+        latent = src.unsqueeze(2) # [batch, d_latent, 1]
+        for conv in self.decoder:
+            latent = F.gelu(conv(latent)) # [batch, d_model, 2 ** layer]
+        lengths = sequence_lengths(src_key_padding_mask, latent.size(0), seq_len, latent.device) # [batch]
+
+        # Linear interpolation of F.interpolate(align_corners=False) to the length of each sentence
+        in_len = latent.size(2)
+        position = torch.arange(seq_len, device=latent.device, dtype=latent.dtype).unsqueeze(0) # [1, seq_len]
+        scale = in_len / lengths.clamp(min=1).to(latent.dtype).unsqueeze(1) # [batch, 1]
+        coordinate = ((position + 0.5) * scale - 0.5).clamp(min=0) # [batch, seq_len]
+        index0 = coordinate.floor().long().clamp(max=in_len - 1)
+        index1 = (index0 + 1).clamp(max=in_len - 1)
+        weight = (coordinate - index0.to(latent.dtype)).unsqueeze(1) # [batch, 1, seq_len]
+        index0 = index0.unsqueeze(1).expand(-1, latent.size(1), -1) # [batch, d_model, seq_len]
+        index1 = index1.unsqueeze(1).expand(-1, latent.size(1), -1)
+        latent = latent.gather(2, index0) * (1 - weight) + latent.gather(2, index1) * weight
+
+        latent = latent * length_mask(lengths, seq_len).to(latent.dtype) # [batch, d_model, seq_len]
+        latent = latent.permute(2, 0, 1) # [seq_len, batch, d_model]
+
+        return latent
+
+def sequence_lengths(key_padding_mask, batch_size, seq_len, device):
+    # Number of tokens of each right-padded sentence from (batch, seq_len) mask, True for padding
+    if key_padding_mask is None:
+        return torch.full((batch_size,), seq_len, dtype=torch.long, device=device)
+    return (~key_padding_mask).sum(dim=1)
+
+def length_mask(lengths, seq_len):
+    # (batch, 1, seq_len) True for the first 'lengths' positions
+    return (torch.arange(seq_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1)
@@ -1,16 +1,18 @@
+import math
 # Import PyTorch
 import torch
 from torch import nn
 from torch.autograd import Variable
 # Import custom modules
-from .encoder_decoder import full_cnn_latent_encoder, full_cnn_latent_decoder, cnn_latent_encoder, cnn_latent_decoder
+from .encoder_decoder import adaptive_cnn_latent_encoder, adaptive_cnn_latent_decoder
 from .loss import GaussianKLLoss, MaximumMeanDiscrepancyLoss
+from .utils import masked_mean, segment_index, segment_mean, segment_to_token
 
 class Latent_module(nn.Module):
     def __init__(self, d_model: int = 512, d_latent: int = 256, variational_model: str = 'vae', 
                  variational_token_processing: str = 'average', variational_with_target: bool = False,
                  cnn_encoder: bool = False, cnn_decoder: bool = False, latent_add_encoder_out: bool = True, 
-                 z_var: int = 2, src_max_len: int = 300, trg_max_len: int = 300):
+                 z_var: int = 2, src_max_len: int = 300, trg_max_len: int = 300, mmd_block_size: int = 0):
 
         super(Latent_module, self).__init__()
 
@@ -41,19 +43,41 @@ class Latent_module(nn.Module):
             self.context_to_latent = nn.Linear(d_model, d_latent)
             self.latent_to_context = nn.Linear(d_latent, d_model)
 
-            self.mmd_criterion = MaximumMeanDiscrepancyLoss()
+            self.mmd_criterion = MaximumMeanDiscrepancyLoss(block_size=mmd_block_size)
 
         # CNN Encoder & Decoder
         if self.cnn_encoder:
-            self.latent_encoder = full_cnn_latent_encoder(d_model, d_latent)
+            self.latent_encoder = adaptive_cnn_latent_encoder(d_model, d_latent)
             if self.variational_model == 'vae':
                 self.latent_to_mu = nn.Linear(d_latent, d_latent)
                 self.latent_to_logvar = nn.Linear(d_latent, d_latent)
         if self.cnn_decoder:
-            self.latent_decoder = full_cnn_latent_decoder(d_model, d_latent)
+            self.latent_decoder = adaptive_cnn_latent_decoder(d_model, d_latent)
         # cnn 일반버젼 코딩도 진행해야함
 
-    def forward(self, encoder_out_src, encoder_out_trg):
+    def forward(self, encoder_out_src, encoder_out_trg, src_segment_ids=None, trg_segment_ids=None,
+                src_key_padding_mask=None, trg_key_padding_mask=None, trg_posterior=None):
+        """
+        src_segment_ids, trg_segment_ids: (batch, seq_len) packed example of each token (0 for padding);
+        the latent variable of each packed example is made from its own tokens only
+        src_key_padding_mask, trg_key_padding_mask: (batch, seq_len) True for padding; left out of the token average
+        and the CNN encoder pooling
+        trg_posterior: (batch, 2 or 1, d_latent) cached output of 'target_posterior' used instead of encoder_out_trg
+        """
+        packed = src_segment_ids is not None
+        encode_trg = self.variational_with_target and trg_posterior is None
+        if packed:
+            if self.cnn_encoder or self.cnn_decoder or self.variational_token_processing != 'average':
+                raise Exception('Packed examples are only available with average token processing')
+            src_index, n_segment = segment_index(src_segment_ids)
+            if self.variational_with_target:
+                trg_index, _ = segment_index(trg_segment_ids)
+        if self.variational_token_processing == 'view' and not self.cnn_encoder and encode_trg \
+            and encoder_out_src.size(0) != encoder_out_trg.size(0):
+            # Source and target latent variables of 'view' are [batch, seq_len * d_latent]
+            raise Exception(f'View token processing with target needs source and target of the same length, '
+                            f'got {encoder_out_src.size(0)} and {encoder_out_trg.size(0)}; '
+                            f'use the same src_max_len and trg_max_len without dynamic padding or max_tokens')
 
     #===================================#
     #================VAE================#
@@ -72,28 +96,14 @@ class Latent_module(nn.Module):
             if self.cnn_encoder:
 
                 # Source encoding
-                if self.src_max_len == 100:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 300:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 768:
-                    src_latent = self.latent_encoder(encoder_out_src) # [batch, d_latent]
-                else:
-                    raise Exception('Sorry, Now only 100, 300, 768 length is available')
+                src_latent = self.latent_encoder(encoder_out_src, src_key_padding_mask) # [batch, d_latent]
 
                 src_mu = self.latent_to_mu(src_latent)
                 src_logvar = self.latent_to_logvar(src_latent)
 
                 # Target encoding
-                if self.variational_with_target:
-                    if self.trg_max_len == 100:
-                        trg_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_trg) # [batch, d_latent]
-                    elif self.trg_max_len == 300:
-                        trg_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_trg) # [batch, d_latent]
-                    elif self.trg_max_len == 768:
-                        trg_latent = self.latent_encoder(encoder_out_trg) # [batch, d_latent]
-                    else:
-                        raise Exception('Sorry, Now only 100, 300, 768 length is available')
+                if encode_trg:
+                    trg_latent = self.latent_encoder(encoder_out_trg, trg_key_padding_mask) # [batch, d_latent]
 
                     trg_mu = self.latent_to_mu(trg_latent)
                     trg_logvar = self.latent_to_logvar(trg_latent)
@@ -103,28 +113,40 @@ class Latent_module(nn.Module):
                 src_mu = self.context_to_mu(encoder_out_src) # [seq_len, batch, d_latent]
                 src_logvar = self.context_to_logvar(encoder_out_src) # [seq_len, batch, d_latent]
 
-                if self.variational_with_target:
+                if encode_trg:
                     trg_mu = self.context_to_mu(encoder_out_trg) # [seq_len, batch, d_latent]
                     trg_logvar = self.context_to_logvar(encoder_out_trg) # [seq_len, batch, d_latent]
 
                 # 2. Sequence token processing
-                if self.variational_token_processing == 'average':
-                    src_mu = src_mu.mean(dim=0) # [batch, d_latent]
-                    src_logvar = src_logvar.mean(dim=0) # [batch, d_latent]
+                if self.variational_token_processing == 'average' and packed:
+                    src_mu = segment_mean(src_mu, src_index, n_segment) # [n_segment, d_latent]
+                    src_logvar = segment_mean(src_logvar, src_index, n_segment) # [n_segment, d_latent]
 
-                    if self.variational_with_target:
-                        trg_mu = trg_mu.mean(dim=0) # [batch, d_latent]
-                        trg_logvar = trg_logvar.mean(dim=0) # [batch, d_latent]
+                    if encode_trg:
+                        trg_mu = segment_mean(trg_mu, trg_index, n_segment) # [n_segment, d_latent]
+                        trg_logvar = segment_mean(trg_logvar, trg_index, n_segment) # [n_segment, d_latent]
+
+                elif self.variational_token_processing == 'average':
+                    src_mu = masked_mean(src_mu, src_key_padding_mask) # [batch, d_latent]
+                    src_logvar = masked_mean(src_logvar, src_key_padding_mask) # [batch, d_latent]
+
+                    if encode_trg:
+                        trg_mu = masked_mean(trg_mu, trg_key_padding_mask) # [batch, d_latent]
+                        trg_logvar = masked_mean(trg_logvar, trg_key_padding_mask) # [batch, d_latent]
 
                 if self.variational_token_processing == 'view':
                     batch_size = encoder_out_src.size(1)
                     src_mu = src_mu.view(batch_size, -1) # [batch, seq_len * d_latent]
                     src_logvar = src_logvar.view(batch_size, -1) # [batch, seq_len * d_latent]
 
-                    if self.variational_with_target:
+                    if encode_trg:
                         trg_mu = trg_mu.view(batch_size, -1) # [batch, seq_len * d_latent]
                         trg_logvar = trg_logvar.view(batch_size, -1) # [batch, seq_len * d_latent]
 
+            # Cached target posterior instead of the target encoder output
+            if trg_posterior is not None:
+                trg_mu, trg_logvar = trg_posterior[:, 0], trg_posterior[:, 1] # [batch, d_latent]
+
             # 3. Calculate Gaussian KL-Divergence
             if self.variational_with_target:
                 numerator = src_logvar.exp() + torch.pow(src_mu - trg_mu, 2)
@@ -141,14 +163,21 @@ class Latent_module(nn.Module):
 
             # 5-1. Decoding by cnn
             if self.cnn_decoder:
-                resize_z = self.latent_decoder(z) # [batch, seq_len, d_model]
+                resize_z = self.latent_decoder(z, encoder_out_src.size(0), src_key_padding_mask) # [seq_len, batch, d_model]
             # 5-2. Decoding by 'z_to_context'
+            elif packed:
+                resize_z = self.z_to_context(z) # [n_segment, d_model]
+                resize_z = segment_to_token(resize_z, src_index) # [seq_len, batch, d_model]
+            elif self.variational_token_processing == 'view' and not self.cnn_encoder:
+                resize_z = z.view(z.size(0), encoder_out_src.size(0), -1) # [batch, seq_len, d_latent]
+                resize_z = self.z_to_context(resize_z).transpose(0, 1) # [seq_len, batch, d_model]
             else:
                 resize_z = self.z_to_context(z) # [batch, d_model]
-                resize_z = resize_z.unsqueeze(1).repeat(1, self.src_max_len, 1)
+                if resize_z.dim() == 2:
+                    # One latent slot per sentence; broadcast over the encoder output length when added
+                    resize_z = resize_z.unsqueeze(0) # [1, batch, d_model]
 
             # 6. Add latent variable or use only latent variable
-            resize_z = resize_z.transpose(0, 1) # [seq_len, batch, d_model]
             if self.latent_add_encoder_out:
                 encoder_out_total = torch.add(encoder_out_src, resize_z)
             else:
@@ -171,45 +200,40 @@ class Latent_module(nn.Module):
             if self.cnn_encoder:
 
                 # Source encoding
-                if self.src_max_len == 100:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 300:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 768:
-                    src_latent = self.latent_encoder(encoder_out_src) # [batch, d_latent]
-                else:
-                    raise Exception('Sorry, Now only 100, 300, 768 length is available')
+                src_latent = self.latent_encoder(encoder_out_src, src_key_padding_mask) # [batch, d_latent]
 
                 # Target encoding
-                if self.variational_with_target:
-                    if self.src_max_len == 100:
-                        trg_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_src) # [batch, d_latent]
-                    elif self.src_max_len == 300:
-                        trg_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_src) # [batch, d_latent]
-                    elif self.src_max_len == 768:
-                        trg_latent = self.latent_encoder(encoder_out_trg) # [batch, d_latent]
-                    else:
-                        raise Exception('Sorry, Now only 100, 300, 768 length is available')
+                if encode_trg:
+                    trg_latent = self.latent_encoder(encoder_out_trg, trg_key_padding_mask) # [batch, d_latent]
 
             # 1-2. Model dimension to latent dimenseion
             else:
                 src_latent = self.context_to_latent(encoder_out_src) # [seq_len, batch, d_latent]
 
-                if self.variational_with_target:
+                if encode_trg:
                     trg_latent = self.context_to_latent(encoder_out_trg) # [seq_len, batch, d_latent]
 
             # 2. Sequence token processing
-            if self.variational_token_processing == 'average':
-                src_latent = src_latent.mean(dim=0) # [batch, d_latent]
-                if self.variational_with_target:
-                    trg_latent = trg_latent.mean(dim=0) # [batch, d_latent]
+            if self.variational_token_processing == 'average' and packed:
+                src_latent = segment_mean(src_latent, src_index, n_segment) # [n_segment, d_latent]
+                if encode_trg:
+                    trg_latent = segment_mean(trg_latent, trg_index, n_segment) # [n_segment, d_latent]
+
+            elif self.variational_token_processing == 'average':
+                src_latent = masked_mean(src_latent, src_key_padding_mask) # [batch, d_latent]
+                if encode_trg:
+                    trg_latent = masked_mean(trg_latent, trg_key_padding_mask) # [batch, d_latent]
 
             if self.variational_token_processing == 'view':
                 batch_size = encoder_out_src.size(1)
                 src_latent = src_latent.view(batch_size, -1) # [batch, seq_len * d_latent]
-                if self.variational_with_target:
+                if encode_trg:
                     trg_latent = trg_latent.view(batch_size, -1) # [batch, seq_len * d_latent]
 
+            # Cached target latent variable instead of the target encoder output
+            if trg_posterior is not None:
+                trg_latent = trg_posterior[:, 0] # [batch, d_latent]
+
             # 3. Calculate Maximum-mean discrepancy
             if self.variational_with_target:
                 dist_loss = self.mmd_criterion(src_latent, trg_latent, self.z_var)
@@ -219,10 +243,19 @@ class Latent_module(nn.Module):
 
             # 4-1. Decoding by cnn
             if self.cnn_decoder:
-                src_latent = self.latent_decoder(src_latent) # [batch, seq_len, d_model]
+                src_latent = self.latent_decoder(src_latent, encoder_out_src.size(0), src_key_padding_mask) # [seq_len, batch, d_model]
             # 4-2. Decoding by 'z_to_context'
+            elif packed:
+                src_latent = self.latent_to_context(src_latent) # [n_segment, d_model]
+                src_latent = segment_to_token(src_latent, src_index) # [seq_len, batch, d_model]
+            elif self.variational_token_processing == 'view' and not self.cnn_encoder:
+                src_latent = src_latent.view(src_latent.size(0), encoder_out_src.size(0), -1) # [batch, seq_len, d_latent]
+                src_latent = self.latent_to_context(src_latent).transpose(0, 1) # [seq_len, batch, d_model]
             else:
-                src_latent = self.latent_to_context(src_latent)
+                src_latent = self.latent_to_context(src_latent) # [batch, d_model]
+                if src_latent.dim() == 2:
+                    # One latent slot per sentence; broadcast over the encoder output length when added
+                    src_latent = src_latent.unsqueeze(0) # [1, batch, d_model]
 
             # 5. Add latent variable or use only latent variable
             if self.latent_add_encoder_out:
@@ -232,54 +265,118 @@ class Latent_module(nn.Module):
 
         return encoder_out_total, dist_loss * 100 # Loss Lambda Refactoring 필수
 
-    def generate(self, encoder_out_src):
+    def target_posterior(self, encoder_out_trg, trg_key_padding_mask=None):
+        """
+        Target posterior of each sentence to be cached for 'forward'; [batch, 2, d_latent] VAE mean and
+        log-variance or [batch, 1, d_latent] WAE latent variable. Only a single latent variable per sentence
+        (average token processing or CNN encoder) can be cached.
+        """
+        if self.cnn_encoder:
+            trg_latent = self.latent_encoder(encoder_out_trg, trg_key_padding_mask) # [batch, d_latent]
+            if self.variational_model == 'vae':
+                return torch.stack((self.latent_to_mu(trg_latent), self.latent_to_logvar(trg_latent)), dim=1)
+            return trg_latent.unsqueeze(1)
+
+        if self.variational_token_processing != 'average':
+            raise Exception('Target posterior cache is only available with average token processing or CNN encoder')
+        if self.variational_model == 'vae':
+            trg_mu = masked_mean(self.context_to_mu(encoder_out_trg), trg_key_padding_mask) # [batch, d_latent]
+            trg_logvar = masked_mean(self.context_to_logvar(encoder_out_trg), trg_key_padding_mask) # [batch, d_latent]
+            return torch.stack((trg_mu, trg_logvar), dim=1)
+        trg_latent = masked_mean(self.context_to_latent(encoder_out_trg), trg_key_padding_mask) # [batch, d_latent]
+        return trg_latent.unsqueeze(1)
+
+    def layerwise_forward(self, encoder_out_src_list, encoder_out_trg_list, src_segment_ids=None, trg_segment_ids=None,
+                          src_key_padding_mask=None, trg_key_padding_mask=None):
+        """
+        Latent mapping of the output of every encoder layer; the distance loss is the sum over layers.
+        VAE layer outputs are stacked on the batch dimension and mapped in one call.
+        WAE and packed examples are mapped layer by layer since the MMD kernel and segment index span the whole batch.
+        """
+        num_layers = len(encoder_out_src_list)
+        if self.variational_model != 'vae' or src_segment_ids is not None:
+            encoder_out_list, dist_loss = list(), 0
+            for encoder_out_src, encoder_out_trg in zip(encoder_out_src_list, encoder_out_trg_list):
+                encoder_out, dist_loss_ = self(encoder_out_src, encoder_out_trg, src_segment_ids, trg_segment_ids,
+                                               src_key_padding_mask, trg_key_padding_mask)
+                encoder_out_list.append(encoder_out)
+                dist_loss = dist_loss + dist_loss_
+            return encoder_out_list, dist_loss
+
+        batch_size = encoder_out_src_list[0].size(1)
+        encoder_out_src = torch.cat(encoder_out_src_list, dim=1) # [seq_len, num_layers * batch, d_model]
+        encoder_out_trg = None
+        if self.variational_with_target:
+            encoder_out_trg = torch.cat(encoder_out_trg_list, dim=1) # [seq_len, num_layers * batch, d_model]
+        if src_key_padding_mask is not None:
+            src_key_padding_mask = src_key_padding_mask.repeat(num_layers, 1) # [num_layers * batch, seq_len]
+        if trg_key_padding_mask is not None:
+            trg_key_padding_mask = trg_key_padding_mask.repeat(num_layers, 1) # [num_layers * batch, seq_len]
+
+        encoder_out, dist_loss = self(encoder_out_src, encoder_out_trg,
+                                      src_key_padding_mask=src_key_padding_mask,
+                                      trg_key_padding_mask=trg_key_padding_mask)
+        if self.variational_with_target:
+            # Batch mean over the stacked layers to sum over layers
+            dist_loss = dist_loss * num_layers
+
+        return list(encoder_out.split(batch_size, dim=1)), dist_loss
+
+    def generate(self, encoder_out_src, src_key_padding_mask=None, sampling: bool = False, generator=None,
+                 src_latent=None, return_latent: bool = False):
+        """
+        Inference latent mapping, called once per source sentence before beam expansion.
+        The VAE uses the posterior mean, or with 'sampling' a sample drawn with 'generator' (torch.Generator)
+        so a seeded generator gives the same latent variables in every run.
+        A latent variable returned by 'return_latent' can be given as 'src_latent' to skip the latent encoding.
+        """
 
     #===================================#
     #================VAE================#
     #===================================#
 
         if self.variational_model == 'vae':
-            # 1-1. Model dimension to latent dimenseion with CNN encoder
-            if self.cnn_encoder:
-
-                # Source encoding
-                if self.src_max_len == 100:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 300:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 768:
-                    src_latent = self.latent_encoder(encoder_out_src) # [batch, d_latent]
+            if src_latent is None:
+                # 1-1. Model dimension to latent dimenseion with CNN encoder
+                if self.cnn_encoder:
+                    cnn_latent = self.latent_encoder(encoder_out_src, src_key_padding_mask) # [batch, d_latent]
+                    src_mu = self.latent_to_mu(cnn_latent)
+                    src_logvar = self.latent_to_logvar(cnn_latent)
+
+                # 1-2. Model dimension to latent dimenseion with 'context_to_mu'
                 else:
-                    raise Exception('Sorry, Now only 100, 300, 768 length is available')
+                    src_mu = self.context_to_mu(encoder_out_src) # [seq_len, batch, d_latent]
+                    src_logvar = self.context_to_logvar(encoder_out_src) # [seq_len, batch, d_latent]
 
-                src_mu = self.latent_to_mu(src_latent)
+                    # 2. Sequence token processing
+                    if self.variational_token_processing == 'average':
+                        src_mu = masked_mean(src_mu, src_key_padding_mask) # [batch, d_latent]
+                        src_logvar = masked_mean(src_logvar, src_key_padding_mask) # [batch, d_latent]
 
-            # 1-2. Model dimension to latent dimenseion with 'context_to_mu'
-            else:
-                src_mu = self.context_to_mu(encoder_out_src) # [token, batch, d_latent]
+                    if self.variational_token_processing == 'view':
+                        batch_size = encoder_out_src.size(1)
+                        src_mu = src_mu.view(batch_size, -1) # [batch, seq_len * d_latent]
+                        src_logvar = src_logvar.view(batch_size, -1) # [batch, seq_len * d_latent]
 
-                # 2. Sequence token processing
-                if self.variational_token_processing == 'average':
-                    src_mu = src_mu.mean(dim=0) # [batch, d_latent]
+                # 3. Posterior mean or seeded sample
+                src_latent = src_mu
+                if sampling:
+                    eps = torch.randn(src_mu.size(), generator=generator, dtype=src_mu.dtype, device=src_mu.device)
+                    src_latent = eps.mul(src_logvar.mul(0.5).exp()).add(src_mu) # [batch, d_latent]
 
-                if self.variational_token_processing == 'view':
-                    batch_size = encoder_out_src.size(1)
-                    src_mu = src_mu.view(batch_size, -1) # [batch, seq_len * d_latent]
-
-            # 3. Re-parameterization
-            std = src_logvar.mul(0.5).exp_()
-            eps = Variable(std.data.new(std.size()).normal_())
-            z = eps.mul(std).add_(src_mu) # [batch, d_latent]
-
-            # 5-1. Decoding by cnn
+            # 4-1. Decoding by cnn
             if self.cnn_decoder:
-                resize_z = self.latent_decoder(z) # [batch, seq_len, d_model]
-            # 5-2. Decoding by 'z_to_context'
+                resize_z = self.latent_decoder(src_latent, encoder_out_src.size(0), src_key_padding_mask) # [seq_len, batch, d_model]
+            # 4-2. Decoding by 'z_to_context'
+            elif self.variational_token_processing == 'view' and not self.cnn_encoder:
+                resize_z = src_latent.view(src_latent.size(0), encoder_out_src.size(0), -1) # [batch, seq_len, d_latent]
+                resize_z = self.z_to_context(resize_z).transpose(0, 1) # [seq_len, batch, d_model]
             else:
-                resize_z = self.z_to_context(z) # [batch, d_model]
-                resize_z = resize_z.unsqueeze(1).repeat(1, src_max_len, 1)
+                resize_z = self.z_to_context(src_latent) # [batch, d_model]
+                if resize_z.dim() == 2:
+                    resize_z = resize_z.unsqueeze(0) # [1, batch, d_model]
 
-            # 6. Add latent variable or use only latent variable
+            # 5. Add latent variable or use only latent variable
             if self.latent_add_encoder_out:
                 encoder_out_total = torch.add(encoder_out_src, resize_z)
             else:
@@ -290,36 +387,44 @@ class Latent_module(nn.Module):
     #===================================#
 
         if self.variational_model == 'wae':
+            if src_latent is None:
+                # 1-1. Model dimension to latent dimenseion with CNN encoder
+                if self.cnn_encoder:
+                    src_latent = self.latent_encoder(encoder_out_src, src_key_padding_mask) # [batch, d_latent]
 
-            # 1-1. Model dimension to latent dimenseion with CNN encoder
-            if self.cnn_encoder:
-
-                # Source encoding
-                if self.src_max_len == 100:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:-2](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 300:
-                    src_latent = nn.Sequential(*list(self.latent_encoder.children()))[2:](encoder_out_src) # [batch, d_latent]
-                elif self.src_max_len == 768:
-                    src_latent = self.latent_encoder(encoder_out_src) # [batch, d_latent]
+                # 1-2. Model dimension to latent dimenseion
                 else:
-                    raise Exception('Sorry, Now only 100, 300, 768 length is available')
-            
-            else:
-                # Source sentence latent mapping
-                src_latent = self.context_to_latent(encoder_out_src) # [seq_len, batch, d_latent]
+                    src_latent = self.context_to_latent(encoder_out_src) # [seq_len, batch, d_latent]
+
+                    # 2. Sequence token processing
+                    if self.variational_token_processing == 'average':
+                        src_latent = masked_mean(src_latent, src_key_padding_mask) # [batch, d_latent]
+
+                    if self.variational_token_processing == 'view':
+                        batch_size = encoder_out_src.size(1)
+                        src_latent = src_latent.view(batch_size, -1) # [batch, seq_len * d_latent]
 
-            # 2-1. Decoding by cnn
+            # 3-1. Decoding by cnn
             if self.cnn_decoder:
-                src_latent = self.latent_decoder(src_latent) # [seq_len, batch, d_model]
-            # 2-2. Decoding by 'z_to_context'
+                context = self.latent_decoder(src_latent, encoder_out_src.size(0), src_key_padding_mask) # [seq_len, batch, d_model]
+            # 3-2. Decoding by 'latent_to_context'
+            elif self.variational_token_processing == 'view' and not self.cnn_encoder:
+                context = src_latent.view(src_latent.size(0), encoder_out_src.size(0), -1) # [batch, seq_len, d_latent]
+                context = self.latent_to_context(context).transpose(0, 1) # [seq_len, batch, d_model]
             else:
-                src_latent = self.latent_to_context(src_latent) # [seq_len, batch, d_model]
+                context = self.latent_to_context(src_latent) # [batch, d_model]
+                if context.dim() == 2:
+                    context = context.unsqueeze(0) # [1, batch, d_model]
 
-            # 3. Add latent variable or use only latent variable
+            # 4. Add latent variable or use only latent variable
             if self.latent_add_encoder_out:
-                encoder_out_total = torch.add(encoder_out_src, src_latent)
+                encoder_out_total = torch.add(encoder_out_src, context)
             else:
-                encoder_out_total = src_latent
+                encoder_out_total = context
+
+        if return_latent:
+            return encoder_out_total, src_latent
+        return encoder_out_total
 
     # #===================================#
     # #==============CNN+VAE==============#
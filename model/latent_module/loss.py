@@ -12,14 +12,18 @@ class GaussianKLLoss(nn.Module):
         kl = 0.5 * torch.sum(logvar2 - logvar1 + fraction - 1, dim=0)
         return kl.mean()
 
-def im_kernel_sum(z1, z2, z_var, exclude_diag=True):
+def im_kernel_sum(z1, z2, z_var, exclude_diag=True, z1_sq=None, z2_sq=None, block_size=0):
     r"""Calculate sum of sample-wise measures of inverse multiquadratics kernel described in the WAE paper.
+    Pairwise squared distances come from the Gram matrix, |z1|^2 + |z2|^2 - 2 * z1 @ z2^T,
+    so no (n, n, dimension) tensor is made.
     Args:
         z1 (Tensor): batch of samples from a multivariate gaussian distribution \
             with scalar variance of z_var.
         z2 (Tensor): batch of samples from another multivariate gaussian distribution \
             with scalar variance of z_var.
         exclude_diag (bool): whether to exclude diagonal kernel measures before sum it all.
+        z1_sq, z2_sq (Tensor): squared norm of each sample; computed if not given.
+        block_size (int): number of z1 rows of the kernel matrix made at a time; 0 makes the whole (n, n) matrix.
     """
     assert z1.size() == z2.size()
     assert z1.ndimension() == 2
@@ -27,20 +31,29 @@ def im_kernel_sum(z1, z2, z_var, exclude_diag=True):
     z_dim = z1.size(1)
     C = 2*z_dim*z_var
 
-    z11 = z1.unsqueeze(1).repeat(1, z2.size(0), 1)
-    z22 = z2.unsqueeze(0).repeat(z1.size(0), 1, 1)
-
-    kernel_matrix = C/(1e-9+C+(z11-z22).pow(2).sum(2))
-    kernel_sum = kernel_matrix.sum()
-    # numerically identical to the formulation. but..
-    if exclude_diag:
-        kernel_sum -= kernel_matrix.diag().sum()
+    if z1_sq is None:
+        z1_sq = z1.pow(2).sum(1)
+    if z2_sq is None:
+        z2_sq = z2.pow(2).sum(1)
+    if block_size <= 0:
+        block_size = z1.size(0)
+
+    kernel_sum = 0
+    for start in range(0, z1.size(0), block_size):
+        z1_block = z1[start:start+block_size]
+        dist = z1_sq[start:start+block_size].unsqueeze(1) + z2_sq.unsqueeze(0) - 2 * z1_block.mm(z2.t()) # (block, n)
+        kernel_matrix = C/(1e-9+C+dist.clamp(min=0))
+        kernel_sum = kernel_sum + kernel_matrix.sum()
+        # numerically identical to the formulation. but..
+        if exclude_diag:
+            kernel_sum = kernel_sum - kernel_matrix.diagonal(offset=start).sum()
 
     return kernel_sum
 
 class MaximumMeanDiscrepancyLoss(nn.Module):
-    def __init__(self):
+    def __init__(self, block_size: int = 0):
         super(MaximumMeanDiscrepancyLoss, self).__init__()
+        self.block_size = block_size
 
     def forward(self, z_tilde, z, z_var):
         r"""Calculate maximum mean discrepancy described in the WAE paper.
@@ -57,9 +70,12 @@ class MaximumMeanDiscrepancyLoss(nn.Module):
         assert z.ndimension() == 2
 
         n = z.size(0)
-        out = im_kernel_sum(z, z, z_var, exclude_diag=True).div(n*(n-1)) + \
-            im_kernel_sum(z_tilde, z_tilde, z_var, exclude_diag=True).div(n*(n-1)) + \
-            -im_kernel_sum(z, z_tilde, z_var, exclude_diag=False).div(n*n).mul(2)
+        # Squared norms are shared by the three kernel sums
+        z_sq = z.pow(2).sum(1)
+        z_tilde_sq = z_tilde.pow(2).sum(1)
+        out = im_kernel_sum(z, z, z_var, True, z_sq, z_sq, self.block_size).div(n*(n-1)) + \
+            im_kernel_sum(z_tilde, z_tilde, z_var, True, z_tilde_sq, z_tilde_sq, self.block_size).div(n*(n-1)) + \
+            -im_kernel_sum(z, z_tilde, z_var, False, z_sq, z_tilde_sq, self.block_size).div(n*n).mul(2)
 
         return out
 
@@ -27,3 +27,59 @@ def calculate_matmul(mat_a, mat_b):
     """
     assert mat_a.shape[-2] == 1 and mat_b.shape[-1] == 1
     return torch.sum(mat_a.squeeze(-2) * mat_b.squeeze(-1), dim=2, keepdim=True)
+
+def masked_mean(x, key_padding_mask=None):
+    """
+    Average tokens of each sentence without padding.
+    args:
+        x:                  torch.Tensor (seq_len, batch, d)
+        key_padding_mask:   torch.Tensor (batch, seq_len); True for padding, or None to average every token
+    returns:
+        torch.Tensor (batch, d)
+    """
+    if key_padding_mask is None:
+        return x.mean(dim=0)
+    token_mask = (~key_padding_mask).transpose(0, 1).unsqueeze(2).to(x.dtype) # (seq_len, batch, 1)
+    return (x * token_mask).sum(dim=0) / token_mask.sum(dim=0).clamp(min=1)
+
+def segment_index(segment_ids):
+    """
+    Index of the packed example of each token over the whole batch.
+    args:
+        segment_ids:    torch.Tensor (batch, seq_len); 1, 2, ... for packed examples and 0 for padding
+    returns:
+        index:          torch.Tensor (batch, seq_len); -1 for padding
+        n_segment:      number of examples in the batch
+    """
+    n_segment = segment_ids.max(dim=1)[0] # (batch)
+    offset = n_segment.cumsum(0) - n_segment
+    index = torch.where(segment_ids > 0, segment_ids - 1 + offset.unsqueeze(1), torch.full_like(segment_ids, -1))
+    return index, int(n_segment.sum())
+
+def segment_mean(x, index, n_segment):
+    """
+    Average tokens of each packed example without padding.
+    args:
+        x:      torch.Tensor (seq_len, batch, d)
+        index:  torch.Tensor (batch, seq_len) from segment_index
+    returns:
+        torch.Tensor (n_segment, d)
+    """
+    token_mask = index >= 0
+    x = x.transpose(0, 1)[token_mask] # (token, d)
+    index = index[token_mask]
+    total = x.new_zeros(n_segment, x.size(-1)).index_add_(0, index, x)
+    count = x.new_zeros(n_segment).index_add_(0, index, torch.ones_like(index, dtype=x.dtype))
+    return total / count.unsqueeze(1)
+
+def segment_to_token(x, index):
+    """
+    Spread the vector of each packed example to its tokens; padding gets zero vector.
+    args:
+        x:      torch.Tensor (n_segment, d)
+        index:  torch.Tensor (batch, seq_len) from segment_index
+    returns:
+        torch.Tensor (seq_len, batch, d)
+    """
+    token_mask = (index >= 0).unsqueeze(2).to(x.dtype)
+    return (x[index.clamp(min=0)] * token_mask).transpose(0, 1)
@@ -0,0 +1,73 @@
+# Import PyTorch
+import torch
+
+class LogitsProcessorList(list):
+    """
+    Apply logits processors in order to the next token scores of every beam.
+    Each processor is called with (seqs, step, scores) and returns the processed scores where
+    seqs is (batch * k, step + 1) decoded tokens including bos token and scores is (batch * k, vocab_num).
+    """
+    def __call__(self, seqs, step, scores):
+        for processor in self:
+            scores = processor(seqs, step, scores)
+        return scores
+
+class RepetitionPenaltyLogitsProcessor(object):
+    """
+    Penalize every token which is already generated; negative scores are multiplied by the penalty
+    and positive scores are divided by it.
+    """
+    def __init__(self, penalty: float):
+        self.penalty = penalty
+
+    def __call__(self, seqs, step, scores):
+        if step == 0:
+            return scores
+        generated = seqs[:, 1:] # (batch * k, step)
+        generated_scores = scores.gather(1, generated)
+        generated_scores = torch.where(generated_scores < 0, generated_scores * self.penalty,
+                                       generated_scores / self.penalty)
+        return scores.scatter(1, generated, generated_scores)
+
+class NoRepeatNGramLogitsProcessor(object):
+    """
+    Block tokens which would make an n-gram that already exists in the hypothesis.
+    """
+    def __init__(self, ngram_size: int):
+        self.ngram_size = ngram_size
+
+    def __call__(self, seqs, step, scores):
+        seq_len = seqs.size(1)
+        if seq_len < self.ngram_size:
+            return scores
+        ngrams = seqs.unfold(1, self.ngram_size, 1) # (batch * k, ngram_num, ngram_size)
+        current_prefix = seqs[:, seq_len - (self.ngram_size - 1):].unsqueeze(1) # (batch * k, 1, ngram_size - 1)
+        prefix_match = (ngrams[:, :, :-1] == current_prefix).all(dim=2) # (batch * k, ngram_num)
+        # Only the matched n-grams are indexed instead of a (batch * k, vocab_num) mask
+        rows, ngram_inds = prefix_match.nonzero(as_tuple=True)
+        scores[rows, ngrams[rows, ngram_inds, -1]] = float('-inf')
+        return scores
+
+class MinLengthLogitsProcessor(object):
+    """
+    Block eos token until 'min_len' tokens are generated. 'min_len=1' only blocks eos token in the first step.
+    """
+    def __init__(self, min_len: int, eos_idx: int):
+        self.min_len = min_len
+        self.eos_idx = eos_idx
+
+    def __call__(self, seqs, step, scores):
+        if step < self.min_len:
+            scores[:, self.eos_idx] = float('-inf')
+        return scores
+
+def build_logits_processor(eos_idx: int, repetition_penalty: float = 0,
+                           no_repeat_ngram_size: int = 0, min_len: int = 0):
+    logits_processor = LogitsProcessorList()
+    if repetition_penalty not in [0, 1]:
+        logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if no_repeat_ngram_size > 0:
+        logits_processor.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    # eos token is always blocked in the first step
+    logits_processor.append(MinLengthLogitsProcessor(max(1, min_len), eos_idx))
+    return logits_processor
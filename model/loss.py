@@ -0,0 +1,51 @@
+# Import PyTorch
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+def chunk_cross_entropy(hidden, weight, bias, gold, logit_scale: float = 1., smoothing_eps: float = 0):
+    """
+    Summed loss and correct prediction count of one chunk of hidden (chunk, d_embedding).
+    Label smoothing gives 1 - smoothing_eps to the gold token and smoothing_eps / (vocab_num - 1) to every other token
+    as label_smoothing_loss in task/utils.py, but from the log-sum-exp without a one-hot matrix.
+    """
+    logits = F.linear(hidden, weight, bias).float() * logit_scale # (chunk, vocab_num)
+    lse = torch.logsumexp(logits, dim=1) # (chunk)
+    nll = lse - logits.gather(1, gold.unsqueeze(1)).squeeze(1) # -log p(gold)
+    loss = nll
+    if smoothing_eps > 0:
+        n_class = logits.size(1)
+        other_nll = n_class * lse - logits.sum(dim=1) - nll # -sum of log p over the other tokens
+        loss = (1 - smoothing_eps) * nll + smoothing_eps / (n_class - 1) * other_nll
+    correct = (logits.argmax(dim=1) == gold).sum()
+    return loss.sum(), correct
+
+class ChunkedCrossEntropyLoss(nn.Module):
+    """
+    Vocabulary projection and cross entropy of hidden (tokens, d_embedding), 'chunk_size' tokens at a time.
+    The logits of each chunk are recomputed in backward instead of being kept,
+    so only one (chunk_size, vocab_num) logit matrix exists at a time.
+    """
+    def __init__(self, chunk_size: int = 4096, smoothing_eps: float = 0):
+        super(ChunkedCrossEntropyLoss, self).__init__()
+        self.chunk_size = chunk_size
+        self.smoothing_eps = smoothing_eps
+
+    def forward(self, hidden, output_linear: nn.Linear, gold, logit_scale: float = 1.):
+        """
+        Returns:
+            loss: token mean loss
+            correct: number of tokens of which the highest logit is the gold token
+        """
+        loss, correct = hidden.new_zeros((), dtype=torch.float), 0
+        for start in range(0, hidden.size(0), self.chunk_size):
+            chunk_args = (hidden[start:start + self.chunk_size], output_linear.weight, output_linear.bias,
+                          gold[start:start + self.chunk_size], logit_scale, self.smoothing_eps)
+            if torch.is_grad_enabled():
+                chunk_loss, chunk_correct = checkpoint(chunk_cross_entropy, *chunk_args, use_reentrant=False)
+            else:
+                chunk_loss, chunk_correct = chunk_cross_entropy(*chunk_args)
+            loss = loss + chunk_loss
+            correct = correct + chunk_correct
+        return loss / max(hidden.size(0), 1), correct
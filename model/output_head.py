@@ -0,0 +1,109 @@
+# Import PyTorch
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+def count_vector(vocab_num: int, token_count=None):
+    """
+    Training count of every token index, zero for indices beyond 'token_count'; one for every token if there is no count
+    """
+    if token_count is None:
+        return torch.ones(vocab_num)
+    token_count = torch.as_tensor(token_count, dtype=torch.float)[:vocab_num]
+    return F.pad(token_count, (0, vocab_num - token_count.size(0)))
+
+def frequency_order(vocab_num: int, token_count=None):
+    """
+    Token indices sorted by descending training count; the index order if there is no count
+    """
+    if token_count is None:
+        return torch.arange(vocab_num)
+    return torch.argsort(count_vector(vocab_num, token_count), descending=True)
+
+class AdaptiveSoftmaxHead(nn.Module):
+    """
+    Adaptive softmax over tokens sorted by training frequency. Frequent tokens up to the first cutoff are scored
+    in the head and the rest in tail clusters of 'div_value' times smaller dimension.
+    """
+    def __init__(self, d_input: int, vocab_num: int, token_count=None, cutoffs: list = [2000, 10000],
+                 div_value: float = 4.):
+        super(AdaptiveSoftmaxHead, self).__init__()
+
+        rank_to_token = frequency_order(vocab_num, token_count)
+        token_to_rank = torch.empty_like(rank_to_token)
+        token_to_rank[rank_to_token] = torch.arange(vocab_num)
+        # Saved with the model since testing has no training counts
+        self.register_buffer('token_to_rank', token_to_rank)
+
+        cutoffs = sorted(set(cutoff for cutoff in cutoffs if 0 < cutoff < vocab_num - 1))
+        if len(cutoffs) == 0:
+            raise Exception(f'Adaptive softmax needs a cutoff between 1 and {vocab_num - 2}')
+        self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(d_input, vocab_num, cutoffs, div_value=div_value)
+
+    def forward(self, hidden, gold, output_linear: nn.Linear = None, logit_scale: float = 1.):
+        """
+        Token mean loss and correct prediction count; the head has its own projection and 'output_linear' is not used
+        """
+        gold_rank = self.token_to_rank[gold]
+        # The cluster outputs are gathered into one tensor which needs a single dtype
+        with torch.cuda.amp.autocast(enabled=False):
+            loss = self.adaptive(hidden.float(), gold_rank).loss
+            with torch.no_grad():
+                correct = (self.adaptive.predict(hidden.float()) == gold_rank).sum()
+        return loss, correct
+
+    def log_prob(self, hidden):
+        # Full vocabulary log-probabilities in token index order
+        with torch.cuda.amp.autocast(enabled=False):
+            log_prob = self.adaptive.log_prob(hidden.float()) # (tokens, vocab_num)
+        return log_prob[:, self.token_to_rank]
+
+class SampledSoftmaxHead(nn.Module):
+    """
+    Sampled softmax over the gold token and 'num_sampled' negative tokens shared by the batch.
+    Negatives are drawn from the training unigram distribution to the power of 'power', logits are corrected by
+    the log expected count of each token and negatives equal to the gold token are masked out.
+    The full softmax of the output projection is used out of training.
+    """
+    def __init__(self, vocab_num: int, token_count=None, num_sampled: int = 8192, power: float = 0.75):
+        super(SampledSoftmaxHead, self).__init__()
+
+        self.num_sampled = num_sampled
+        sampling_prob = count_vector(vocab_num, token_count).clamp(min=1).pow(power)
+        self.register_buffer('sampling_prob', sampling_prob / sampling_prob.sum())
+
+    def forward(self, hidden, gold, output_linear: nn.Linear, logit_scale: float = 1.):
+        """
+        Token mean loss and correct prediction count among the gold and sampled tokens
+        """
+        sampled = torch.multinomial(self.sampling_prob, self.num_sampled, replacement=True) # (num_sampled)
+        log_expected = torch.log(self.sampling_prob * self.num_sampled) # (vocab_num)
+        bias = output_linear.bias
+
+        gold_logits = (hidden * output_linear.weight[gold]).sum(dim=1) # (tokens)
+        sampled_logits = F.linear(hidden, output_linear.weight[sampled]) # (tokens, num_sampled)
+        if bias is not None:
+            gold_logits = gold_logits + bias[gold]
+            sampled_logits = sampled_logits + bias[sampled]
+        gold_logits = gold_logits.float() * logit_scale - log_expected[gold]
+        sampled_logits = sampled_logits.float() * logit_scale - log_expected[sampled]
+        sampled_logits = sampled_logits.masked_fill(sampled.unsqueeze(0) == gold.unsqueeze(1), float('-inf'))
+
+        logits = torch.cat((gold_logits.unsqueeze(1), sampled_logits), dim=1) # (tokens, 1 + num_sampled)
+        loss = F.cross_entropy(logits, torch.zeros_like(gold))
+        correct = (logits.argmax(dim=1) == 0).sum()
+        return loss, correct
+
+def build_output_head(output_head_dict: dict, d_input: int, vocab_num: int):
+    """
+    Adaptive or sampled softmax head of 'output_head_dict', or None for the full softmax
+    """
+    output_head = output_head_dict.get('output_head', 'softmax')
+    if output_head == 'adaptive':
+        return AdaptiveSoftmaxHead(d_input, vocab_num, output_head_dict.get('token_count'),
+                                   cutoffs=output_head_dict.get('adaptive_cutoffs', [2000, 10000]),
+                                   div_value=output_head_dict.get('adaptive_div_value', 4.))
+    if output_head == 'sampled':
+        return SampledSoftmaxHead(vocab_num, output_head_dict.get('token_count'),
+                                  num_sampled=output_head_dict.get('num_sampled', 8192))
+    return None
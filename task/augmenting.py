@@ -24,7 +24,7 @@ from model.custom_plm.bart import custom_Bart
 from model.custom_plm.bert import custom_Bert
 from optimizer.utils import shceduler_select, optimizer_select
 from utils import TqdmLoggingHandler, write_log, get_tb_exp_name
-from task.utils import input_to_device, label_smoothing_loss, model_save_name
+from task.utils import input_to_device, label_smoothing_loss, model_save_name, load_hdf5_array
 
 def training(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -61,20 +61,22 @@ def training(args):
         save_name = f'processed_{args.task}.hdf5'
 
     with h5py.File(os.path.join(save_path, save_name), 'r') as f:
-        train_src_input_ids = f.get('train_src_input_ids')[:]
-        train_src_attention_mask = f.get('train_src_attention_mask')[:]
-        valid_src_input_ids = f.get('valid_src_input_ids')[:]
-        valid_src_attention_mask = f.get('valid_src_attention_mask')[:]
+        # Original token index of each index of a trimmed vocabulary
+        vocab_map = f['vocab_map'][:] if 'vocab_map' in f else None
+        train_src_input_ids = load_hdf5_array(f, 'train_src_input_ids', args.lazy_loading)
+        train_src_attention_mask = load_hdf5_array(f, 'train_src_attention_mask', args.lazy_loading)
+        valid_src_input_ids = load_hdf5_array(f, 'valid_src_input_ids', args.lazy_loading)
+        valid_src_attention_mask = load_hdf5_array(f, 'valid_src_attention_mask', args.lazy_loading)
         if args.task in ['translation', 'style_transfer', 'summarization']:
-            train_trg_input_ids = f.get('train_trg_input_ids')[:]
-            train_trg_attention_mask = f.get('train_trg_attention_mask')[:]
-            valid_trg_input_ids = f.get('valid_trg_input_ids')[:]
-            valid_trg_attention_mask = f.get('valid_trg_attention_mask')[:]
+            train_trg_input_ids = load_hdf5_array(f, 'train_trg_input_ids', args.lazy_loading)
+            train_trg_attention_mask = load_hdf5_array(f, 'train_trg_attention_mask', args.lazy_loading)
+            valid_trg_input_ids = load_hdf5_array(f, 'valid_trg_input_ids', args.lazy_loading)
+            valid_trg_attention_mask = load_hdf5_array(f, 'valid_trg_attention_mask', args.lazy_loading)
         elif args.task in ['reconstruction']:
-            train_trg_input_ids = f.get('train_src_input_ids')[:]
-            train_trg_attention_mask = f.get('train_src_attention_mask')[:]
-            valid_trg_input_ids = f.get('valid_src_input_ids')[:]
-            valid_trg_attention_mask = f.get('valid_src_attention_mask')[:]
+            train_trg_input_ids = load_hdf5_array(f, 'train_src_input_ids', args.lazy_loading)
+            train_trg_attention_mask = load_hdf5_array(f, 'train_src_attention_mask', args.lazy_loading)
+            valid_trg_input_ids = load_hdf5_array(f, 'valid_src_input_ids', args.lazy_loading)
+            valid_trg_attention_mask = load_hdf5_array(f, 'valid_src_attention_mask', args.lazy_loading)
         elif args.task in ['classification']:
             train_trg_list = f.get('train_label')[:]
             valid_trg_list = f.get('valid_label')[:]
@@ -98,6 +100,9 @@ def training(args):
         else:
             trg_vocab_num = 0
         del data_
+    if vocab_map is not None:
+        src_vocab_num = len(vocab_map)
+        trg_vocab_num = len(vocab_map) if trg_vocab_num > 0 else 0
 
     gc.enable()
     write_log(logger, "Finished loading data!")
@@ -119,6 +124,14 @@ def training(args):
         variational_mode_dict['latent_add_encoder_out'] = args.latent_add_encoder_out
         variational_mode_dict['z_var'] = args.z_var
         variational_mode_dict['d_latent'] = args.d_latent
+        variational_mode_dict['trg_encoder_mode'] = args.trg_encoder_mode
+
+    # Output head weights and token order are loaded from the checkpoint
+    output_head_dict = dict()
+    if args.output_head != 'softmax':
+        output_head_dict['output_head'] = args.output_head
+        output_head_dict['adaptive_cutoffs'] = args.adaptive_cutoffs
+        output_head_dict['num_sampled'] = args.num_sampled
 
     if args.model_type == 'custom_transformer':
         model = Transformer(task=args.task,
@@ -134,7 +147,7 @@ def training(args):
                             emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing, 
                             variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
-                            parallel=args.parallel)
+                            parallel=args.parallel, output_head_dict=output_head_dict)
         tgt_subsqeunt_mask = model.generate_square_subsequent_mask(args.trg_max_len - 1, device)
     # elif args.model_type == 'T5':
     #     model = custom_T5(isPreTrain=args.isPreTrain, d_latent=args.d_latent, 
@@ -146,7 +159,8 @@ def training(args):
                             isPreTrain=args.isPreTrain, variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            output_head_dict=output_head_dict, vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     elif args.model_type == 'bert':
         model = custom_Bert(task=args.task, num_class=128, # Need to refactoring
@@ -154,7 +168,8 @@ def training(args):
                             src_language=src_language,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     model = model.to(device)
 
@@ -1,23 +1,115 @@
 import os
 import numpy as np
+from itertools import islice
 import pandas as pd
 from sklearn.preprocessing import LabelEncoder
 
 from datasets import load_dataset
 
-def data_split_index(seq, valid_ration: float = 0.1, test_ratio: float = 0.03):
-
+def data_split_index(seq, args, valid_ration: float = 0.1, test_ratio: float = 0.03):
+    """
+    Train, valid and test index arrays from one permutation seeded with 'seed'.
+    The indices are saved in 'split_index.npz' next to the preprocessed data and reused
+    while the data length, ratios and seed are the same.
+    """
     paired_data_len = len(seq)
     valid_num = int(paired_data_len * valid_ration)
     test_num = int(paired_data_len * test_ratio)
+    seed = -1 if args.seed is None else args.seed
+
+    split_path = os.path.join(args.preprocess_path, args.data_name, 'split_index.npz')
+    if os.path.exists(split_path):
+        split_index = np.load(split_path)
+        if split_index['setting'].tolist() == [paired_data_len, valid_num, test_num, seed]:
+            return split_index['train_index'], split_index['valid_index'], split_index['test_index']
+
+    permutation = np.random.RandomState(args.seed).permutation(paired_data_len)
+    valid_index = permutation[:valid_num]
+    test_index = permutation[valid_num:valid_num + test_num]
+    train_index = np.sort(permutation[valid_num + test_num:])
 
-    valid_index = np.random.choice(paired_data_len, valid_num, replace=False)
-    train_index = list(set(range(paired_data_len)) - set(valid_index))
-    test_index = np.random.choice(train_index, test_num, replace=False)
-    train_index = list(set(train_index) - set(test_index))
+    if os.path.exists(os.path.dirname(split_path)):
+        np.savez(split_path, train_index=train_index, valid_index=valid_index, test_index=test_index,
+                 setting=np.array([paired_data_len, valid_num, test_num, seed]))
 
     return train_index, valid_index, test_index
 
+def index_select(values, index):
+    """
+    Values of a list or pandas Series at 'index' as a list
+    """
+    if isinstance(values, pd.Series):
+        return values.iloc[index].tolist()
+    return np.asarray(values, dtype=object)[index].tolist()
+
+# Raw data directory of each data name under 'data_path'
+raw_data_dir_dict = {
+    'WMT2016_Multimodal': 'WMT/2016/multi_modal',
+    'WMT2014_de_en': 'WMT/2014/de_en',
+    'korpora': 'korpora',
+    'aihub_en_kr': 'AI_Hub_KR_EN',
+    'GYAFC': 'GYAFC_Corpus',
+    'WNC': 'bias_data',
+    'korean_hate_speech': 'korean-hate-speech-detection',
+    'IMDB': 'text_classification/IMDB',
+    'ProsCons': 'text_classification/ProsCons',
+    'MR': 'text_classification/MR',
+    'GVFC': 'GVFC',
+    'dacon_kotour': 'dacon_kotour'
+}
+
+def raw_data_dir(args):
+    """
+    Raw data directory of 'data_name', or None if the data is loaded from Huggingface datasets
+    """
+    if args.data_name == 'cnn_dailymail':
+        return os.path.join(args.data_path, 'cnn_dailymail', args.cnn_dailymail_ver)
+    if args.data_name in raw_data_dir_dict:
+        return os.path.join(args.data_path, raw_data_dir_dict[args.data_name])
+    return None
+
+# Line-aligned (source, target) files of each split for streaming preprocessing
+raw_line_file_dict = {
+    'WMT2016_Multimodal': {
+        'train': ('train.de', 'train.en'),
+        'valid': ('val.de', 'val.en'),
+        'test': ('test.de', 'test.en')
+    },
+    'WMT2014_de_en': {
+        'train': ('train.de', 'train.en'),
+        'valid': ('val.de', 'val.en'),
+        'test': ('test.de', 'test.en')
+    }
+}
+
+def raw_line_files(args):
+    """
+    (source file path, target file path) of each split of 'data_name'
+    """
+    if args.data_name not in raw_line_file_dict:
+        raise Exception(f'Streaming preprocessing only supports pre-split line corpora; {list(raw_line_file_dict.keys())}')
+
+    file_dict = dict()
+    for phase, (src_file, trg_file) in raw_line_file_dict[args.data_name].items():
+        src_path = os.path.join(raw_data_dir(args), src_file)
+        trg_path = os.path.join(raw_data_dir(args), trg_file)
+        file_dict[phase] = (trg_path, src_path) if args.src_trg_reverse else (src_path, trg_path)
+    return file_dict
+
+def line_chunk_iter(src_path: str, trg_path: str, chunk_size: int = 100000):
+    """
+    Read aligned source and target lines 'chunk_size' lines at a time
+    """
+    with open(src_path, 'r') as f_src, open(trg_path, 'r') as f_trg:
+        while True:
+            src_chunk = [x.replace('\n', '') for x in islice(f_src, chunk_size)]
+            trg_chunk = [x.replace('\n', '') for x in islice(f_trg, chunk_size)]
+            if len(src_chunk) != len(trg_chunk):
+                raise Exception(f'{src_path} and {trg_path} have different line counts')
+            if len(src_chunk) == 0:
+                return
+            yield src_chunk, trg_chunk
+
 def total_data_load(args):
 
     src_list = dict()
@@ -30,7 +122,7 @@ def total_data_load(args):
     # WMT2016 Multimodal [DE -> EN]
 
     if args.data_name == 'WMT2016_Multimodal':
-        args.data_path = os.path.join(args.data_path,'WMT/2016/multi_modal')
+        args.data_path = raw_data_dir(args)
 
         # 1) Train data load
         with open(os.path.join(args.data_path, 'train.de'), 'r') as f:
@@ -53,7 +145,7 @@ def total_data_load(args):
     # WMT2014 Translation [DE -> EN]
         
     elif args.data_name == 'WMT2014_de_en':
-        args.data_path = os.path.join(args.data_path,'WMT/2014/de_en')
+        args.data_path = raw_data_dir(args)
 
         # 1) Train data load
         with open(os.path.join(args.data_path, 'train.de'), 'r') as f:
@@ -79,39 +171,39 @@ def total_data_load(args):
     # Korpora [EN -> KR]
 
     elif args.data_name == 'korpora':
-        args.data_path = os.path.join(args.data_path,'korpora')
+        args.data_path = raw_data_dir(args)
 
         en = pd.read_csv(os.path.join(args.data_path, 'pair_eng.csv'), names=['en'])['en']
         kr = pd.read_csv(os.path.join(args.data_path, 'pair_kor.csv'), names=['kr'])['kr']
 
-        train_index, valid_index, test_index = data_split_index(en)
+        train_index, valid_index, test_index = data_split_index(en, args)
 
-        src_list['train'] = [en[i] for i in train_index]
-        trg_list['train'] = [kr[i] for i in train_index]
+        src_list['train'] = index_select(en, train_index)
+        trg_list['train'] = index_select(kr, train_index)
 
-        src_list['valid'] = [en[i] for i in valid_index]
-        trg_list['valid'] = [kr[i] for i in valid_index]
+        src_list['valid'] = index_select(en, valid_index)
+        trg_list['valid'] = index_select(kr, valid_index)
 
-        src_list['test'] = [en[i] for i in test_index]
-        trg_list['test'] = [kr[i] for i in test_index]
+        src_list['test'] = index_select(en, test_index)
+        trg_list['test'] = index_select(kr, test_index)
 
     # AIHUB [EN -> KR]
 
     elif args.data_name == 'aihub_en_kr':
-        args.data_path = os.path.join(args.data_path,'AI_Hub_KR_EN')
+        args.data_path = raw_data_dir(args)
 
         dat = pd.read_csv(os.path.join(args.data_path, '1_구어체(1).csv'))
 
-        train_index, valid_index, test_index = data_split_index(dat)
+        train_index, valid_index, test_index = data_split_index(dat, args)
 
-        src_list['train'] = [dat['EN'][i] for i in train_index]
-        trg_list['train'] = [dat['KR'][i] for i in train_index]
+        src_list['train'] = index_select(dat['EN'], train_index)
+        trg_list['train'] = index_select(dat['KR'], train_index)
 
-        src_list['valid'] = [dat['EN'][i] for i in valid_index]
-        trg_list['valid'] = [dat['KR'][i] for i in valid_index]
+        src_list['valid'] = index_select(dat['EN'], valid_index)
+        trg_list['valid'] = index_select(dat['KR'], valid_index)
 
-        src_list['test'] = [dat['EN'][i] for i in test_index]
-        trg_list['test'] = [dat['KR'][i] for i in test_index]
+        src_list['test'] = index_select(dat['EN'], test_index)
+        trg_list['test'] = index_select(dat['KR'], test_index)
 
     #===================================#
     #========Text Style Transfer========#
@@ -120,7 +212,7 @@ def total_data_load(args):
     # GYAFC [Informal -> Formal]
 
     if args.data_name == 'GYAFC':
-        args.data_path = os.path.join(args.data_path,'GYAFC_Corpus')
+        args.data_path = raw_data_dir(args)
 
         # 1) Train data load
         with open(os.path.join(args.data_path, 'Entertainment_Music/train/informal_em_train.txt'), 'r') as f:
@@ -139,21 +231,21 @@ def total_data_load(args):
         record_list_src = music_src + family_src
         record_list_trg = music_trg + family_trg
 
-        train_index, valid_index, test_index = data_split_index(record_list_src)
+        train_index, valid_index, test_index = data_split_index(record_list_src, args)
 
-        src_list['train'] = [record_list_src[i] for i in train_index]
-        trg_list['train'] = [record_list_trg[i] for i in train_index]
+        src_list['train'] = index_select(record_list_src, train_index)
+        trg_list['train'] = index_select(record_list_trg, train_index)
 
-        src_list['valid'] = [record_list_src[i] for i in valid_index]
-        trg_list['valid'] = [record_list_trg[i] for i in valid_index]
+        src_list['valid'] = index_select(record_list_src, valid_index)
+        trg_list['valid'] = index_select(record_list_trg, valid_index)
 
-        src_list['test'] = [record_list_src[i] for i in test_index]
-        trg_list['test'] = [record_list_trg[i] for i in test_index]
+        src_list['test'] = index_select(record_list_src, test_index)
+        trg_list['test'] = index_select(record_list_trg, test_index)
 
     # WNC [Biased -> Neutral]
 
     if args.data_name == 'WNC':
-        args.data_path = os.path.join(args.data_path,'bias_data')
+        args.data_path = raw_data_dir(args)
         col_names = ['ID','src_tok','tgt_tok','src_raw','trg_raw','src_POS','trg_parse_tags']
 
         train_dat = pd.read_csv(os.path.join(args.data_path, 'WNC/biased.word.train'), 
@@ -175,7 +267,7 @@ def total_data_load(args):
     #===================================#
 
     if args.data_name == 'korean_hate_speech':
-        args.data_path = os.path.join(args.data_path,'korean-hate-speech-detection')
+        args.data_path = raw_data_dir(args)
 
         train_dat = pd.read_csv(os.path.join(args.data_path, 'train.hate.csv'))
         valid_dat = pd.read_csv(os.path.join(args.data_path, 'dev.hate.csv'))
@@ -196,7 +288,7 @@ def total_data_load(args):
         trg_list['test'] = [0 for _ in range(len(test_dat))]
 
     if args.data_name == 'IMDB':
-        args.data_path = os.path.join(args.data_path,'text_classification/IMDB')
+        args.data_path = raw_data_dir(args)
 
         if args.with_eda:
             train_dat = pd.read_csv(os.path.join(args.data_path, 'train_aug.csv'))
@@ -207,19 +299,19 @@ def total_data_load(args):
         test_dat['sentiment'] = test_dat['sentiment'].replace('positive', 0)
         test_dat['sentiment'] = test_dat['sentiment'].replace('negative', 1)
 
-        train_index, valid_index, test_index = data_split_index(train_dat)
+        train_index, valid_index, test_index = data_split_index(train_dat, args)
 
-        src_list['train'] = [train_dat['comment'].tolist()[i] for i in train_index]
-        trg_list['train'] = [train_dat['sentiment'].tolist()[i] for i in train_index]
+        src_list['train'] = index_select(train_dat['comment'], train_index)
+        trg_list['train'] = index_select(train_dat['sentiment'], train_index)
 
-        src_list['valid'] = [train_dat['comment'].tolist()[i] for i in valid_index]
-        trg_list['valid'] = [train_dat['sentiment'].tolist()[i] for i in valid_index]
+        src_list['valid'] = index_select(train_dat['comment'], valid_index)
+        trg_list['valid'] = index_select(train_dat['sentiment'], valid_index)
 
         src_list['test'] = test_dat['comment'].tolist()
         trg_list['test'] = test_dat['sentiment'].tolist()
 
     if args.data_name == 'ProsCons':
-        args.data_path = os.path.join(args.data_path,'text_classification/ProsCons')
+        args.data_path = raw_data_dir(args)
 
         if args.with_eda:
             train_dat = pd.read_csv(os.path.join(args.data_path, 'train_aug.csv'))
@@ -228,19 +320,19 @@ def total_data_load(args):
 
         test_dat = pd.read_csv(os.path.join(args.data_path, 'test.csv'), names=['label', 'description'])
 
-        train_index, valid_index, test_index = data_split_index(train_dat)
+        train_index, valid_index, test_index = data_split_index(train_dat, args)
 
-        src_list['train'] = [train_dat['description'].tolist()[i] for i in train_index]
-        trg_list['train'] = [train_dat['label'].tolist()[i] for i in train_index]
+        src_list['train'] = index_select(train_dat['description'], train_index)
+        trg_list['train'] = index_select(train_dat['label'], train_index)
 
-        src_list['valid'] = [train_dat['description'].tolist()[i] for i in valid_index]
-        trg_list['valid'] = [train_dat['label'].tolist()[i] for i in valid_index]
+        src_list['valid'] = index_select(train_dat['description'], valid_index)
+        trg_list['valid'] = index_select(train_dat['label'], valid_index)
 
         src_list['test'] = test_dat['description'].tolist()
         trg_list['test'] = test_dat['label'].tolist()
 
     if args.data_name == 'MR':
-        args.data_path = os.path.join(args.data_path,'text_classification/MR')
+        args.data_path = raw_data_dir(args)
 
         if args.with_eda:
             train_dat = pd.read_csv(os.path.join(args.data_path, 'train_aug.csv'))
@@ -249,33 +341,33 @@ def total_data_load(args):
 
         test_dat = pd.read_csv(os.path.join(args.data_path, 'test.csv'), names=['label', 'description'])
 
-        train_index, valid_index, test_index = data_split_index(train_dat)
+        train_index, valid_index, test_index = data_split_index(train_dat, args)
 
-        src_list['train'] = [train_dat['description'].tolist()[i] for i in train_index]
-        trg_list['train'] = [train_dat['label'].tolist()[i] for i in train_index]
+        src_list['train'] = index_select(train_dat['description'], train_index)
+        trg_list['train'] = index_select(train_dat['label'], train_index)
 
-        src_list['valid'] = [train_dat['description'].tolist()[i] for i in valid_index]
-        trg_list['valid'] = [train_dat['label'].tolist()[i] for i in valid_index]
+        src_list['valid'] = index_select(train_dat['description'], valid_index)
+        trg_list['valid'] = index_select(train_dat['label'], valid_index)
 
         src_list['test'] = test_dat['description'].tolist()
         trg_list['test'] = test_dat['label'].tolist()
 
     if args.data_name == 'GVFC':
-        args.data_path = os.path.join(args.data_path,'GVFC')
+        args.data_path = raw_data_dir(args)
 
         gvfc_dat = pd.read_csv(os.path.join(args.data_path, 'GVFC_headlines_and_annotations.csv'))
         gvfc_dat = gvfc_dat.replace(99, 0)
         src_text = gvfc_dat['news_title'].tolist()
         trg_class = gvfc_dat['Q3 Theme1'].tolist()
 
-        train_index, valid_index, test_index = data_split_index(gvfc_dat)
+        train_index, valid_index, test_index = data_split_index(gvfc_dat, args)
 
-        src_list['train'] = [src_text[i] for i in train_index]
-        trg_list['train'] = [trg_class[i] for i in train_index]
-        src_list['valid'] = [src_text[i] for i in valid_index]
-        trg_list['valid'] = [trg_class[i] for i in valid_index]
-        src_list['test'] = [src_text[i] for i in test_index]
-        trg_list['test'] = [trg_class[i] for i in test_index]
+        src_list['train'] = index_select(src_text, train_index)
+        trg_list['train'] = index_select(trg_class, train_index)
+        src_list['valid'] = index_select(src_text, valid_index)
+        trg_list['valid'] = index_select(trg_class, valid_index)
+        src_list['test'] = index_select(src_text, test_index)
+        trg_list['test'] = index_select(trg_class, test_index)
 
     #===================================#
     #===========Summarization===========#
@@ -283,7 +375,7 @@ def total_data_load(args):
 
     if args.data_name == 'cnn_dailymail':
 
-        args.data_path = os.path.join(args.data_path, 'cnn_dailymail', args.cnn_dailymail_ver)
+        args.data_path = raw_data_dir(args)
 
         train = pd.read_csv(os.path.join(args.data_path, 'train.csv'))
         valid = pd.read_csv(os.path.join(args.data_path, 'valid.csv'))
@@ -317,7 +409,7 @@ def total_data_load(args):
 
     if args.data_name == 'dacon_kotour':
 
-        args.data_path = os.path.join(args.data_path, 'dacon_kotour')
+        args.data_path = raw_data_dir(args)
 
         train = pd.read_csv(os.path.join(args.data_path, 'train.csv'))
         test = pd.read_csv(os.path.join(args.data_path, 'test.csv'))
@@ -326,7 +418,7 @@ def total_data_load(args):
         train['img_path'] = train['img_path'].map(lambda t: os.path.join(args.data_path, 'image/train', t.split('/')[-1]))
         test['img_path'] = test['img_path'].map(lambda t: os.path.join(args.data_path, 'image/test', t.split('/')[-1]))
         
-        train_index, valid_index, test_index = data_split_index(train, test_ratio=0)
+        train_index, valid_index, test_index = data_split_index(train, args, test_ratio=0)
 
         le = LabelEncoder()
         le.fit(train.iloc[train_index]['cat3'].values)
@@ -335,13 +427,13 @@ def total_data_load(args):
         src_list['txt'] = dict()
         src_list['img'] = dict()
 
-        src_list['img']['train'] = [train['img_path'].tolist()[i] for i in train_index]
-        src_list['txt']['train'] = [train['overview'].tolist()[i] for i in train_index]
-        trg_list['train'] = [train['cat3_encoded'].tolist()[i] for i in train_index]
+        src_list['img']['train'] = index_select(train['img_path'], train_index)
+        src_list['txt']['train'] = index_select(train['overview'], train_index)
+        trg_list['train'] = index_select(train['cat3_encoded'], train_index)
 
-        src_list['img']['valid'] = [train['img_path'].tolist()[i] for i in valid_index]
-        src_list['txt']['valid'] = [train['overview'].tolist()[i] for i in valid_index]
-        trg_list['valid'] = [train['cat3_encoded'].tolist()[i] for i in valid_index]
+        src_list['img']['valid'] = index_select(train['img_path'], valid_index)
+        src_list['txt']['valid'] = index_select(train['overview'], valid_index)
+        trg_list['valid'] = index_select(train['cat3_encoded'], valid_index)
 
         src_list['img']['test'] = train['img_path'].tolist()
         src_list['txt']['test'] = test['overview'].tolist()
@@ -4,15 +4,90 @@ import h5py
 import pickle
 import logging
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 # Import custom modules
-from task.preprocessing.tokenizer.spm_tokenize import spm_tokenizing, benchmark_spm_tokenizing
-from task.preprocessing.tokenizer.plm_tokenize import plm_tokenizing, benchmark_plm_tokenizing
+from task.preprocessing.tokenizer.spm_tokenize import spm_tokenizing, spm_training, spm_vocab_load, spm_encoding, \
+    pad_add, benchmark_spm_tokenizing
+from task.preprocessing.tokenizer.plm_tokenize import plm_tokenizing, plm_tokenizer_select, plm_worker_pool, \
+    plm_encoding, benchmark_plm_tokenizing
 from task.preprocessing.tokenizer.spacy_tokenize import spacy_tokenizing
-from task.preprocessing.data_load import total_data_load
+from task.preprocessing.data_load import total_data_load, raw_line_files, line_chunk_iter
+from task.preprocessing.ragged_format import write_token_array, convert_to_ragged, TokenArrayAppender
+from task.preprocessing.preprocess_cache import spm_cache_config, processed_cache_config, cache_lookup, \
+    cache_restore, cache_store
+from task.preprocessing.vocab_trimming import vocab_trimming
 from utils import TqdmLoggingHandler, write_log
 
 from datasets import load_dataset
 
+def data_language(args):
+    src_language, trg_language = None, None
+    if args.data_name in ['WMT2016_Multimodal', 'WMT2014_de_en']:
+        src_language = 'de'
+        trg_language = 'en'
+    elif args.data_name in ['korpora', 'aihub_en_kr']:
+        src_language = 'en'
+        trg_language = 'kr'
+    elif args.data_name in ['GYAFC', 'WNC', 'cnn_dailymail']:
+        src_language = 'en'
+        trg_language = 'en'
+    elif args.data_name in ['korean_hate_speech', 'NSMC']:
+        src_language = 'kr'
+    elif args.data_name in ['IMDB', 'ProsCons', 'MR']:
+        src_language = 'en'
+    elif args.data_name in ['dacon_kotour']:
+        src_language = 'kr'
+    return src_language, trg_language
+
+def plm_tokenizing_with_speed(logger, sequence_dict: dict, args, domain: str = 'src', language: str = 'en'):
+    start_time = time.time()
+    processed_sequences, word2id = plm_tokenizing(sequence_dict, args, domain=domain, language=language)
+    sentence_num = sum(len(sequence_dict[phase]) for phase in ['train', 'valid', 'test'])
+    write_log(logger, f'{args.tokenizer} tokenizer ({language}, {domain}) speed: '
+                      f'{sentence_num / (time.time() - start_time):.1f} sentences/sec')
+    return processed_sequences, word2id
+
+def plm_vocab_trimming(logger, args, save_path: str, save_name: str, languages: list):
+    """
+    Trim the pretrained tokenizer vocabulary to the token indices of the preprocessed train, valid and test files
+    """
+    special_ids = set()
+    for language in set(languages) - {None}:
+        special_ids.update(plm_tokenizer_select(args.tokenizer, language).all_special_ids)
+    vocab_map = vocab_trimming([os.path.join(save_path, save_name), os.path.join(save_path, 'test_' + save_name)],
+                               special_ids=sorted(special_ids))
+    write_log(logger, f'Vocabulary trimmed to {len(vocab_map)} tokens')
+
+def spm_cached_training(logger, sequence_dict: dict, args, spm_config_dict: dict):
+    """
+    Train SentencePiece models of each domain in 'sequence_dict' at the same time.
+    Models made with the same config are restored from the preprocessing cache instead.
+    """
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+
+    training_dict = dict()
+    for domain, sequences in sequence_dict.items():
+        entry_path = cache_lookup(args, f'spm_{domain}', spm_config_dict[domain]) if args.preprocess_cache else None
+        if entry_path is None:
+            training_dict[domain] = sequences
+        else:
+            cache_restore(entry_path, save_path)
+            write_log(logger, f'{domain} SentencePiece model restored from cache ({os.path.basename(entry_path)})')
+
+    if len(training_dict) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=len(training_dict)) as executor:
+        future_list = [executor.submit(spm_training, sequences, args, domain) \
+                       for domain, sequences in training_dict.items()]
+        for future in future_list:
+            future.result()
+
+    if args.preprocess_cache:
+        for domain in training_dict.keys():
+            vocab_size = args.src_vocab_size if domain == 'src' else args.trg_vocab_size
+            model_prefix = os.path.join(save_path, f'm_{domain}_{args.sentencepiece_model}_{vocab_size}')
+            cache_store(args, f'spm_{domain}', spm_config_dict[domain], [model_prefix + '.model', model_prefix + '.vocab'])
+
 def data_preprocessing(args):
 
     start_time = time.time()
@@ -28,6 +103,28 @@ def data_preprocessing(args):
     logger.addHandler(handler)
     logger.propagate = False
 
+    #===================================#
+    #===============Cache===============#
+    #===================================#
+
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+
+    if args.tokenizer == 'spm':
+        save_name = f'processed_{args.task}_{args.sentencepiece_model}_src_{args.src_vocab_size}_trg_{args.trg_vocab_size}.hdf5'
+    else:
+        save_name = f'processed_{args.task}.hdf5'
+
+    # Configs are made before data loading changes 'data_path'
+    processed_config = processed_cache_config(args)
+    spm_config_dict = {domain: spm_cache_config(args, domain) for domain in ['src', 'trg']}
+
+    if args.preprocess_cache:
+        entry_path = cache_lookup(args, 'processed', processed_config)
+        if entry_path is not None:
+            cache_restore(entry_path, save_path)
+            write_log(logger, f'Preprocessed data restored from cache ({os.path.basename(entry_path)})')
+            return
+
     #===================================#
     #=============Data Load=============#
     #===================================#
@@ -43,41 +140,33 @@ def data_preprocessing(args):
     write_log(logger, 'Tokenizer setting...')
     start_time = time.time()
 
-    if args.data_name in ['WMT2016_Multimodal', 'WMT2014_de_en']:
-        src_language = 'de'
-        trg_language = 'en'
-    elif args.data_name in ['korpora', 'aihub_en_kr']:
-        src_language = 'en'
-        trg_language = 'kr'
-    elif args.data_name in ['GYAFC', 'WNC', 'cnn_dailymail']:
-        src_language = 'en'
-        trg_language = 'en'
-    elif args.data_name in ['korean_hate_speech', 'NSMC']:
-        src_language = 'kr'
-    elif args.data_name in ['IMDB', 'ProsCons', 'MR']:
-        src_language = 'en'
-    elif args.data_name in ['dacon_kotour']:
-        src_language = 'kr'
+    src_language, trg_language = data_language(args)
 
     if args.task in ['classification', 'reconstruction']:
         if args.tokenizer == 'spm':
-            processed_src, word2id_src = spm_tokenizing(src_list, args, domain='src')
+            spm_cached_training(logger, {'src': src_list}, args, spm_config_dict)
+            processed_src, word2id_src = spm_tokenizing(src_list, args, domain='src', vocab_trained=True)
         else:
-            processed_src, word2id_src = plm_tokenizing(src_list, args, domain='src', language=src_language)
+            processed_src, word2id_src = plm_tokenizing_with_speed(logger, src_list, args, domain='src', language=src_language)
 
     elif args.task in ['translation', 'style_transfer', 'summarization']:
         if args.tokenizer == 'spm':
-            processed_src, word2id_src = spm_tokenizing(src_list, args, domain='src')
-            processed_trg, word2id_trg = spm_tokenizing(trg_list, args, domain='trg', src_trg_identical=args.src_trg_identical)
+            # Source and target vocabularies are trained at the same time
+            spm_sequence_dict = {'src': src_list} if args.src_trg_identical else {'src': src_list, 'trg': trg_list}
+            spm_cached_training(logger, spm_sequence_dict, args, spm_config_dict)
+            processed_src, word2id_src = spm_tokenizing(src_list, args, domain='src', vocab_trained=True)
+            processed_trg, word2id_trg = spm_tokenizing(trg_list, args, domain='trg', src_trg_identical=args.src_trg_identical,
+                                                        vocab_trained=True)
         else:
-            processed_src, word2id_src = plm_tokenizing(src_list, args, domain='src', language=src_language)
-            processed_trg, word2id_trg = plm_tokenizing(trg_list, args, domain='trg', language=trg_language)
+            processed_src, word2id_src = plm_tokenizing_with_speed(logger, src_list, args, domain='src', language=src_language)
+            processed_trg, word2id_trg = plm_tokenizing_with_speed(logger, trg_list, args, domain='trg', language=trg_language)
 
     elif args.task in ['multi-modal_classification']:
         if args.tokenizer == 'spm':
-            processed_src, word2id_src = spm_tokenizing(src_list['txt'], args, domain='src')
+            spm_cached_training(logger, {'src': src_list['txt']}, args, spm_config_dict)
+            processed_src, word2id_src = spm_tokenizing(src_list['txt'], args, domain='src', vocab_trained=True)
         else:
-            processed_src, word2id_src = plm_tokenizing(src_list['txt'], args, domain='src', language=src_language)
+            processed_src, word2id_src = plm_tokenizing_with_speed(logger, src_list['txt'], args, domain='src', language=src_language)
 
     write_log(logger, f'Done! ; {round((time.time()-start_time)/60, 3)}min spend')
 
@@ -88,32 +177,29 @@ def data_preprocessing(args):
     write_log(logger, 'Parsed sentence saving...')
     start_time = time.time()
 
-    # Path checking
-    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
-
-    if args.tokenizer == 'spm':
-        save_name = f'processed_{args.task}_{args.sentencepiece_model}_src_{args.src_vocab_size}_trg_{args.trg_vocab_size}.hdf5'
-    else:
-        save_name = f'processed_{args.task}.hdf5'
+    token_array_kwargs = {
+        'ragged': args.ragged_format,
+        'compression': None if args.hdf5_compression == 'none' else args.hdf5_compression
+    }
 
     with h5py.File(os.path.join(save_path, save_name), 'w') as f:
-        f.create_dataset('train_src_input_ids', data=processed_src['train']['input_ids'])
-        f.create_dataset('train_src_attention_mask', data=processed_src['train']['attention_mask'])
-        f.create_dataset('valid_src_input_ids', data=processed_src['valid']['input_ids'])
-        f.create_dataset('valid_src_attention_mask', data=processed_src['valid']['attention_mask'])
+        write_token_array(f, 'train_src', processed_src['train']['input_ids'], processed_src['train']['attention_mask'],
+                          **token_array_kwargs)
+        write_token_array(f, 'valid_src', processed_src['valid']['input_ids'], processed_src['valid']['attention_mask'],
+                          **token_array_kwargs)
         if args.task in ['translation', 'style_transfer', 'summarization']:
-            f.create_dataset('train_trg_input_ids', data=processed_trg['train']['input_ids'])
-            f.create_dataset('train_trg_attention_mask', data=processed_trg['train']['attention_mask'])
-            f.create_dataset('valid_trg_input_ids', data=processed_trg['valid']['input_ids'])
-            f.create_dataset('valid_trg_attention_mask', data=processed_trg['valid']['attention_mask'])
+            write_token_array(f, 'train_trg', processed_trg['train']['input_ids'], processed_trg['train']['attention_mask'],
+                              **token_array_kwargs)
+            write_token_array(f, 'valid_trg', processed_trg['valid']['input_ids'], processed_trg['valid']['attention_mask'],
+                              **token_array_kwargs)
         elif args.task in ['classification']:
             f.create_dataset('train_label', data=np.array(trg_list['train']).astype(int))
             f.create_dataset('valid_label', data=np.array(trg_list['valid']).astype(int))
         elif args.task in ['reconstruction']:
-            f.create_dataset('train_trg_input_ids', data=processed_src['train']['input_ids'])
-            f.create_dataset('train_trg_attention_mask', data=processed_src['train']['attention_mask'])
-            f.create_dataset('valid_trg_input_ids', data=processed_src['valid']['input_ids'])
-            f.create_dataset('valid_trg_attention_mask', data=processed_src['valid']['attention_mask'])
+            write_token_array(f, 'train_trg', processed_src['train']['input_ids'], processed_src['train']['attention_mask'],
+                              **token_array_kwargs)
+            write_token_array(f, 'valid_trg', processed_src['valid']['input_ids'], processed_src['valid']['attention_mask'],
+                              **token_array_kwargs)
         elif args.task in ['multi-modal_classification']:
             f.create_dataset('train_src_img_path', data=np.array(src_list['img']['train'], dtype='S'))
             f.create_dataset('valid_src_img_path', data=np.array(src_list['img']['valid'], dtype='S'))
@@ -121,16 +207,16 @@ def data_preprocessing(args):
             f.create_dataset('valid_label', data=np.array(trg_list['valid']).astype(int))
 
     with h5py.File(os.path.join(save_path, 'test_' + save_name), 'w') as f:
-        f.create_dataset('test_src_input_ids', data=processed_src['test']['input_ids'])
-        f.create_dataset('test_src_attention_mask', data=processed_src['test']['attention_mask'])
+        write_token_array(f, 'test_src', processed_src['test']['input_ids'], processed_src['test']['attention_mask'],
+                          **token_array_kwargs)
         if args.task in ['translation', 'style_transfer','summarization']:
-            f.create_dataset('test_trg_input_ids', data=processed_trg['test']['input_ids'])
-            f.create_dataset('test_trg_attention_mask', data=processed_trg['test']['attention_mask'])
+            write_token_array(f, 'test_trg', processed_trg['test']['input_ids'], processed_trg['test']['attention_mask'],
+                              **token_array_kwargs)
         elif args.task in ['classification']:
             f.create_dataset('test_label', data=np.array(trg_list['test']).astype(int))
         elif args.task in ['reconstruction']:
-            f.create_dataset('test_trg_input_ids', data=processed_src['test']['input_ids'])
-            f.create_dataset('test_trg_attention_mask', data=processed_src['test']['attention_mask'])
+            write_token_array(f, 'test_trg', processed_src['test']['input_ids'], processed_src['test']['attention_mask'],
+                              **token_array_kwargs)
         elif args.task in ['multi-modal_classification']:
             f.create_dataset('test_src_img_path', data=np.array(src_list['img']['test'], dtype='S'))
 
@@ -148,11 +234,195 @@ def data_preprocessing(args):
             'trg_word2id': word2id_trg
         }
     
+    # Corpus vocabulary trimming of the pretrained tokenizer
+    if args.vocab_trimming and args.tokenizer != 'spm':
+        plm_vocab_trimming(logger, args, save_path, save_name, [src_language, trg_language])
+
     with open(os.path.join(save_path, save_name[:-5] + '_word2id.pkl'), 'wb') as f:
         pickle.dump(word2id_dict, f)
 
+    if args.preprocess_cache:
+        cache_store(args, 'processed', processed_config,
+                    [os.path.join(save_path, file_name) for file_name in \
+                     [save_name, 'test_' + save_name, save_name[:-5] + '_word2id.pkl']])
+
     write_log(logger, f'Done! ; {round((time.time()-start_time)/60, 3)}min spend')
 
+def stream_chunk_encoding(text_list: list, args, domain: str = 'src', phase: str = 'train',
+                          model_file: str = None, pool=None):
+    max_len = args.src_max_len if domain == 'src' else args.trg_max_len
+    if args.tokenizer == 'spm':
+        input_ids = pad_add(spm_encoding(model_file, text_list, args, sampling=phase == 'train'), max_len)
+        return input_ids, (input_ids != 0).astype(int)
+
+    encoded_dict = plm_encoding(text_list, args, max_len=max_len, pool=pool)
+    # BART's decoder input id need to start with 'model.config.decoder_start_token_id'
+    if args.tokenizer == 'bart' and domain == 'trg':
+        encoded_dict['input_ids'][:, 0] = 2
+    return encoded_dict['input_ids'], encoded_dict['attention_mask']
+
+def streaming_preprocessing(args):
+    """
+    Preprocess a pre-split line corpus 'stream_chunk_size' lines at a time.
+    Each chunk is tokenized and appended to the HDF5 files, so memory does not grow with the corpus size.
+    """
+
+    start_time = time.time()
+
+    #===================================#
+    #==============Logging==============#
+    #===================================#
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    handler = TqdmLoggingHandler()
+    handler.setFormatter(logging.Formatter(" %(asctime)s - %(message)s", "%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    if args.task not in ['translation', 'style_transfer', 'summarization']:
+        raise Exception('Streaming preprocessing only supports sequence-to-sequence tasks')
+
+    #===================================#
+    #===============Cache===============#
+    #===================================#
+
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+
+    if args.tokenizer == 'spm':
+        save_name = f'processed_{args.task}_{args.sentencepiece_model}_src_{args.src_vocab_size}_trg_{args.trg_vocab_size}.hdf5'
+    else:
+        save_name = f'processed_{args.task}.hdf5'
+
+    processed_config = processed_cache_config(args)
+    spm_config_dict = {domain: spm_cache_config(args, domain) for domain in ['src', 'trg']}
+
+    if args.preprocess_cache:
+        entry_path = cache_lookup(args, 'processed', processed_config)
+        if entry_path is not None:
+            cache_restore(entry_path, save_path)
+            write_log(logger, f'Preprocessed data restored from cache ({os.path.basename(entry_path)})')
+            return
+
+    #===================================#
+    #==========Tokenizer Setting========#
+    #===================================#
+
+    write_log(logger, 'Tokenizer setting...')
+
+    file_dict = raw_line_files(args)
+    src_language, trg_language = data_language(args)
+    model_file_dict, pool_dict = {'src': None, 'trg': None}, {'src': None, 'trg': None}
+
+    if args.tokenizer == 'spm':
+        # Vocabularies are trained with the first 10000 train sentences as in spm_training
+        src_head, trg_head = next(line_chunk_iter(*file_dict['train'], chunk_size=10000))
+        spm_sequence_dict = {'src': {'train': src_head}}
+        if not args.src_trg_identical:
+            spm_sequence_dict['trg'] = {'train': trg_head}
+        spm_cached_training(logger, spm_sequence_dict, args, spm_config_dict)
+
+        word2id_src, model_file_dict['src'] = spm_vocab_load(args, 'src', args.src_vocab_size)
+        word2id_trg, model_file_dict['trg'] = spm_vocab_load(args, 'src' if args.src_trg_identical else 'trg',
+                                                             args.trg_vocab_size)
+    else:
+        word2id_src = plm_tokenizer_select(args.tokenizer, src_language).get_vocab()
+        word2id_trg = plm_tokenizer_select(args.tokenizer, trg_language).get_vocab()
+        pool_dict['src'] = plm_worker_pool(args, src_language)
+        pool_dict['trg'] = plm_worker_pool(args, trg_language)
+
+    #===================================#
+    #=====Streaming Pre-processing======#
+    #===================================#
+
+    token_array_kwargs = {
+        'ragged': args.ragged_format,
+        'compression': None if args.hdf5_compression == 'none' else args.hdf5_compression
+    }
+
+    try:
+        with h5py.File(os.path.join(save_path, save_name), 'w') as f, \
+             h5py.File(os.path.join(save_path, 'test_' + save_name), 'w') as f_test:
+            for phase in ['train', 'valid', 'test']:
+                phase_start_time = time.time()
+                f_phase = f_test if phase == 'test' else f
+                appender_dict = {
+                    'src': TokenArrayAppender(f_phase, f'{phase}_src', args.src_max_len, vocab_size=len(word2id_src),
+                                              **token_array_kwargs),
+                    'trg': TokenArrayAppender(f_phase, f'{phase}_trg', args.trg_max_len, vocab_size=len(word2id_trg),
+                                              **token_array_kwargs)
+                }
+
+                line_num = 0
+                for src_chunk, trg_chunk in line_chunk_iter(*file_dict[phase], chunk_size=args.stream_chunk_size):
+                    for domain, text_list in [('src', src_chunk), ('trg', trg_chunk)]:
+                        input_ids, attention_mask = stream_chunk_encoding(text_list, args, domain=domain, phase=phase,
+                                                                          model_file=model_file_dict[domain],
+                                                                          pool=pool_dict[domain])
+                        appender_dict[domain].append(input_ids, attention_mask)
+                    line_num += len(src_chunk)
+
+                write_log(logger, f'{phase} {line_num} lines processed; '
+                                  f'{line_num / (time.time() - phase_start_time):.1f} sentences/sec')
+    finally:
+        for pool in pool_dict.values():
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    # Word2id pickle file save
+    word2id_dict = {
+        'src_language': src_language,
+        'trg_language': trg_language,
+        'src_word2id': word2id_src,
+        'trg_word2id': word2id_trg
+    }
+
+    # Corpus vocabulary trimming of the pretrained tokenizer
+    if args.vocab_trimming and args.tokenizer != 'spm':
+        plm_vocab_trimming(logger, args, save_path, save_name, [src_language, trg_language])
+
+    with open(os.path.join(save_path, save_name[:-5] + '_word2id.pkl'), 'wb') as f:
+        pickle.dump(word2id_dict, f)
+
+    if args.preprocess_cache:
+        cache_store(args, 'processed', processed_config,
+                    [os.path.join(save_path, file_name) for file_name in \
+                     [save_name, 'test_' + save_name, save_name[:-5] + '_word2id.pkl']])
+
+    write_log(logger, f'Done! ; {round((time.time()-start_time)/60, 3)}min spend')
+
+def ragged_converting(args):
+    """
+    Convert the preprocessed HDF5 files of 'data_name' and 'tokenizer' to the ragged token format
+    """
+
+    #===================================#
+    #==============Logging==============#
+    #===================================#
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    handler = TqdmLoggingHandler()
+    handler.setFormatter(logging.Formatter(" %(asctime)s - %(message)s", "%Y-%m-%d %H:%M:%S"))
+    logger.addHandler(handler)
+    logger.propagate = False
+
+    #===================================#
+    #============Converting=============#
+    #===================================#
+
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+    compression = None if args.hdf5_compression == 'none' else args.hdf5_compression
+    for file_name in sorted(os.listdir(save_path)):
+        if file_name.endswith('.hdf5') and 'processed_' in file_name:
+            start_time = time.time()
+            file_path = os.path.join(save_path, file_name)
+            before_size = os.path.getsize(file_path)
+            convert_to_ragged(file_path, compression=compression)
+            write_log(logger, f'{file_name} converted; {before_size / 1024**2:.1f}MB -> '
+                              f'{os.path.getsize(file_path) / 1024**2:.1f}MB ; {round(time.time()-start_time, 3)}sec spend')
+
 def benchmark_preprocessing(args):
 
     start_time = time.time()
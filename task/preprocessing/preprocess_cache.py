@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+# Import custom modules
+from task.preprocessing.data_load import raw_data_dir
+
+def cache_root(args: argparse.Namespace):
+    return os.path.join(args.preprocess_path, 'preprocess_cache')
+
+def raw_data_fingerprint(args: argparse.Namespace):
+    """
+    (relative path, size, modification time) of every raw data file of 'data_name'
+    """
+    data_dir = raw_data_dir(args)
+    if data_dir is None or not os.path.exists(data_dir):
+        return None
+
+    fingerprint = list()
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_stat = os.stat(os.path.join(root, file_name))
+            fingerprint.append([os.path.relpath(os.path.join(root, file_name), data_dir),
+                                file_stat.st_size, file_stat.st_mtime_ns])
+    return fingerprint
+
+def spm_cache_config(args: argparse.Namespace, domain: str = 'src'):
+    """
+    Everything the SentencePiece model of 'domain' depends on
+    """
+    return {
+        'data_name': args.data_name,
+        'raw_data': raw_data_fingerprint(args),
+        'cnn_dailymail_ver': args.cnn_dailymail_ver,
+        'with_eda': args.with_eda,
+        'src_trg_reverse': args.src_trg_reverse,
+        'seed': args.seed,
+        'domain': domain,
+        'sentencepiece_model': args.sentencepiece_model,
+        'vocab_size': args.src_vocab_size if domain == 'src' else args.trg_vocab_size,
+        'character_coverage': args.src_character_coverage if domain == 'src' else args.trg_character_coverage,
+        'special_ids': [args.pad_id, args.unk_id, args.bos_id, args.eos_id]
+    }
+
+def processed_cache_config(args: argparse.Namespace):
+    """
+    Everything the preprocessed HDF5 splits and word2id pickle depend on
+    """
+    config = spm_cache_config(args, 'src')
+    config.pop('domain')
+    config.update({
+        'task': args.task,
+        'tokenizer': args.tokenizer,
+        'src_max_len': args.src_max_len,
+        'trg_max_len': args.trg_max_len,
+        'src_trg_identical': args.src_trg_identical,
+        'ragged_format': args.ragged_format,
+        'hdf5_compression': args.hdf5_compression,
+        'vocab_trimming': args.vocab_trimming and args.tokenizer != 'spm'
+    })
+    if args.tokenizer == 'spm':
+        config['spm_src'] = spm_cache_config(args, 'src')
+        config['spm_trg'] = spm_cache_config(args, 'trg')
+    return config
+
+def cache_key(config: dict):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def cache_entry_path(args: argparse.Namespace, stage: str, config: dict):
+    return os.path.join(cache_root(args), f'{args.data_name}_{args.tokenizer}_{stage}_{cache_key(config)}')
+
+def cache_lookup(args: argparse.Namespace, stage: str, config: dict):
+    """
+    Cache entry path of 'stage' made with the same 'config', or None
+    """
+    entry_path = cache_entry_path(args, stage, config)
+    if not os.path.exists(os.path.join(entry_path, 'entry.json')):
+        return None
+    with open(os.path.join(entry_path, 'entry.json')) as f:
+        entry = json.load(f)
+    if entry['config'] != json.loads(json.dumps(config)):
+        return None
+    if not all(os.path.exists(os.path.join(entry_path, file_name)) for file_name in entry['files']):
+        return None
+    return entry_path
+
+def cache_restore(entry_path: str, save_path: str):
+    """
+    Copy the artifacts of a cache entry to 'save_path'
+    """
+    with open(os.path.join(entry_path, 'entry.json')) as f:
+        entry = json.load(f)
+    for file_name in entry['files']:
+        shutil.copy2(os.path.join(entry_path, file_name), os.path.join(save_path, file_name))
+    return entry['files']
+
+def cache_store(args: argparse.Namespace, stage: str, config: dict, file_list: list):
+    """
+    Copy the artifacts of 'stage' to a new cache entry; the entry appears only when every file is copied
+    """
+    entry_path = cache_entry_path(args, stage, config)
+    tmp_path = entry_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    for file_path in file_list:
+        shutil.copy2(file_path, os.path.join(tmp_path, os.path.basename(file_path)))
+    entry = {
+        'data_name': args.data_name,
+        'tokenizer': args.tokenizer,
+        'stage': stage,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'files': [os.path.basename(file_path) for file_path in file_list],
+        'config': config
+    }
+    with open(os.path.join(tmp_path, 'entry.json'), 'w') as f:
+        json.dump(entry, f, indent=2)
+
+    if os.path.exists(entry_path):
+        shutil.rmtree(entry_path)
+    os.replace(tmp_path, entry_path)
+    return entry_path
+
+def cache_listing(args: argparse.Namespace):
+    """
+    Print every cache entry with its stage, size and creation time
+    """
+    if not os.path.exists(cache_root(args)):
+        print('Preprocessing cache is empty')
+        return
+
+    total_size = 0
+    for entry_name in sorted(os.listdir(cache_root(args))):
+        entry_path = os.path.join(cache_root(args), entry_name)
+        if not os.path.exists(os.path.join(entry_path, 'entry.json')):
+            continue
+        with open(os.path.join(entry_path, 'entry.json')) as f:
+            entry = json.load(f)
+        entry_size = sum(os.path.getsize(os.path.join(entry_path, file_name)) for file_name in os.listdir(entry_path))
+        total_size += entry_size
+        print(f'{entry_name} | {entry["stage"]} | {entry_size / 1024**2:.1f}MB | {entry["created"]}')
+    print(f'Total: {total_size / 1024**2:.1f}MB')
+
+def cache_evicting(args: argparse.Namespace, name: str):
+    """
+    Remove cache entries whose name starts with 'name', or every entry with 'all'
+    """
+    if not os.path.exists(cache_root(args)):
+        return
+
+    for entry_name in sorted(os.listdir(cache_root(args))):
+        if name == 'all' or entry_name.startswith(name):
+            shutil.rmtree(os.path.join(cache_root(args), entry_name))
+            print(f'{entry_name} evicted')
@@ -0,0 +1,166 @@
+import os
+import h5py
+import numpy as np
+
+def write_token_array(f: h5py.File, name: str, input_ids, attention_mask,
+                      ragged: bool = False, compression: str = None, chunk_size: int = 100000):
+    """
+    Write '{name}_input_ids' and '{name}_attention_mask' padded matrices, or with 'ragged' the tokens of each row
+    without padding; '{name}_tokens' (flat buffer, uint16 if every index is under 65536),
+    '{name}_offsets' (start of each row in the buffer) and '{name}_lengths'.
+    Attention masks are not stored in the ragged format, they are derived from the lengths when loaded.
+    """
+    if isinstance(input_ids, list):
+        input_ids = np.asarray(input_ids)
+    if isinstance(attention_mask, list):
+        attention_mask = np.asarray(attention_mask)
+
+    if not ragged:
+        f.create_dataset(f'{name}_input_ids', data=input_ids, compression=compression)
+        f.create_dataset(f'{name}_attention_mask', data=attention_mask, compression=compression)
+        return
+
+    # 1) Row length, maximum token index and padding index
+    num_rows, max_len = input_ids.shape
+    lengths = np.zeros(num_rows, dtype=np.int32)
+    max_token, pad_idx = 0, None
+    for start in range(0, num_rows, chunk_size):
+        ids = np.asarray(input_ids[start:start + chunk_size])
+        mask = np.asarray(attention_mask[start:start + chunk_size]).astype(bool)
+        lengths[start:start + chunk_size] = mask.sum(axis=1)
+        if not (mask == (np.arange(max_len) < lengths[start:start + chunk_size, None])).all():
+            raise Exception('Ragged format needs right padded sequences')
+        if mask.any():
+            max_token = max(max_token, int(ids[mask].max()))
+        if pad_idx is None and not mask.all():
+            pad_idx = int(ids[~mask][0])
+    offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    # 2) Flat token buffer
+    token_dtype = np.uint16 if max_token < 2 ** 16 else np.int32
+    tokens = f.create_dataset(f'{name}_tokens', shape=(int(offsets[-1]),), dtype=token_dtype,
+                              compression=compression)
+    tokens.attrs['max_len'] = max_len
+    tokens.attrs['pad_idx'] = 0 if pad_idx is None else pad_idx
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        ids = np.asarray(input_ids[start:end])
+        mask = np.asarray(attention_mask[start:end]).astype(bool)
+        tokens[offsets[start]:offsets[end]] = ids[mask].astype(token_dtype)
+    f.create_dataset(f'{name}_offsets', data=offsets, compression=compression)
+    f.create_dataset(f'{name}_lengths', data=lengths, compression=compression)
+
+class TokenArrayAppender(object):
+    """
+    Token arrays of 'name' which grow as rows are appended, in the same layout as write_token_array.
+    The ragged token buffer is uint16 if 'vocab_size' is not larger than 65536.
+    """
+    def __init__(self, f: h5py.File, name: str, max_len: int, vocab_size: int = None,
+                 ragged: bool = False, compression: str = None):
+        self.max_len = max_len
+        self.ragged = ragged
+        self.pad_idx = None
+        self.num_rows, self.num_tokens = 0, 0
+        if not ragged:
+            self.input_ids = f.create_dataset(f'{name}_input_ids', shape=(0, max_len), maxshape=(None, max_len),
+                                              dtype=np.int32, chunks=True, compression=compression)
+            self.attention_mask = f.create_dataset(f'{name}_attention_mask', shape=(0, max_len), maxshape=(None, max_len),
+                                                   dtype=np.int32, chunks=True, compression=compression)
+            return
+
+        token_dtype = np.uint16 if vocab_size is not None and vocab_size <= 2 ** 16 else np.int32
+        self.tokens = f.create_dataset(f'{name}_tokens', shape=(0,), maxshape=(None,), dtype=token_dtype,
+                                       chunks=True, compression=compression)
+        self.tokens.attrs['max_len'] = max_len
+        self.tokens.attrs['pad_idx'] = 0
+        self.offsets = f.create_dataset(f'{name}_offsets', data=np.zeros(1, dtype=np.int64), maxshape=(None,),
+                                        chunks=True, compression=compression)
+        self.lengths = f.create_dataset(f'{name}_lengths', shape=(0,), maxshape=(None,), dtype=np.int32,
+                                        chunks=True, compression=compression)
+
+    def append(self, input_ids, attention_mask):
+        input_ids = np.asarray(input_ids)
+        attention_mask = np.asarray(attention_mask)
+        num_rows = self.num_rows
+        new_rows = num_rows + len(input_ids)
+        self.num_rows = new_rows
+
+        if not self.ragged:
+            self.input_ids.resize(new_rows, axis=0)
+            self.attention_mask.resize(new_rows, axis=0)
+            self.input_ids[num_rows:] = input_ids
+            self.attention_mask[num_rows:] = attention_mask
+            return
+
+        mask = attention_mask.astype(bool)
+        lengths = mask.sum(axis=1)
+        if not (mask == (np.arange(self.max_len) < lengths[:, None])).all():
+            raise Exception('Ragged format needs right padded sequences')
+        if self.pad_idx is None and not mask.all():
+            self.pad_idx = int(input_ids[~mask][0])
+            self.tokens.attrs['pad_idx'] = self.pad_idx
+
+        start = self.num_tokens
+        self.num_tokens += int(lengths.sum())
+        if self.num_tokens > start:
+            self.tokens.resize(self.num_tokens, axis=0)
+            self.tokens[start:] = input_ids[mask].astype(self.tokens.dtype)
+        self.offsets.resize(new_rows + 1, axis=0)
+        self.offsets[num_rows + 1:] = start + np.cumsum(lengths)
+        self.lengths.resize(new_rows, axis=0)
+        self.lengths[num_rows:] = lengths
+
+def split_token_key(key: str):
+    # 'train_src_input_ids' -> ('train_src', 'input_ids')
+    for field in ['input_ids', 'attention_mask']:
+        if key.endswith(f'_{field}'):
+            return key[:-len(field) - 1], field
+    raise Exception(f'{key} is not a token array')
+
+def token_array_info(f: h5py.File, key: str):
+    """
+    Shape and dtype of the padded array of 'key' in either format
+    """
+    if key in f:
+        return f[key].shape, f[key].dtype
+    name, _ = split_token_key(key)
+    return (len(f[f'{name}_lengths']), int(f[f'{name}_tokens'].attrs['max_len'])), np.dtype(np.int32)
+
+def read_token_array(f: h5py.File, key: str, start: int = 0, end: int = None):
+    """
+    Padded rows [start:end] of 'key' ('{name}_input_ids' or '{name}_attention_mask') in either format
+    """
+    if key in f:
+        return f[key][start:end]
+
+    name, field = split_token_key(key)
+    tokens = f[f'{name}_tokens']
+    lengths = f[f'{name}_lengths'][start:end]
+    end = start + len(lengths)
+    mask = np.arange(tokens.attrs['max_len']) < lengths[:, None] # (rows, max_len)
+    if field == 'attention_mask':
+        return mask.astype(np.int32)
+
+    offsets = f[f'{name}_offsets']
+    input_ids = np.full(mask.shape, tokens.attrs['pad_idx'], dtype=np.int32)
+    input_ids[mask] = tokens[offsets[start]:offsets[end]]
+    return input_ids
+
+def convert_to_ragged(hdf5_file: str, compression: str = None):
+    """
+    Convert a preprocessed HDF5 file of padded matrices to the ragged format in place.
+    Other arrays (labels, image paths) are copied as they are.
+    """
+    tmp_file = hdf5_file + '.tmp'
+    with h5py.File(hdf5_file, 'r') as f, h5py.File(tmp_file, 'w') as f_out:
+        for key in f.keys():
+            if key.endswith('_input_ids') and key.replace('_input_ids', '_attention_mask') in f:
+                name, _ = split_token_key(key)
+                write_token_array(f_out, name, f[key], f[f'{name}_attention_mask'],
+                                  ragged=True, compression=compression)
+            elif key.endswith('_attention_mask') and key.replace('_attention_mask', '_input_ids') in f:
+                continue
+            else:
+                f.copy(f[key], f_out)
+    os.replace(tmp_file, hdf5_file)
@@ -1,32 +1,21 @@
 import argparse
-from transformers import  BertTokenizer, BartTokenizerFast, T5Tokenizer
+import numpy as np
+from multiprocessing import Pool
+from transformers import BertTokenizerFast, BartTokenizerFast, T5TokenizerFast
 
 from datasets import load_dataset
 
-def plm_tokenizing(sequence_dict: dict, args: argparse.Namespace, 
-                    domain: str = 'src', language: str = 'en'):
-
-    # 1) Pre-setting
-    processed_sequences = dict()
-    processed_sequences['train'] = dict()
-    processed_sequences['valid'] = dict()
-    processed_sequences['test'] = dict()
-
-    if domain == 'src':
-        max_len = args.src_max_len
-    if domain == 'trg':
-        max_len = args.trg_max_len
-
-    if args.tokenizer == 'bert':
+def plm_tokenizer_select(tokenizer_type: str = 'bert', language: str = 'en'):
+    if tokenizer_type == 'bert':
         if language == 'en':
-            tokenizer =  BertTokenizer.from_pretrained('bert-base-cased')
+            tokenizer = BertTokenizerFast.from_pretrained('bert-base-cased')
         elif language == 'kr':
-            tokenizer =  BertTokenizer.from_pretrained('beomi/kcbert-base')
+            tokenizer = BertTokenizerFast.from_pretrained('beomi/kcbert-base')
         elif language == 'de':
-            tokenizer = BertTokenizer.from_pretrained('bert-base-german-cased')
+            tokenizer = BertTokenizerFast.from_pretrained('bert-base-german-cased')
         else:
             raise Exception(f'{language} language does not support')
-    elif args.tokenizer == 'bart':
+    elif tokenizer_type == 'bart':
         if language == 'en':
             tokenizer = BartTokenizerFast.from_pretrained('facebook/bart-large')
         elif language =='kr':
@@ -35,34 +24,79 @@ def plm_tokenizing(sequence_dict: dict, args: argparse.Namespace,
             tokenizer = BartTokenizerFast.from_pretrained('Shahm/bart-german')
         else:
             raise Exception(f'{language} language does not support')
-    elif args.tokenizer == 'T5':
+    elif tokenizer_type == 'T5':
         if language == 'en':
-            tokenizer = T5Tokenizer.from_pretrained("t5-base")
+            tokenizer = T5TokenizerFast.from_pretrained('t5-base')
         elif language == 'kr':
-            tokenizer = T5Tokenizer.from_pretrained('KETI-AIR/ke-t5-base')
+            tokenizer = T5TokenizerFast.from_pretrained('KETI-AIR/ke-t5-base')
         elif language == 'de':
-            tokenizer = T5Tokenizer.from_pretrained('t5-base')
+            tokenizer = T5TokenizerFast.from_pretrained('t5-base')
         else:
             raise Exception(f'{language} language does not support')
+    return tokenizer
+
+# Tokenizer of each worker process
+worker_tokenizer = None
+
+def init_worker_tokenizer(tokenizer_type: str, language: str):
+    global worker_tokenizer
+    worker_tokenizer = plm_tokenizer_select(tokenizer_type, language)
+
+def plm_encode_chunk(text_list: list, max_len: int):
+    encoded_dict = worker_tokenizer(text_list, max_length=max_len, padding='max_length',
+                                    truncation=True, return_tensors='np')
+    return dict(encoded_dict)
+
+def plm_worker_pool(args: argparse.Namespace, language: str = 'en', num_workers: int = None):
+    num_workers = args.tokenizing_workers if num_workers is None else num_workers
+    return Pool(max(1, num_workers), initializer=init_worker_tokenizer, initargs=(args.tokenizer, language))
+
+def plm_encoding(text_list: list, args: argparse.Namespace, language: str = 'en', max_len: int = 300,
+                 chunk_size: int = 10000, pool=None):
+    """
+    Encode sentences with the fast tokenizer in 'tokenizing_workers' processes, 'chunk_size' sentences per call.
+    Returns numpy arrays of (sentence_num, max_len) for each output of the tokenizer.
+    A pool made by plm_worker_pool can be given to keep the tokenizers loaded between calls.
+    """
+    text_list = list(text_list)
+    chunk_list = [text_list[i:i + chunk_size] for i in range(0, len(text_list), chunk_size)]
+    if pool is not None:
+        encoded_list = pool.starmap(plm_encode_chunk, [(chunk, max_len) for chunk in chunk_list])
+    else:
+        with plm_worker_pool(args, language, min(args.tokenizing_workers, len(chunk_list))) as pool:
+            encoded_list = pool.starmap(plm_encode_chunk, [(chunk, max_len) for chunk in chunk_list])
+    if not encoded_list:
+        return {'input_ids': np.zeros((0, max_len), dtype=np.int64),
+                'attention_mask': np.zeros((0, max_len), dtype=np.int64)}
+    return {key: np.concatenate([encoded[key] for encoded in encoded_list]) for key in encoded_list[0]}
+
+def plm_tokenizing(sequence_dict: dict, args: argparse.Namespace, 
+                    domain: str = 'src', language: str = 'en'):
+
+    # 1) Pre-setting
+    processed_sequences = dict()
+    processed_sequences['train'] = dict()
+    processed_sequences['valid'] = dict()
+    processed_sequences['test'] = dict()
+
+    if domain == 'src':
+        max_len = args.src_max_len
+    if domain == 'trg':
+        max_len = args.trg_max_len
 
     for phase in ['train', 'valid', 'test']:
-        encoded_dict = \
-        tokenizer(
-            sequence_dict[phase],
-            max_length=max_len,
-            padding='max_length',
-            truncation=True
-        )
+        encoded_dict = plm_encoding(sequence_dict[phase], args, language=language, max_len=max_len)
         processed_sequences[phase]['input_ids'] = encoded_dict['input_ids']
         processed_sequences[phase]['attention_mask'] = encoded_dict['attention_mask']
         if args.tokenizer == 'bert':
             processed_sequences[phase]['token_type_ids'] = encoded_dict['token_type_ids']
 
-    # BART's decoder input id need to start with 'model.config.decoder_start_token_id'
-    if args.tokenizer == 'bart' and domain == 'trg':
-        for i in range(len(processed_sequences[phase]['input_ids'])):
-            processed_sequences[phase]['input_ids'][i][0] = 2
-    
+        # BART's decoder input id need to start with 'model.config.decoder_start_token_id'
+        if args.tokenizer == 'bart' and domain == 'trg':
+            processed_sequences[phase]['input_ids'][:, 0] = 2
+
+    # Tokenizer of the main process is loaded after the worker processes are forked
+    tokenizer = plm_tokenizer_select(args.tokenizer, language)
     word2id = tokenizer.get_vocab()
 
     return processed_sequences, word2id
@@ -82,18 +116,6 @@ def benchmark_plm_tokenizing(dataset, args, domain='src', language='en'):
     if domain == 'trg':
         max_len = args.trg_max_len
 
-    if args.tokenizer == 'bert':
-        if language == 'en':
-            tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
-    elif args.tokenizer == 'bart':
-        if language == 'en':
-            tokenizer = BartTokenizer.from_pretrained('facebook/bart-base')
-    elif args.tokenizer == 'T5':
-        if language == 'en':
-            tokenizer = T5Tokenizer.from_pretrained('t5-base')
-    else:
-        raise Exception(f'{language} language does not support')
-
     for phase in dataset.keys():
         for key in dataset[phase].column_names:
 
@@ -101,27 +123,17 @@ def benchmark_plm_tokenizing(dataset, args, domain='src', language='en'):
             if key in ['label','idx','start1','start2','end1','end2','span1_index','span2_index']:
                 processed_sequences[phase][key] = dataset[phase][key]
             else:
-                
-                encoded_dict = \
-                        tokenizer(
-                                dataset[phase][key],
-                                max_length=max_len,
-                                padding='max_length',
-                                truncation=True
-                                )
-
-                
+                encoded_dict = plm_encoding(dataset[phase][key], args, language=language, max_len=max_len)
+
                 processed_sequences[phase][key]['input_ids'] = encoded_dict['input_ids']
                 processed_sequences[phase][key]['attention_mask'] = encoded_dict['attention_mask']
                 if args.tokenizer == 'bert':
                     processed_sequences[phase][key]['token_type_ids'] = encoded_dict['token_type_ids']
 
+                if args.tokenizer == 'bart' and domain == 'trg':
+                    processed_sequences[phase][key]['input_ids'][:, 0] = 2
 
-    if args.tokenizer == 'bart' and domain == 'trg':
-        for i in range(len(processed_sequences[phase]['input_ids'])):
-            processed_sequences[phase]['input_ids'][i][0] = 2
-
+    tokenizer = plm_tokenizer_select(args.tokenizer, language)
     word2id = tokenizer.get_vocab()
 
     return processed_sequences, word2id
-
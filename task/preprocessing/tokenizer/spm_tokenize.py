@@ -3,21 +3,96 @@ import argparse
 import numpy as np
 import sentencepiece as spm
 from tqdm import tqdm
+from itertools import chain
+from multiprocessing import Pool
 
 import datasets
 
 def pad_add(list_, max_len: int = 300):
-    ind_list = list()
-    for ind_ in list_:
-        if len(ind_) <= max_len:
-            ind = np.zeros(max_len, dtype=np.int32)
-            ind[:len(ind_)] = np.array(ind_, dtype=np.int32)
-            ind_list.append(ind)
-        else:
-            ind_list.append(ind_[:max_len])
-    return np.array(ind_list, dtype=np.int32)
-
-def spm_tokenizing(sequence_dict: dict,  args: argparse.Namespace, domain: str ='src', src_trg_identical: bool = False):
+    """
+    Pad index lists with 0 (or cut them) to 'max_len' with one numpy assignment
+    """
+    lengths = np.fromiter((len(ind_) for ind_ in list_), dtype=np.int64, count=len(list_))
+    flat = np.fromiter(chain.from_iterable(list_), dtype=np.int32, count=int(lengths.sum()))
+    # Position of each index in its list
+    position = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    ind_array = np.zeros((len(list_), max_len), dtype=np.int32)
+    ind_array[np.arange(max_len) < np.minimum(lengths, max_len)[:, None]] = flat[position < max_len]
+    return ind_array
+
+def spm_training(sequence_dict: dict, args: argparse.Namespace, domain: str = 'src'):
+    """
+    Train SentencePiece model of 'domain' with the first 10000 train sentences
+    """
+    preprocess_save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+
+    if domain == 'src':
+        vocab_size = args.src_vocab_size
+        character_coverage = args.src_character_coverage
+    if domain == 'trg':
+        vocab_size = args.trg_vocab_size
+        character_coverage = args.trg_character_coverage
+
+    # Make text to train vocab
+    with open(f'{preprocess_save_path}/{domain}.txt', 'w') as f:
+        for text in sequence_dict['train'][:10000]:
+            f.write(f'{text}\n')
+
+    spm.SentencePieceProcessor()
+    spm.SentencePieceTrainer.Train(
+        f'--input={preprocess_save_path}/{domain}.txt --model_type={args.sentencepiece_model} '
+        f'--model_prefix={preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size} '
+        f'--vocab_size={vocab_size} --character_coverage={character_coverage} '
+        f'--pad_id={args.pad_id} --unk_id={args.unk_id} --bos_id={args.bos_id} --eos_id={args.eos_id} '
+        f'--split_by_whitespace=true --user_defined_symbols=[SEP]')
+
+def spm_encode_shard(model_file: str, text_list: list, bos_id: int, eos_id: int,
+                     sampling: bool = False, seed: int = None):
+    spm_model = spm.SentencePieceProcessor()
+    spm_model.Load(model_file)
+    if sampling:
+        # Sampling is reproducible for the same shard and seed
+        if seed is not None:
+            spm.set_random_generator_seed(seed)
+        return [[bos_id] + spm_model.encode(text, enable_sampling=True, alpha=0.1, nbest_size=-1, out_type=int) + \
+                [eos_id] for text in text_list]
+    return [[bos_id] + ids + [eos_id] for ids in spm_model.encode(text_list, out_type=int)]
+
+def spm_encoding(model_file: str, text_list: list, args: argparse.Namespace, sampling: bool = False):
+    """
+    Encode sentences with bos and eos token in 'tokenizing_workers' processes.
+    Shard i of the sampling encoding uses 'seed + i' as its random seed.
+    """
+    num_workers = max(1, min(args.tokenizing_workers, len(text_list)))
+    shard_size = -(-len(text_list) // num_workers)
+    shard_list = [text_list[i:i + shard_size] for i in range(0, len(text_list), shard_size)]
+    seed_list = [None if args.seed is None else args.seed + i for i in range(len(shard_list))]
+    if len(shard_list) <= 1:
+        return spm_encode_shard(model_file, text_list, args.bos_id, args.eos_id, sampling, seed_list[0] if seed_list else None)
+
+    with Pool(num_workers) as pool:
+        encoded_list = pool.starmap(spm_encode_shard,
+                                    [(model_file, shard, args.bos_id, args.eos_id, sampling, seed) \
+                                     for shard, seed in zip(shard_list, seed_list)])
+    return list(chain.from_iterable(encoded_list))
+
+def spm_vocab_load(args: argparse.Namespace, domain: str = 'src', vocab_size: int = 24000):
+    """
+    word2id and model file path of the trained SentencePiece model of 'domain'
+    """
+    preprocess_save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+
+    vocab_list = list()
+    with open(f'{preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size}.vocab') as f:
+        for line in f:
+            vocab_list.append(line[:-1].split('\t')[0])
+
+    word2id = {w: i for i, w in enumerate(vocab_list)}
+    model_file = f'{preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size}.model'
+    return word2id, model_file
+
+def spm_tokenizing(sequence_dict: dict,  args: argparse.Namespace, domain: str ='src', src_trg_identical: bool = False,
+                   vocab_trained: bool = False):
 
     # 0) Path Setting
     if not os.path.exists(os.path.join(args.preprocess_path, args.data_name)):
@@ -35,50 +110,22 @@ def spm_tokenizing(sequence_dict: dict,  args: argparse.Namespace, domain: str =
 
     if domain == 'src':
         vocab_size = args.src_vocab_size
-        character_coverage = args.src_character_coverage
         max_len = args.src_max_len
     if domain == 'trg':
         vocab_size = args.trg_vocab_size
-        character_coverage = args.trg_character_coverage
         max_len = args.trg_max_len
 
-    # Make text to train vocab
-    with open(f'{preprocess_save_path}/{domain}.txt', 'w') as f:
-        for text in sequence_dict['train'][:10000]:
-            f.write(f'{text}\n')
-
     if src_trg_identical:
         domain = 'src'
-    else:
-        spm.SentencePieceProcessor()
-        spm.SentencePieceTrainer.Train(
-            f'--input={preprocess_save_path}/{domain}.txt --model_type={args.sentencepiece_model} '
-            f'--model_prefix={preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size} '
-            f'--vocab_size={vocab_size} --character_coverage={character_coverage} '
-            f'--pad_id={args.pad_id} --unk_id={args.unk_id} --bos_id={args.bos_id} --eos_id={args.eos_id} '
-            f'--split_by_whitespace=true --user_defined_symbols=[SEP]')
+    elif not vocab_trained:
+        spm_training(sequence_dict, args, domain=domain)
 
-    vocab_list = list()
-    with open(f'{preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size}.vocab') as f:
-        for line in f:
-            vocab_list.append(line[:-1].split('\t')[0])
-
-    word2id = {w: i for i, w in enumerate(vocab_list)}
-    spm_src = spm.SentencePieceProcessor()
-    spm_src.Load(f'{preprocess_save_path}/m_{domain}_{args.sentencepiece_model}_{vocab_size}.model')
+    word2id, model_file = spm_vocab_load(args, domain, vocab_size)
 
     # Encoding
-    train_src_input_ids = list(
-        [args.bos_id] + spm_src.encode(
-                            text, enable_sampling=True, alpha=0.1, nbest_size=-1, out_type=int) + \
-        [args.eos_id] for text in sequence_dict['train']
-    )
-    valid_src_input_ids = list(
-        [args.bos_id] + spm_src.encode(text, out_type=int) + [args.eos_id] for text in sequence_dict['valid']
-    )
-    test_src_input_ids = list(
-        [args.bos_id] + spm_src.encode(text, out_type=int) + [args.eos_id] for text in sequence_dict['test']
-    )
+    train_src_input_ids = spm_encoding(model_file, sequence_dict['train'], args, sampling=True)
+    valid_src_input_ids = spm_encoding(model_file, sequence_dict['valid'], args)
+    test_src_input_ids = spm_encoding(model_file, sequence_dict['test'], args)
 
     # Pad token add
     processed_sequences['train']['input_ids'] = pad_add(train_src_input_ids, max_len)
@@ -86,43 +133,15 @@ def spm_tokenizing(sequence_dict: dict,  args: argparse.Namespace, domain: str =
     processed_sequences['test']['input_ids'] = pad_add(test_src_input_ids, max_len)
 
     # Attention mask encoding
-    processed_sequences['train']['attention_mask'] = list()
-    processed_sequences['valid']['attention_mask'] = list()
-    processed_sequences['test']['attention_mask'] = list()
-
-    for ind in processed_sequences['train']['input_ids']:
-        processed_sequences['train']['attention_mask'].append((ind != 0).astype(int))
-    for ind in processed_sequences['valid']['input_ids']:
-        processed_sequences['valid']['attention_mask'].append((ind != 0).astype(int))
-    for ind in processed_sequences['test']['input_ids']:
-        processed_sequences['test']['attention_mask'].append((ind != 0).astype(int))
+    processed_sequences['train']['attention_mask'] = (processed_sequences['train']['input_ids'] != 0).astype(int)
+    processed_sequences['valid']['attention_mask'] = (processed_sequences['valid']['input_ids'] != 0).astype(int)
+    processed_sequences['test']['attention_mask'] = (processed_sequences['test']['input_ids'] != 0).astype(int)
 
     # Segment encoding
-    # processed_sequences['train']['token_type_ids'] = list()
-    # processed_sequences['valid']['token_type_ids'] = list()
-    # processed_sequences['test']['token_type_ids'] = list()
     processed_sequences['train']['token_type_ids'] = None
     processed_sequences['valid']['token_type_ids'] = None
     processed_sequences['test']['token_type_ids'] = None
 
-    # for ind in processed_sequences['train']['input_ids']:
-    #     print(ind)
-    #     ind = list(ind)
-    #     print(ind)
-    #     token_type_ids_ = [0 if i <= ind.index(4) else 1 for i in range(len(ind))]
-    #     token_type_ids_ = token_type_ids_ + [0 for _ in range(args.max_len - len(ind))]
-    #     processed_sequences['train']['token_type_ids'].append(token_type_ids_)
-    # for ind in processed_sequences['valid']['input_ids']:
-    #     ind = list(ind)
-    #     token_type_ids_ = [0 if i <= ind.index(4) else 1 for i in range(len(ind))]
-    #     token_type_ids_ = token_type_ids_ + [0 for _ in range(args.max_len - len(ind))]
-    #     processed_sequences['valid']['token_type_ids'].append(token_type_ids_)
-    # for ind in processed_sequences['test']['input_ids']:
-    #     ind = list(ind)
-    #     token_type_ids_ = [0 if i <= ind.index(4) else 1 for i in range(len(ind))]
-    #     token_type_ids_ = token_type_ids_ + [0 for _ in range(args.max_len - len(ind))]
-    #     processed_sequences['test']['token_type_ids'].append(token_type_ids_)
-
     return processed_sequences, word2id
 
 def benchmark_spm_tokenizing(dataset: datasets.dataset_dict.DatasetDict,  args: argparse.Namespace, domain='src'):
@@ -187,8 +206,7 @@ def benchmark_spm_tokenizing(dataset: datasets.dataset_dict.DatasetDict,  args:
                         [args.bos_id] + spm_src.encode(text, out_type=int) + [args.eos_id] for text in dataset[phase][key])
     
                 processed_sequences[phase][key]['input_ids'] = pad_add(source, max_len)
-                processed_sequences[phase][key]['attention_mask'] = list()
-                for ind in processed_sequences[phase][key]['input_ids']:
-                    processed_sequences[phase][key]['attention_mask'].append((ind != 0).astype(int))
+                processed_sequences[phase][key]['attention_mask'] = \
+                    (processed_sequences[phase][key]['input_ids'] != 0).astype(int)
 
     return processed_sequences, word2id
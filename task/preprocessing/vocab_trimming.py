@@ -0,0 +1,54 @@
+import h5py
+import numpy as np
+
+def token_array_keys(f: h5py.File):
+    # Token index arrays of either format; padded '{name}_input_ids' or ragged '{name}_tokens'
+    return [key for key in f.keys() if key.endswith('_input_ids') or key.endswith('_tokens')]
+
+def used_token_ids(hdf5_files: list, chunk_size: int = 100000):
+    """
+    Boolean array of the token indices which appear in any token array of 'hdf5_files'.
+    The padding index of a ragged array is used as well since it is not in its token buffer.
+    """
+    used = np.zeros(0, dtype=bool)
+    def mark(ids):
+        nonlocal used
+        ids = np.unique(ids)
+        if len(ids) > 0 and ids[-1] >= len(used):
+            used = np.pad(used, (0, int(ids[-1]) + 1 - len(used)))
+        used[ids] = True
+
+    for hdf5_file in hdf5_files:
+        with h5py.File(hdf5_file, 'r') as f:
+            for key in token_array_keys(f):
+                if 'pad_idx' in f[key].attrs:
+                    mark([f[key].attrs['pad_idx']])
+                for start in range(0, f[key].shape[0], chunk_size):
+                    mark(f[key][start:start + chunk_size])
+    return used
+
+def vocab_trimming(hdf5_files: list, special_ids: list = [], chunk_size: int = 100000):
+    """
+    Keep the token indices used in the preprocessed splits and the special token indices,
+    and remap the token arrays of 'hdf5_files' in place to 0, 1, ... in the original index order.
+    The kept original indices are saved as 'vocab_map' in every file; new index i is the original index vocab_map[i].
+    """
+    used = used_token_ids(hdf5_files, chunk_size)
+    if len(special_ids) > 0 and max(special_ids) >= len(used):
+        used = np.pad(used, (0, max(special_ids) + 1 - len(used)))
+    used[special_ids] = True
+    vocab_map = np.nonzero(used)[0]
+    new_index = np.zeros(len(used), dtype=np.int64)
+    new_index[vocab_map] = np.arange(len(vocab_map))
+
+    for hdf5_file in hdf5_files:
+        with h5py.File(hdf5_file, 'r+') as f:
+            if 'vocab_map' in f:
+                raise Exception(f'{hdf5_file} is already trimmed')
+            for key in token_array_keys(f):
+                for start in range(0, f[key].shape[0], chunk_size):
+                    f[key][start:start + chunk_size] = new_index[f[key][start:start + chunk_size]]
+                if 'pad_idx' in f[key].attrs:
+                    f[key].attrs['pad_idx'] = new_index[f[key].attrs['pad_idx']]
+            f.create_dataset('vocab_map', data=vocab_map)
+    return vocab_map
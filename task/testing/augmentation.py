@@ -20,7 +20,7 @@ from model.custom_transformer.transformer import Transformer
 from model.custom_plm.T5 import custom_T5
 from model.custom_plm.bart import custom_Bart
 from utils import TqdmLoggingHandler, write_log, get_tb_exp_name
-from task.utils import model_save_name, results_save_name
+from task.utils import model_save_name, results_save_name, load_hdf5_array
 
 def seq2seq_testing(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -57,11 +57,11 @@ def seq2seq_testing(args):
         save_name = f'processed_{args.task}_{args.tokenizer}.hdf5'
 
     with h5py.File(os.path.join(save_path, save_name), 'r') as f:
-        train_src_input_ids = f.get('train_src_input_ids')[:]
-        train_src_attention_mask = f.get('train_src_attention_mask')[:]
+        train_src_input_ids = load_hdf5_array(f, 'train_src_input_ids', args.lazy_loading)
+        train_src_attention_mask = load_hdf5_array(f, 'train_src_attention_mask', args.lazy_loading)
         if args.task in ['translation', 'style_transfer', 'summarization']:
-            train_trg_input_ids = f.get('train_trg_input_ids')[:]
-            train_trg_attention_mask = f.get('train_trg_attention_mask')[:]
+            train_trg_input_ids = load_hdf5_array(f, 'train_trg_input_ids', args.lazy_loading)
+            train_trg_attention_mask = load_hdf5_array(f, 'train_trg_attention_mask', args.lazy_loading)
 
     with open(os.path.join(save_path, save_name[:-5] + '_word2id.pkl'), 'rb') as f:
         data_ = pickle.load(f)
@@ -4,6 +4,7 @@ import gc
 import h5py
 import pickle
 import logging
+from time import time
 import pandas as pd
 import sentencepiece as spm
 from tqdm import tqdm
@@ -20,7 +21,7 @@ from model.custom_transformer.transformer import Transformer
 from model.custom_plm.T5 import custom_T5
 from model.custom_plm.bart import custom_Bart
 from utils import TqdmLoggingHandler, write_log, get_tb_exp_name
-from task.utils import model_save_name, results_save_name
+from task.utils import model_save_name, results_save_name, dataloader_select, load_hdf5_array
 
 def seq2seq_testing(args):
 
@@ -58,11 +59,13 @@ def seq2seq_testing(args):
         save_name = f'processed_{args.task}_{args.tokenizer}.hdf5'
 
     with h5py.File(os.path.join(save_path, 'test_' + save_name), 'r') as f:
-        test_src_input_ids = f.get('test_src_input_ids')[:]
-        test_src_attention_mask = f.get('test_src_attention_mask')[:]
+        # Original token index of each index of a trimmed vocabulary
+        vocab_map = f['vocab_map'][:] if 'vocab_map' in f else None
+        test_src_input_ids = load_hdf5_array(f, 'test_src_input_ids', args.lazy_loading)
+        test_src_attention_mask = load_hdf5_array(f, 'test_src_attention_mask', args.lazy_loading)
         if args.task in ['translation', 'style_transfer', 'summarization']:
-            test_trg_input_ids = f.get('test_trg_input_ids')[:]
-            test_trg_attention_mask = f.get('test_trg_attention_mask')[:]
+            test_trg_input_ids = load_hdf5_array(f, 'test_trg_input_ids', args.lazy_loading)
+            test_trg_attention_mask = load_hdf5_array(f, 'test_trg_attention_mask', args.lazy_loading)
         elif args.task in ['multi-modal_classification']:
             test_src_img_path = f.get('test_src_img_path')[:]
 
@@ -75,6 +78,9 @@ def seq2seq_testing(args):
             trg_id2word = {v: k for k, v in trg_word2id.items()}
             trg_vocab_num = len(trg_word2id)
         del data_
+    if vocab_map is not None:
+        src_vocab_num = len(vocab_map)
+        trg_vocab_num = len(vocab_map)
 
     gc.enable()
     write_log(logger, "Finished loading data!")
@@ -96,6 +102,14 @@ def seq2seq_testing(args):
         variational_mode_dict['latent_add_encoder_out'] = args.latent_add_encoder_out
         variational_mode_dict['z_var'] = args.z_var
         variational_mode_dict['d_latent'] = args.d_latent
+        variational_mode_dict['trg_encoder_mode'] = args.trg_encoder_mode
+
+    # Output head weights and token order are loaded from the checkpoint
+    output_head_dict = dict()
+    if args.output_head != 'softmax':
+        output_head_dict['output_head'] = args.output_head
+        output_head_dict['adaptive_cutoffs'] = args.adaptive_cutoffs
+        output_head_dict['num_sampled'] = args.num_sampled
 
     if args.model_type == 'custom_transformer':
         model = Transformer(task=args.task,
@@ -111,7 +125,7 @@ def seq2seq_testing(args):
                             emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing, 
                             variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
-                            parallel=args.parallel)
+                            parallel=args.parallel, output_head_dict=output_head_dict)
         tgt_subsqeunt_mask = model.generate_square_subsequent_mask(args.trg_max_len - 1, device)
     # elif args.model_type == 'T5':
     #     model = custom_T5(isPreTrain=args.isPreTrain, d_latent=args.d_latent, 
@@ -123,7 +137,8 @@ def seq2seq_testing(args):
                             isPreTrain=args.isPreTrain, variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            output_head_dict=output_head_dict, vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     elif args.model_type == 'bert':
         model = custom_Bert(task=args.task, num_class=128, # Need to refactoring
@@ -131,7 +146,8 @@ def seq2seq_testing(args):
                             src_language=src_language,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     model = model.to(device)
 
@@ -146,8 +162,8 @@ def seq2seq_testing(args):
                                   trg_list=test_trg_input_ids, trg_att_list=test_trg_attention_mask,
                                   src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
                                   pad_idx=model.pad_idx, eos_idx=model.eos_idx)
-    test_dataloader = DataLoader(test_dataset, drop_last=False, batch_size=args.test_batch_size, shuffle=False,
-                                 pin_memory=True, num_workers=args.num_workers)
+    test_dataloader = dataloader_select(test_dataset, args, batch_size=args.test_batch_size,
+                                        shuffle=False, drop_last=False)
     write_log(logger, f"Total number of trainingsets  iterations - {len(test_dataset)}, {len(test_dataloader)}")
 
     # 3) Load tokenizer
@@ -169,6 +185,8 @@ def seq2seq_testing(args):
     #source_tokens = []
     predicted_tokens = []
     target_tokens = []
+    generated_token_num = 0
+    decoding_time = 0
 
     #===================================#
     #============Inference==============#
@@ -188,13 +206,28 @@ def seq2seq_testing(args):
             trg_sequence = trg_sequence.to(device, non_blocking=True)
             trg_att = trg_att.to(device, non_blocking=True)
 
+            start_time = time()
             predicted = model.generate(src_sequence, src_att, 
                                        beam_size=args.beam_size, beam_alpha=args.beam_alpha, 
-                                       repetition_penalty=args.repetition_penalty, device=device)
+                                       repetition_penalty=args.repetition_penalty, device=device,
+                                       incremental_decoding=args.incremental_decoding,
+                                       max_len_a=args.max_len_a, max_len_b=args.max_len_b,
+                                       no_repeat_ngram_size=args.no_repeat_ngram_size,
+                                       min_len=args.min_decoding_len,
+                                       latent_sampling=args.latent_sampling,
+                                       latent_seed=None if args.seed is None else args.seed + i)
+            decoding_time += time() - start_time
+            generated_token_num += sum([len(predicted_sequence) for predicted_sequence in predicted])
+
+            src_seq_list = src_sequence.cpu().tolist()
+            trg_seq_list = trg_sequence.cpu().tolist()
+            # Tokenizer indices of a trimmed vocabulary for decoding
+            if vocab_map is not None:
+                predicted = [vocab_map[predicted_sequence].tolist() for predicted_sequence in predicted]
+                src_seq_list = vocab_map[src_sequence.cpu().numpy()].tolist()
+                trg_seq_list = vocab_map[trg_sequence.cpu().numpy()].tolist()
 
             for j, predicted_sequence in enumerate(predicted):
-                src_seq_list = src_sequence.cpu().tolist()
-                trg_seq_list = trg_sequence.cpu().tolist()
 
                 if args.tokenizer == 'spm':
                     source = spm_model.DecodeIds(src_seq_list[j])
@@ -217,7 +250,7 @@ def seq2seq_testing(args):
                 
                 # Get BLEU score
                 predicted_token = [trg_id2word[idx] for idx in predicted_sequence]
-                target_token = [trg_id2word[idx] for idx in trg_sequence.cpu().tolist()[j]]
+                target_token = [trg_id2word[idx] for idx in trg_seq_list[j]]
                 target_tokens.append([target_token])
                 predicted_tokens.append(predicted_token)
                 corpus_bleu_score = corpus_bleu(target_tokens, predicted_tokens)
@@ -225,6 +258,7 @@ def seq2seq_testing(args):
                 if args.use_tensorboard:
                     writer.add_scalar('TEST/Corpus BLEU', corpus_bleu_score, i)
             
+    write_log(logger, f'[TEST] Decoding speed: {round(generated_token_num / decoding_time, 2)} tokens/sec')
     final_bleu_score = corpus_bleu(target_tokens, predicted_tokens)
     write_log(logger, f'[TEST] Final BLEU score: {final_bleu_score}')
     if args.use_tensorboard:
@@ -17,14 +17,17 @@ from torch.nn.utils import clip_grad_norm_
 from torch.cuda.amp import GradScaler, autocast
 from torch.utils.tensorboard import SummaryWriter
 # Import custom modules
-from model.dataset import Seq2SeqDataset, Seq2LabelDataset, MutlimodalClassificationDataset
+from model.dataset import Seq2SeqDataset, PackedSeq2SeqDataset, TargetPosteriorDataset, Seq2LabelDataset, \
+    MutlimodalClassificationDataset
 from model.custom_transformer.transformer import Transformer
 from model.custom_plm.T5 import custom_T5
 from model.custom_plm.bart import custom_Bart
 from model.custom_plm.bert import custom_Bert
+from model.loss import ChunkedCrossEntropyLoss
 from optimizer.utils import shceduler_select, optimizer_select
 from utils import TqdmLoggingHandler, write_log, get_tb_exp_name
-from task.utils import input_to_device, label_smoothing_loss, model_save_name
+from task.utils import input_to_device, label_smoothing_loss, model_save_name, dataloader_select, load_hdf5_array
+from task.utils import token_frequency, target_posterior_caching
 
 def training(args):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -61,20 +64,22 @@ def training(args):
         save_name = f'processed_{args.task}.hdf5'
 
     with h5py.File(os.path.join(save_path, save_name), 'r') as f:
-        train_src_input_ids = f.get('train_src_input_ids')[:]
-        train_src_attention_mask = f.get('train_src_attention_mask')[:]
-        valid_src_input_ids = f.get('valid_src_input_ids')[:]
-        valid_src_attention_mask = f.get('valid_src_attention_mask')[:]
+        # Original token index of each index of a trimmed vocabulary
+        vocab_map = f['vocab_map'][:] if 'vocab_map' in f else None
+        train_src_input_ids = load_hdf5_array(f, 'train_src_input_ids', args.lazy_loading)
+        train_src_attention_mask = load_hdf5_array(f, 'train_src_attention_mask', args.lazy_loading)
+        valid_src_input_ids = load_hdf5_array(f, 'valid_src_input_ids', args.lazy_loading)
+        valid_src_attention_mask = load_hdf5_array(f, 'valid_src_attention_mask', args.lazy_loading)
         if args.task in ['translation', 'style_transfer', 'summarization']:
-            train_trg_input_ids = f.get('train_trg_input_ids')[:]
-            train_trg_attention_mask = f.get('train_trg_attention_mask')[:]
-            valid_trg_input_ids = f.get('valid_trg_input_ids')[:]
-            valid_trg_attention_mask = f.get('valid_trg_attention_mask')[:]
+            train_trg_input_ids = load_hdf5_array(f, 'train_trg_input_ids', args.lazy_loading)
+            train_trg_attention_mask = load_hdf5_array(f, 'train_trg_attention_mask', args.lazy_loading)
+            valid_trg_input_ids = load_hdf5_array(f, 'valid_trg_input_ids', args.lazy_loading)
+            valid_trg_attention_mask = load_hdf5_array(f, 'valid_trg_attention_mask', args.lazy_loading)
         elif args.task in ['reconstruction']:
-            train_trg_input_ids = f.get('train_src_input_ids')[:]
-            train_trg_attention_mask = f.get('train_src_attention_mask')[:]
-            valid_trg_input_ids = f.get('valid_src_input_ids')[:]
-            valid_trg_attention_mask = f.get('valid_src_attention_mask')[:]
+            train_trg_input_ids = load_hdf5_array(f, 'train_src_input_ids', args.lazy_loading)
+            train_trg_attention_mask = load_hdf5_array(f, 'train_src_attention_mask', args.lazy_loading)
+            valid_trg_input_ids = load_hdf5_array(f, 'valid_src_input_ids', args.lazy_loading)
+            valid_trg_attention_mask = load_hdf5_array(f, 'valid_src_attention_mask', args.lazy_loading)
         elif args.task in ['classification']:
             train_trg_list = f.get('train_label')[:]
             valid_trg_list = f.get('valid_label')[:]
@@ -98,6 +103,9 @@ def training(args):
         else:
             trg_vocab_num = 0
         del data_
+    if vocab_map is not None:
+        src_vocab_num = len(vocab_map)
+        trg_vocab_num = len(vocab_map) if trg_vocab_num > 0 else 0
 
     gc.enable()
     write_log(logger, "Finished loading data!")
@@ -111,6 +119,11 @@ def training(args):
 
     variational_mode_dict = dict()
     if args.variational:
+        if args.variational_token_processing == 'view' and args.variational_with_target and \
+            (args.dynamic_padding or args.max_tokens > 0 or args.src_max_len != args.trg_max_len):
+            # Source and target latent variables of 'view' are flattened over the padded length
+            raise Exception('View token processing with variational_with_target needs the same src_max_len and '
+                            'trg_max_len without dynamic_padding or max_tokens')
         variational_mode_dict['variational_model'] = args.variational_model
         variational_mode_dict['variational_token_processing'] = args.variational_token_processing
         variational_mode_dict['variational_with_target'] = args.variational_with_target
@@ -119,6 +132,19 @@ def training(args):
         variational_mode_dict['latent_add_encoder_out'] = args.latent_add_encoder_out
         variational_mode_dict['z_var'] = args.z_var
         variational_mode_dict['d_latent'] = args.d_latent
+        variational_mode_dict['mmd_block_size'] = args.mmd_block_size
+        variational_mode_dict['batched_src_trg_encoding'] = args.batched_src_trg_encoding
+        variational_mode_dict['trg_encoder_mode'] = args.trg_encoder_mode
+        variational_mode_dict['trg_encoder_ema_decay'] = args.trg_encoder_ema_decay
+        variational_mode_dict['parallel_layer_latent'] = args.parallel_layer_latent
+
+    # Adaptive or sampled softmax head from the training target token counts
+    output_head_dict = dict()
+    if args.output_head != 'softmax' and args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
+        output_head_dict['output_head'] = args.output_head
+        output_head_dict['adaptive_cutoffs'] = args.adaptive_cutoffs
+        output_head_dict['num_sampled'] = args.num_sampled
+        output_head_dict['token_count'] = token_frequency(train_trg_input_ids, train_trg_attention_mask, trg_vocab_num)
 
     if args.model_type == 'custom_transformer':
         model = Transformer(task=args.task,
@@ -134,7 +160,8 @@ def training(args):
                             emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing, 
                             variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
-                            parallel=args.parallel)
+                            parallel=args.parallel, gradient_checkpointing=args.gradient_checkpointing,
+                            checkpoint_every=args.checkpoint_every, output_head_dict=output_head_dict)
         tgt_subsqeunt_mask = model.generate_square_subsequent_mask(args.trg_max_len - 1, device)
     # elif args.model_type == 'T5':
     #     model = custom_T5(isPreTrain=args.isPreTrain, d_latent=args.d_latent, 
@@ -146,7 +173,8 @@ def training(args):
                             isPreTrain=args.isPreTrain, variational=args.variational,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            output_head_dict=output_head_dict, vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     elif args.model_type == 'bert':
         model = custom_Bert(task=args.task, num_class=128, # Need to refactoring
@@ -154,7 +182,8 @@ def training(args):
                             src_language=src_language,
                             variational_mode_dict=variational_mode_dict,
                             src_max_len=args.src_max_len, trg_max_len=args.trg_max_len,
-                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing)
+                            emb_src_trg_weight_sharing=args.emb_src_trg_weight_sharing,
+                            vocab_map=vocab_map)
         tgt_subsqeunt_mask = None
     model = model.to(device)
 
@@ -183,6 +212,7 @@ def training(args):
         train_trg_attention_mask = None
         valid_trg_attention_mask = None
 
+    start_time = time()
     dataset_dict = {
         'train': CustomDataset(src_list=train_src_input_ids, src_att_list=train_src_attention_mask,
                                src_img_path=train_src_img_path,
@@ -197,15 +227,35 @@ def training(args):
                                pad_idx=model.pad_idx, eos_idx=model.eos_idx,
                                image_transform=image_transform),
     }
+    write_log(logger, f"Dataset setting time - {time() - start_time:.1f}sec, RSS - {psutil.Process().memory_info().rss / 1024**3:.2f}GB")
+    if args.packing:
+        if CustomDataset != Seq2SeqDataset or args.model_type != 'custom_transformer':
+            raise Exception('Packing is only available for sequence-to-sequence tasks with custom_transformer')
+        dataset_dict = {
+            'train': PackedSeq2SeqDataset(dataset_dict['train'], src_max_len=args.src_max_len,
+                                          trg_max_len=args.trg_max_len, shuffle=True),
+            'valid': PackedSeq2SeqDataset(dataset_dict['valid'], src_max_len=args.src_max_len,
+                                          trg_max_len=args.trg_max_len, shuffle=False)
+        }
+    # Target posterior of every training example cached to disk once per epoch
+    trg_posterior_cache = args.variational and args.variational_with_target and args.trg_encoder_mode == 'cache'
+    if trg_posterior_cache:
+        if CustomDataset != Seq2SeqDataset or args.model_type != 'custom_transformer' or args.parallel or \
+            args.packing:
+            raise Exception('Target posterior cache is only available for sequence-to-sequence tasks with '
+                            'non-parallel custom_transformer without packing')
+        dataset_dict['train'] = TargetPosteriorDataset(dataset_dict['train'])
+        trg_posterior_file = model_save_name(args).replace('.pth.tar', '_trg_posterior.npy')
     dataloader_dict = {
-        'train': DataLoader(dataset_dict['train'], drop_last=True,
-                            batch_size=args.batch_size, shuffle=True, pin_memory=True,
-                            num_workers=args.num_workers),
-        'valid': DataLoader(dataset_dict['valid'], drop_last=False,
-                            batch_size=args.batch_size, shuffle=False, pin_memory=True,
-                            num_workers=args.num_workers)
+        'train': dataloader_select(dataset_dict['train'], args, batch_size=args.batch_size,
+                                   shuffle=True, drop_last=True),
+        'valid': dataloader_select(dataset_dict['valid'], args, batch_size=args.batch_size,
+                                   shuffle=False, drop_last=False)
     }
     write_log(logger, f"Total number of trainingsets  iterations - {len(dataset_dict['train'])}, {len(dataloader_dict['train'])}")
+    if args.max_tokens > 0:
+        write_log(logger, f"Number of iterations is the first epoch of the token budget ({args.max_tokens} tokens); "
+                          f"the scheduler uses it for every epoch")
     
     # 3) Optimizer & Learning rate scheduler setting
     optimizer = optimizer_select(model, args)
@@ -232,6 +282,21 @@ def training(args):
     #===================================#
 
     best_val_loss = 1e+10
+    train_step = 0
+
+    # Adaptive or sampled softmax loss; validation uses the full vocabulary log-probabilities
+    head_loss = len(output_head_dict) > 0
+    # Vocabulary projection and cross entropy in token chunks
+    smoothing_eps = args.label_smoothing_eps if args.label_smoothing else 0
+    chunked_loss = args.loss_chunk_size > 0 and args.model_type == 'custom_transformer' and not head_loss and \
+        args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']
+    hidden_dict = dict()
+    if head_loss:
+        hidden_dict['return_hidden'] = True
+    elif chunked_loss:
+        criterion = ChunkedCrossEntropyLoss(chunk_size=args.loss_chunk_size, smoothing_eps=smoothing_eps)
+        valid_criterion = ChunkedCrossEntropyLoss(chunk_size=args.loss_chunk_size)
+        hidden_dict['return_hidden'] = True
 
     write_log(logger, 'Traing start!')
 
@@ -239,7 +304,14 @@ def training(args):
         start_time_e = time()
         for phase in ['train', 'valid']:
             if phase == 'train':
+                train_token_num = 0
+                train_padded_token_num = 0
                 model.train()
+                if trg_posterior_cache:
+                    start_time_c = time()
+                    target_posterior_caching(model, dataset_dict['train'], trg_posterior_file,
+                                             args.test_batch_size, device)
+                    write_log(logger, f'Target posterior caching time - {time() - start_time_c:.1f}sec')
             if phase == 'valid':
                 write_log(logger, 'Validation start...')
                 val_ce_loss = 0
@@ -254,28 +326,57 @@ def training(args):
 
                 # Input, output setting
                 src_sequence, src_att, src_img, trg_label, trg_sequence, trg_att = input_to_device(args, batch_iter, device)
+                packing_dict = dict()
+                if args.packing:
+                    packing_dict['src_segment_ids'] = batch_iter[4].to(device, non_blocking=True)
+                    packing_dict['trg_segment_ids'] = batch_iter[5].to(device, non_blocking=True)
+                posterior_dict = dict()
+                if phase == 'train' and trg_posterior_cache:
+                    posterior_dict['trg_posterior'] = batch_iter[4].to(device, non_blocking=True)
 
                 # Output pre-processing
                 if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
                     trg_sequence_gold = trg_sequence[:, 1:]
                     non_pad = trg_sequence_gold != model.pad_idx
+                    if args.packing:
+                        # The end of a packed example does not predict the start of the next one
+                        trg_segment_ids = packing_dict['trg_segment_ids']
+                        non_pad = non_pad & (trg_segment_ids[:, 1:] == trg_segment_ids[:, :-1])
                     trg_sequence_gold = trg_sequence_gold[non_pad].contiguous().view(-1)
                 else:
                     non_pad = None
 
                 # Train
                 if phase == 'train':
+                    # Non-padding and total token count for padding ratio and speed
+                    train_token_num += int(batch_iter[1].sum())
+                    train_padded_token_num += batch_iter[1].numel()
+                    if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
+                        train_token_num += int(batch_iter[3].sum())
+                        train_padded_token_num += batch_iter[3].numel()
+
                     with autocast():
                         predicted, dist_loss = model(src_input_ids=src_sequence, src_attention_mask=src_att,
                                                      src_img=src_img, trg_label=trg_label,
                                                      trg_input_ids=trg_sequence, trg_attention_mask=trg_att,
-                                                     non_pad_position=non_pad, tgt_subsqeunt_mask=tgt_subsqeunt_mask)
-                        if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
+                                                     non_pad_position=non_pad, tgt_subsqeunt_mask=tgt_subsqeunt_mask,
+                                                     **packing_dict, **posterior_dict, **hidden_dict)
+                        if head_loss:
+                            loss, correct = model.output_loss(predicted, trg_sequence_gold)
+                            acc = correct / len(trg_sequence_gold)
+                        elif chunked_loss:
+                            loss, correct = criterion(predicted, model.trg_output_linear2, trg_sequence_gold,
+                                                      logit_scale=model.x_logit_scale)
+                            acc = correct / len(trg_sequence_gold)
+                        elif args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
                             predicted = predicted.view(-1, predicted.size(-1))
-                            # loss = label_smoothing_loss(predicted, trg_sequence_gold, 
-                            #                             trg_pad_idx=model.pad_idx,
-                            #                             smoothing_eps=args.label_smoothing_eps)
-                            loss = F.cross_entropy(predicted, trg_sequence_gold)
+                            if args.label_smoothing:
+                                loss = label_smoothing_loss(predicted, trg_sequence_gold,
+                                                            trg_pad_idx=model.pad_idx,
+                                                            smoothing_eps=args.label_smoothing_eps)
+                            else:
+                                loss = F.cross_entropy(predicted, trg_sequence_gold)
+                            acc = (predicted.max(dim=1)[1] == trg_sequence_gold).sum() / len(trg_sequence_gold)
                         elif 'classification' in args.task: # Need to refactoring
                             loss = F.cross_entropy(predicted, trg_label)
                         total_loss = loss + dist_loss
@@ -287,6 +388,11 @@ def training(args):
                     scaler.step(optimizer)
                     scaler.update()
 
+                    # Target encoder EMA snapshot update
+                    train_step += 1
+                    if args.model_type == 'custom_transformer' and train_step % args.trg_encoder_ema_interval == 0:
+                        model.update_trg_encoder()
+
                     if args.scheduler in ['constant', 'warmup']:
                         scheduler.step()
                     if args.scheduler == 'reduce_train':
@@ -295,23 +401,24 @@ def training(args):
                     # Print loss value only training
                     if i == 0 or freq == args.print_freq or i==len(dataloader_dict['train']):
                         if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
-                            acc = (predicted.max(dim=1)[1] == trg_sequence_gold).sum() / len(trg_sequence_gold)
                             loss = loss.item()
                             dist_loss = dist_loss.item()
                         elif 'classification' in args.task:
                             acc = (predicted.max(dim=1)[1] == trg_label).sum() / len(trg_label)
-                        iter_log = "[Epoch:%03d][%03d/%03d] train_loss:%03.2f | train_latent_loss:%03.2f | train_acc:%03.2f%% | learning_rate:%1.6f | spend_time:%02.2fmin" % \
+                        iter_log = "[Epoch:%03d][%03d/%03d] train_loss:%03.2f | train_latent_loss:%03.2f | train_acc:%03.2f%% | learning_rate:%1.6f | padding_ratio:%03.2f%% | tokens/sec:%05.1f | spend_time:%02.2fmin" % \
                             (epoch, i, len(dataloader_dict['train']), 
                             loss, dist_loss, acc*100, optimizer.param_groups[0]['lr'], 
+                            (1 - train_token_num / train_padded_token_num) * 100,
+                            train_token_num / (time() - start_time_e),
                             (time() - start_time_e) / 60)
+                        if device.type == 'cuda':
+                            iter_log += " | peak_memory:%.2fGB" % (torch.cuda.max_memory_allocated(device) / 1024**3)
                         write_log(logger, iter_log)
                         freq = 0
                     freq += 1
 
                     if args.use_tensorboard:
-                        if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
-                            acc = (predicted.max(dim=1)[1] == trg_sequence_gold).sum() / len(trg_sequence_gold)
-                        elif 'classification' in args.task:
+                        if 'classification' in args.task:
                             acc = (predicted.max(dim=1)[1] == trg_label).sum() / len(trg_label)
                         
                         tb_writer.add_scalar('TRAIN/Total_Loss', total_loss, (epoch-1) * len(dataloader_dict['train']) + i)
@@ -328,8 +435,15 @@ def training(args):
                         predicted, dist_loss = model(src_input_ids=src_sequence, src_attention_mask=src_att,
                                                      src_img=src_img, trg_label=trg_label,
                                                      trg_input_ids=trg_sequence, trg_attention_mask=trg_att,
-                                                     non_pad_position=non_pad, tgt_subsqeunt_mask=tgt_subsqeunt_mask)
-                        if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
+                                                     non_pad_position=non_pad, tgt_subsqeunt_mask=tgt_subsqeunt_mask,
+                                                     **packing_dict, **hidden_dict)
+                        if head_loss:
+                            predicted = model.output_log_prob(predicted)
+                            loss = F.nll_loss(predicted, trg_sequence_gold)
+                        elif chunked_loss:
+                            loss, correct = valid_criterion(predicted, model.trg_output_linear2, trg_sequence_gold,
+                                                            logit_scale=model.x_logit_scale)
+                        elif args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
                             loss = F.cross_entropy(predicted, trg_sequence_gold, ignore_index=model.pad_idx)
                         elif 'classification' in args.task:
                             loss = F.cross_entropy(predicted, trg_label)
@@ -337,7 +451,9 @@ def training(args):
                     val_ce_loss += loss
                     val_latent_loss += dist_loss
                     val_total_loss += total_loss
-                    if args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
+                    if chunked_loss:
+                        val_acc += correct / len(trg_sequence_gold)
+                    elif args.task in ['translation', 'style_transfer', 'summarization', 'reconstruction']:
                         val_acc += (predicted.max(dim=1)[1] == trg_sequence_gold).sum() / len(trg_sequence_gold)
                     elif 'classification' in args.task:
                         val_acc += (predicted.max(dim=1)[1] == trg_label).sum() / len(trg_label)
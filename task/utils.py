@@ -1,6 +1,13 @@
 import os
+import numpy as np
 import torch
 from torch.nn import functional as F
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler
+# Import custom modules
+from task.preprocessing.ragged_format import token_array_info, read_token_array
+from model.dataset import Seq2SeqDataset, PackedSeq2SeqDataset, TargetPosteriorDataset, Seq2LabelDataset, \
+    MutlimodalClassificationDataset
+from model.dataset import BucketBatchSampler, seq2seq_collate, seq2label_collate, trim_seq2seq_batch, trim_seq2label_batch
 
 def input_to_device(args, batch_iter, device):
     # Input, output setting
@@ -45,17 +52,108 @@ def input_to_device(args, batch_iter, device):
     return src_sequence, src_att, src_img, trg_label, trg_sequence, trg_att
 
 
+def load_hdf5_array(f, key: str, lazy_loading: bool = False):
+    """
+    Read a padded token array of the preprocessed HDF5 file; the ragged format is padded when it is read.
+    With lazy_loading, the array is exported to '.npy' next to the HDF5 file once (chunk by chunk) and opened
+    as a read-only memory map, so rows are read from disk on demand and every DataLoader worker shares
+    the page cache instead of holding its own copy.
+    """
+    if not lazy_loading:
+        return read_token_array(f, key)
+
+    npy_file = f'{os.path.splitext(f.filename)[0]}_{key}.npy'
+    if not os.path.exists(npy_file) or os.path.getmtime(npy_file) < os.path.getmtime(f.filename):
+        shape, dtype = token_array_info(f, key)
+        tmp_file = npy_file + '.tmp'
+        memmap = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=dtype, shape=shape)
+        chunk_size = 100000
+        for start in range(0, shape[0], chunk_size):
+            memmap[start:start + chunk_size] = read_token_array(f, key, start, start + chunk_size)
+        memmap.flush()
+        del memmap
+        os.replace(tmp_file, npy_file)
+    return np.load(npy_file, mmap_mode='r')
+
+def token_frequency(input_ids, attention_mask, vocab_num: int, chunk_size: int = 100000):
+    """
+    Count of every token index in the non-padding positions of a padded token array
+    """
+    token_count = np.zeros(vocab_num, dtype=np.int64)
+    for start in range(0, len(input_ids), chunk_size):
+        ids = np.asarray(input_ids[start:start + chunk_size])
+        mask = np.asarray(attention_mask[start:start + chunk_size]).astype(bool)
+        token_count += np.bincount(ids[mask], minlength=vocab_num)[:vocab_num]
+    return token_count
+
+def dataloader_select(dataset, args, batch_size: int, shuffle: bool = False, drop_last: bool = False):
+    # Array datasets make the whole batch from an index list
+    batch_fetch = args.batch_fetch and \
+        isinstance(dataset, (Seq2SeqDataset, TargetPosteriorDataset, Seq2LabelDataset, MutlimodalClassificationDataset))
+
+    # Trim padding of each batch to its longest sequence
+    collate_fn = None
+    if args.dynamic_padding or args.max_tokens > 0:
+        if isinstance(dataset, (Seq2SeqDataset, PackedSeq2SeqDataset, TargetPosteriorDataset)):
+            collate_fn = trim_seq2seq_batch if batch_fetch else seq2seq_collate
+        elif isinstance(dataset, Seq2LabelDataset):
+            collate_fn = trim_seq2label_batch if batch_fetch else seq2label_collate
+
+    # Group examples of similar length; token budget batches are always bucketed
+    if (args.bucket_batch or args.max_tokens > 0) and hasattr(dataset, 'src_lengths'):
+        batch_sampler = BucketBatchSampler(dataset.src_lengths, getattr(dataset, 'trg_lengths', None),
+                                           batch_size=batch_size, drop_last=drop_last, shuffle=shuffle,
+                                           max_tokens=args.max_tokens)
+    elif batch_fetch:
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    else:
+        return DataLoader(dataset, drop_last=drop_last, batch_size=batch_size, shuffle=shuffle,
+                          collate_fn=collate_fn, pin_memory=True, num_workers=args.num_workers)
+
+    if batch_fetch:
+        # Each index list of batch_sampler is passed to dataset[...] as it is
+        return DataLoader(dataset, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn,
+                          pin_memory=True, num_workers=args.num_workers)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn,
+                      pin_memory=True, num_workers=args.num_workers)
+
+def target_posterior_caching(model, dataset, cache_file: str, batch_size: int, device):
+    """
+    Write the target posterior of every example of TargetPosteriorDataset with the current weights to a '.npy' file
+    and set it to the dataset as a read-only memory map for the coming epoch. Dropout is not used.
+    """
+    was_training = model.training
+    model.eval()
+    tmp_file = cache_file + '.tmp'
+    memmap = None
+    with torch.no_grad():
+        for start in range(0, len(dataset), batch_size):
+            index = np.arange(start, min(start + batch_size, len(dataset)))
+            _, _, trg, trg_att = trim_seq2seq_batch(dataset.dataset[index])
+            trg_posterior = model.target_posterior(trg.to(device), trg_att.to(device)).float().cpu().numpy()
+            if memmap is None:
+                memmap = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                                   shape=(len(dataset), *trg_posterior.shape[1:]))
+            memmap[start:start + len(index)] = trg_posterior
+    model.train(was_training)
+    memmap.flush()
+    del memmap
+    os.replace(tmp_file, cache_file)
+    dataset.set_posterior(np.load(cache_file, mmap_mode='r'))
+
 def label_smoothing_loss(pred, gold, trg_pad_idx, smoothing_eps=0.1):
     ''' Calculate cross entropy loss, apply label smoothing if needed. '''
     gold = gold.contiguous().view(-1)
     n_class = pred.size(1)
 
-    one_hot = torch.zeros_like(pred).scatter(1, gold.view(-1, 1), 1)
-    one_hot = one_hot * (1 - smoothing_eps) + (1 - one_hot) * smoothing_eps / (n_class - 1)
+    # Smoothed target distribution without a one-hot matrix
     log_prb = F.log_softmax(pred, dim=1)
+    gold_log_prb = log_prb.gather(1, gold.view(-1, 1)).squeeze(1)
+    other_log_prb = log_prb.sum(dim=1) - gold_log_prb
 
     non_pad_mask = gold.ne(trg_pad_idx)
-    loss = -(one_hot * log_prb).sum(dim=1)
+    loss = -((1 - smoothing_eps) * gold_log_prb + smoothing_eps / (n_class - 1) * other_log_prb)
     loss = loss.masked_select(non_pad_mask).mean()
     return loss
 
@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Import PyTorch
+import torch
+# Import custom modules
+from tests.helpers import padded_source, padded_target, variational_mode_dict
+from model.custom_transformer.transformer import Transformer
+
+def step_time(args, batched_src_trg_encoding, device):
+    torch.manual_seed(args.seed)
+    model = Transformer(src_vocab_num=args.vocab_num, trg_vocab_num=args.vocab_num, d_model=args.d_model,
+                        d_embedding=args.d_model // 2, n_head=8, dim_feedforward=args.d_model * 4,
+                        num_encoder_layer=args.num_layer, num_decoder_layer=args.num_layer,
+                        src_max_len=args.max_len, trg_max_len=args.max_len, variational=True,
+                        variational_mode_dict=variational_mode_dict(
+                            args.variational_model, variational_with_target=True,
+                            d_latent=args.d_model // 2, batched_src_trg_encoding=batched_src_trg_encoding))
+    model = model.to(device).train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+
+    lengths = torch.randint(args.max_len // 4, args.max_len, (args.batch_size,)).tolist()
+    src_input_ids, src_attention_mask = padded_source(lengths, seed=args.seed, vocab_num=args.vocab_num)
+    trg_input_ids, trg_attention_mask = padded_target(lengths, seed=args.seed + 1, vocab_num=args.vocab_num)
+    src_input_ids, src_attention_mask = src_input_ids.to(device), src_attention_mask.to(device)
+    trg_input_ids, trg_attention_mask = trg_input_ids.to(device), trg_attention_mask.to(device)
+
+    elapsed = list()
+    for step in range(args.warmup_step + args.step):
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        logits, dist_loss = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                                  trg_input_ids, trg_attention_mask)
+        (logits.float().logsumexp(dim=-1).mean() + dist_loss).backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if step >= args.warmup_step:
+            elapsed.append(time.perf_counter() - start)
+    return sum(elapsed) / len(elapsed)
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    print(f'Device: {device}, batch size: {args.batch_size}, max length: {args.max_len}, '
+          f'{args.variational_model} with target')
+    for batched_src_trg_encoding in [False, True]:
+        elapsed = step_time(args, batched_src_trg_encoding, device)
+        print(f'batched_src_trg_encoding={str(batched_src_trg_encoding):>5} | {elapsed * 1000:8.1f} ms/step')
+
+if __name__ == '__main__':
+    # Training step time of the variational Transformer with and without one source and target encoder pass
+    parser = argparse.ArgumentParser(description='Batched source and target encoding benchmark')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--vocab_num', default=8000, type=int)
+    parser.add_argument('--d_model', default=256, type=int)
+    parser.add_argument('--num_layer', default=3, type=int)
+    parser.add_argument('--max_len', default=64, type=int)
+    parser.add_argument('--variational_model', default='wae', type=str)
+    parser.add_argument('--step', default=10, type=int)
+    parser.add_argument('--warmup_step', default=2, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    main(args)
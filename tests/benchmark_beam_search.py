@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Import PyTorch
+import torch
+# Import custom modules
+from tests.helpers import padded_source
+from tests.test_beam_search import reference_generate
+from model.custom_transformer.transformer import Transformer
+
+def timed(fn, device):
+    start = time.perf_counter()
+    with torch.no_grad():
+        predicted = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, predicted
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    torch.manual_seed(args.seed)
+    model = Transformer(src_vocab_num=args.vocab_num, trg_vocab_num=args.vocab_num, d_model=args.d_model,
+                        d_embedding=args.d_model // 2, n_head=8, dim_feedforward=args.d_model * 4,
+                        num_encoder_layer=args.num_layer, num_decoder_layer=args.num_layer,
+                        src_max_len=args.max_len, trg_max_len=args.max_len, variational=False)
+    with torch.no_grad():
+        # Larger eos logit makes source sentences finish at different steps as a trained model does
+        model.trg_output_linear2.bias[model.eos_idx] += args.eos_bias
+    model = model.to(device).eval()
+
+    lengths = torch.randint(args.max_len // 4, args.max_len, (args.batch_size,)).tolist()
+    src_input_ids, src_attention_mask = padded_source(lengths, seed=args.seed, vocab_num=args.vocab_num)
+    src_input_ids, src_attention_mask = src_input_ids.to(device), src_attention_mask.to(device)
+
+    results = {
+        'previous loop': timed(lambda: reference_generate(model, src_input_ids, args.beam_size, 0.7, device), device),
+        'beam_search': timed(lambda: model.generate(src_input_ids, src_attention_mask, args.beam_size, 0.7, 0,
+                                                    device, incremental_decoding=False), device),
+        'beam_search + cache': timed(lambda: model.generate(src_input_ids, src_attention_mask, args.beam_size, 0.7, 0,
+                                                            device, incremental_decoding=True), device)
+    }
+    reference = results['previous loop'][1]
+    print(f'Device: {device}, sources: {args.batch_size}, beam size: {args.beam_size}, '
+          f'mean output length: {sum(len(seq) for seq in reference) / len(reference):.1f}')
+    for name, (elapsed, predicted) in results.items():
+        print(f'{name:>20} | {elapsed:8.3f} sec | same hypotheses: {predicted == reference}')
+
+if __name__ == '__main__':
+    # Beam search time against the decoding loop of Transformer.generate before model/beam_search.py
+    parser = argparse.ArgumentParser(description='Beam search benchmark')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--beam_size', default=5, type=int)
+    parser.add_argument('--vocab_num', default=8000, type=int)
+    parser.add_argument('--d_model', default=256, type=int)
+    parser.add_argument('--num_layer', default=3, type=int)
+    parser.add_argument('--max_len', default=64, type=int)
+    parser.add_argument('--eos_bias', default=1., type=float)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Import PyTorch
+import torch
+import torch.nn.functional as F
+# Import custom modules
+from model.loss import ChunkedCrossEntropyLoss
+
+def loss_stat(loss_fn, hidden, output_linear, gold, device, step):
+    # Forward and backward time, tensors kept for backward and peak memory on GPU
+    storages = dict()
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    parameter_ptrs = {param.untyped_storage().data_ptr() for param in output_linear.parameters()}
+    parameter_ptrs.add(hidden.untyped_storage().data_ptr())
+
+    elapsed = list()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(step):
+        hidden.grad, output_linear.weight.grad, output_linear.bias.grad = None, None, None
+        start = time.perf_counter()
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            loss = loss_fn(hidden, output_linear, gold)
+        loss.backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        elapsed.append(time.perf_counter() - start)
+    saved_bytes = sum(nbytes for ptr, nbytes in storages.items() if ptr not in parameter_ptrs)
+    peak_memory = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+    return sum(elapsed[1:]) / max(len(elapsed) - 1, 1), saved_bytes, peak_memory
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    torch.manual_seed(args.seed)
+    output_linear = torch.nn.Linear(args.d_embedding, args.vocab_num).to(device)
+    hidden = torch.randn(args.tokens, args.d_embedding, device=device, requires_grad=True)
+    gold = torch.randint(1, args.vocab_num, (args.tokens,), device=device)
+
+    def full_loss(hidden, output_linear, gold):
+        return F.cross_entropy(output_linear(hidden), gold)
+    results = {'full logits': loss_stat(full_loss, hidden, output_linear, gold, device, args.step)}
+    for chunk_size in args.chunk_size:
+        criterion = ChunkedCrossEntropyLoss(chunk_size)
+        results[f'chunk {chunk_size}'] = loss_stat(lambda *inputs: criterion(*inputs)[0],
+                                                   hidden, output_linear, gold, device, args.step)
+
+    print(f'Device: {device}, tokens: {args.tokens}, vocab: {args.vocab_num}, d_embedding: {args.d_embedding}')
+    for name, (elapsed, saved_bytes, peak_memory) in results.items():
+        peak = f' | peak {peak_memory / 1024**2:8.1f} MB' if peak_memory is not None else ''
+        print(f'{name:>12} | {elapsed * 1000:8.1f} ms | kept for backward {saved_bytes / 1024**2:8.1f} MB{peak}')
+
+if __name__ == '__main__':
+    # Memory and time of the vocabulary projection and cross entropy with and without --loss_chunk_size
+    parser = argparse.ArgumentParser(description='Chunked cross entropy benchmark')
+    parser.add_argument('--tokens', default=8192, type=int)
+    parser.add_argument('--vocab_num', default=32000, type=int)
+    parser.add_argument('--d_embedding', default=256, type=int)
+    parser.add_argument('--chunk_size', default=[1024, 4096], type=int, nargs='+')
+    parser.add_argument('--step', default=4, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Import PyTorch
+import torch
+# Import custom modules
+from tests.helpers import padded_source, padded_target
+import model.custom_transformer.transformer as transformer
+from model.custom_transformer.transformer import Transformer
+
+def saved_activation_bytes(storages):
+    # Tensors kept for backward and the inputs kept by the checkpointed segments; each storage is counted once
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    def segment_checkpoint(function, layers, hidden, **kwargs):
+        pack(hidden)
+        return torch.utils.checkpoint.checkpoint(function, layers, hidden, **kwargs)
+    transformer.checkpoint = segment_checkpoint
+    return torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor)
+
+def step_stat(args, checkpoint_every, device):
+    torch.manual_seed(args.seed)
+    model = Transformer(src_vocab_num=args.vocab_num, trg_vocab_num=args.vocab_num, d_model=args.d_model,
+                        d_embedding=args.d_model // 2, n_head=8, dim_feedforward=args.d_model * 4,
+                        num_encoder_layer=args.num_layer, num_decoder_layer=args.num_layer,
+                        src_max_len=args.max_len, trg_max_len=args.max_len, parallel=args.parallel,
+                        variational=False, gradient_checkpointing=checkpoint_every > 0,
+                        checkpoint_every=max(checkpoint_every, 1))
+    model = model.to(device).train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-4)
+    # Parameters and their gradients are not activations
+    parameter_ptrs = {param.untyped_storage().data_ptr() for param in model.parameters()}
+
+    lengths = torch.randint(args.max_len // 2, args.max_len, (args.batch_size,)).tolist()
+    src_input_ids, src_attention_mask = padded_source(lengths, seed=args.seed, vocab_num=args.vocab_num)
+    trg_input_ids, trg_attention_mask = padded_target(lengths, seed=args.seed + 1, vocab_num=args.vocab_num)
+    src_input_ids, src_attention_mask = src_input_ids.to(device), src_attention_mask.to(device)
+    trg_input_ids, trg_attention_mask = trg_input_ids.to(device), trg_attention_mask.to(device)
+    tgt_subsqeunt_mask = model.generate_square_subsequent_mask(trg_input_ids.size(1) - 1, device)
+    gold = trg_input_ids[:, 1:]
+
+    elapsed, storages = list(), dict()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    for step in range(args.warmup_step + args.step):
+        start = time.perf_counter()
+        optimizer.zero_grad(set_to_none=True)
+        with saved_activation_bytes(storages if step == 0 else dict()):
+            logits, _ = model(src_input_ids, src_attention_mask, None, gold, trg_input_ids, trg_attention_mask,
+                              tgt_subsqeunt_mask=tgt_subsqeunt_mask)
+            loss = torch.nn.functional.cross_entropy(logits[gold != 0], gold[gold != 0])
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        if step >= args.warmup_step:
+            elapsed.append(time.perf_counter() - start)
+    saved_bytes = sum(nbytes for ptr, nbytes in storages.items() if ptr not in parameter_ptrs)
+    peak_memory = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+    return sum(elapsed) / len(elapsed), saved_bytes, peak_memory
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    print(f'Device: {device}, batch size: {args.batch_size}, max length: {args.max_len}, '
+          f'{args.num_layer} + {args.num_layer} layers, parallel: {args.parallel}')
+    for checkpoint_every in [0] + args.checkpoint_every:
+        elapsed, saved_bytes, peak_memory = step_stat(args, checkpoint_every, device)
+        peak = f' | peak {peak_memory / 1024**2:8.1f} MB' if peak_memory is not None else ''
+        print(f'checkpoint_every={checkpoint_every} | {elapsed * 1000:8.1f} ms/step | '
+              f'saved activations {saved_bytes / 1024**2:8.1f} MB{peak}')
+
+if __name__ == '__main__':
+    # Training step time and activation memory with and without gradient checkpointing
+    parser = argparse.ArgumentParser(description='Gradient checkpointing benchmark')
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--vocab_num', default=8000, type=int)
+    parser.add_argument('--d_model', default=256, type=int)
+    parser.add_argument('--num_layer', default=6, type=int)
+    parser.add_argument('--max_len', default=64, type=int)
+    parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('--checkpoint_every', default=[1, 2], type=int, nargs='+')
+    parser.add_argument('--step', default=5, type=int)
+    parser.add_argument('--warmup_step', default=1, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    main(args)
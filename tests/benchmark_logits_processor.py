@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Import PyTorch
+import torch
+# Import custom modules
+from test_logits_processor import repetition_penalty_loop, no_repeat_ngram_loop
+from model.logits_processor import RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor
+
+def step_time(processor, seqs, step, scores, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        processor(seqs, step, scores.clone())
+    if scores.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main(args):
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.cpu else 'cpu')
+    rows = args.batch_size * args.beam_size
+    print(f'Device: {device}, hypotheses: {rows}, vocab_num: {args.vocab_num}')
+    print(f'{"step":>6} | {"penalty loop":>12} | {"penalty":>8} | {"ngram loop":>10} | {"ngram":>8} (ms per step)')
+    for step in args.steps:
+        seqs = torch.randint(3, args.vocab_num, (rows, step + 1), device=device)
+        scores = torch.randn(rows, args.vocab_num, device=device)
+        times = [
+            step_time(lambda *x: repetition_penalty_loop(*x, args.repetition_penalty), seqs, step, scores, 1),
+            step_time(RepetitionPenaltyLogitsProcessor(args.repetition_penalty), seqs, step, scores, args.repeat),
+            step_time(lambda *x: no_repeat_ngram_loop(*x, args.no_repeat_ngram_size), seqs, step, scores, 1),
+            step_time(NoRepeatNGramLogitsProcessor(args.no_repeat_ngram_size), seqs, step, scores, args.repeat)
+        ]
+        print(f'{step:>6} | {times[0]:>12.2f} | {times[1]:>8.3f} | {times[2]:>10.2f} | {times[3]:>8.3f}')
+
+if __name__ == '__main__':
+    # Per-step cost of the logits processors against per-hypothesis Python loops
+    parser = argparse.ArgumentParser(description='Logits processor benchmark')
+    parser.add_argument('--batch_size', default=16, type=int)
+    parser.add_argument('--beam_size', default=5, type=int)
+    parser.add_argument('--vocab_num', default=32000, type=int)
+    parser.add_argument('--steps', default=[10, 50, 100], type=int, nargs='+')
+    parser.add_argument('--repetition_penalty', default=1.3, type=float)
+    parser.add_argument('--no_repeat_ngram_size', default=3, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--cpu', action='store_true')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,83 @@
+# Import modules
+import os
+import argparse
+import numpy as np
+# Import PyTorch
+import torch
+# Import custom modules
+from model.custom_transformer.transformer import Transformer
+
+def tiny_transformer(parallel=False, seed=0, weight_std=0.3, eos_bias=2.5, variational_mode_dict=None, **kwargs):
+    """
+    Small random Transformer for decoding tests; variational with 'variational_mode_dict'. Weight matrices are drawn with 'weight_std' so that hypotheses
+    depend on the source, and 'eos_bias' is added to eos token so that source sentences finish at different steps.
+    """
+    torch.manual_seed(seed)
+    model = Transformer(src_vocab_num=20, trg_vocab_num=20, d_model=16, d_embedding=8, n_head=2,
+                        dim_feedforward=32, num_common_layer=2, num_encoder_layer=2, num_decoder_layer=2,
+                        src_max_len=16, trg_max_len=12, parallel=parallel,
+                        variational=variational_mode_dict is not None,
+                        variational_mode_dict=variational_mode_dict or dict(), **kwargs)
+    with torch.no_grad():
+        for param in model.parameters():
+            if param.dim() > 1:
+                param.normal_(0, weight_std)
+        if model.output_head != 'adaptive':
+            model.trg_output_linear2.bias[model.eos_idx] += eos_bias
+    return model.eval()
+
+def padded_source(lengths, seed=0, vocab_num=20):
+    # Random source token ids of 'lengths' padded with 0; 0, 1, 2 are the pad, bos, eos token
+    generator = torch.Generator().manual_seed(seed)
+    src_input_ids = torch.zeros(len(lengths), max(lengths), dtype=torch.long)
+    for i, length in enumerate(lengths):
+        src_input_ids[i, :length] = torch.randint(3, vocab_num, (length,), generator=generator)
+    return src_input_ids, (src_input_ids != 0).long()
+
+def variational_mode_dict(variational_model='wae', variational_with_target=False, **kwargs):
+    # Average token processing setting of the variational model; 'kwargs' overrides or adds options
+    mode_dict = dict(variational_model=variational_model, variational_token_processing='average',
+                     variational_with_target=variational_with_target, cnn_encoder=False, cnn_decoder=False,
+                     latent_add_encoder_out=True, z_var=2, d_latent=4)
+    mode_dict.update(kwargs)
+    return mode_dict
+
+def padded_target(lengths, seed=0, vocab_num=20, bos_idx=1, eos_idx=2):
+    # Random target token ids between bos and eos token, padded with 0
+    trg_input_ids, _ = padded_source([length - 2 for length in lengths], seed, vocab_num)
+    trg_input_ids = torch.nn.functional.pad(trg_input_ids, (1, 1))
+    trg_input_ids[:, 0] = bos_idx
+    for i, length in enumerate(lengths):
+        trg_input_ids[i, length - 1] = eos_idx
+    return trg_input_ids, (trg_input_ids != 0).long()
+
+def write_line_corpus(data_path, line_num_dict=dict(train=120, valid=12, test=9), seed=0):
+    """
+    Small WMT2016_Multimodal line corpus of random words under 'data_path'
+    """
+    rng = np.random.RandomState(seed)
+    words = [''.join(rng.choice(list('abcdefghij'), rng.randint(2, 6))) for _ in range(40)]
+    corpus_path = os.path.join(data_path, 'WMT', '2016', 'multi_modal')
+    os.makedirs(corpus_path, exist_ok=True)
+    for phase, file_phase in [('train', 'train'), ('valid', 'val'), ('test', 'test')]:
+        for language in ['de', 'en']:
+            with open(os.path.join(corpus_path, f'{file_phase}.{language}'), 'w') as f:
+                for _ in range(line_num_dict[phase]):
+                    f.write(' '.join(rng.choice(words, rng.randint(1, 9))) + '\n')
+    return corpus_path
+
+def preprocessing_args(tmp_path, **kwargs):
+    """
+    Preprocessing options of main.py for the line corpus of 'write_line_corpus'; 'kwargs' overrides or adds options
+    """
+    args = argparse.Namespace(
+        preprocess_path=os.path.join(tmp_path, 'preprocessed'), data_path=os.path.join(tmp_path, 'data'),
+        data_name='WMT2016_Multimodal', task='translation', tokenizer='spm', sentencepiece_model='unigram',
+        src_vocab_size=32, trg_vocab_size=32, src_character_coverage=1.0, trg_character_coverage=1.0,
+        pad_id=0, unk_id=3, bos_id=1, eos_id=2, src_max_len=12, trg_max_len=12, src_trg_identical=False,
+        src_trg_reverse=False, cnn_dailymail_ver='3.0.0', with_eda=False, seed=42, tokenizing_workers=1,
+        ragged_format=False, hdf5_compression='none', vocab_trimming=False, preprocess_cache=True,
+        stream_chunk_size=100000)
+    vars(args).update(kwargs)
+    os.makedirs(os.path.join(args.preprocess_path, args.data_name, args.tokenizer), exist_ok=True)
+    return args
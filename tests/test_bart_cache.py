@@ -0,0 +1,46 @@
+# Import PyTorch
+import torch
+import pytest
+
+transformers = pytest.importorskip('transformers')
+from model.custom_plm.bart import reorder_past_key_values
+
+def tiny_bart_decoder():
+    torch.manual_seed(0)
+    config = transformers.BartConfig(vocab_size=20, d_model=16, encoder_layers=1, decoder_layers=2,
+                                     encoder_attention_heads=2, decoder_attention_heads=2,
+                                     encoder_ffn_dim=32, decoder_ffn_dim=32, max_position_embeddings=32)
+    return transformers.BartModel(config).get_decoder().eval()
+
+def test_reorder_past_key_values():
+    # Cached decoding after re-ordering the cache gives the hidden states of the re-ordered prefixes
+    decoder = tiny_bart_decoder()
+    generator = torch.Generator().manual_seed(1)
+    seqs = torch.randint(3, 20, (4, 3), generator=generator)
+    encoder_out = torch.randn(4, 5, 16, generator=generator)
+    attention_mask = torch.ones(4, 5, dtype=torch.long)
+    beam_index = torch.tensor([2, 2, 0, 3])
+
+    with torch.no_grad():
+        past_key_values = None
+        for step in range(2):
+            past_key_values = decoder(input_ids=seqs[:, step:step + 1], encoder_hidden_states=encoder_out,
+                                      encoder_attention_mask=attention_mask, past_key_values=past_key_values,
+                                      use_cache=True)['past_key_values']
+        past_key_values = reorder_past_key_values(past_key_values, beam_index)
+        reordered = seqs.index_select(0, beam_index)
+        cached = decoder(input_ids=reordered[:, 2:], encoder_hidden_states=encoder_out.index_select(0, beam_index),
+                         encoder_attention_mask=attention_mask, past_key_values=past_key_values,
+                         use_cache=True)['last_hidden_state'][:, -1]
+        full = decoder(input_ids=reordered, encoder_hidden_states=encoder_out.index_select(0, beam_index),
+                       encoder_attention_mask=attention_mask)['last_hidden_state'][:, -1]
+    assert torch.allclose(cached, full, atol=1e-5)
+
+def test_reorder_legacy_past_key_values():
+    # Per-layer tuples of older transformers versions are re-ordered on the batch dimension
+    past_key_values = tuple(tuple(torch.randn(4, 2, 3, 8) for _ in range(4)) for _ in range(2))
+    beam_index = torch.tensor([1, 1, 3])
+    reordered = reorder_past_key_values(past_key_values, beam_index)
+    for layer_past, reordered_layer_past in zip(past_key_values, reordered):
+        for past_state, reordered_state in zip(layer_past, reordered_layer_past):
+            assert torch.equal(reordered_state, past_state[beam_index])
@@ -0,0 +1,113 @@
+from collections import defaultdict
+# Import PyTorch
+import torch
+import pytest
+from torch.nn import functional as F
+# Import custom modules
+from tests.helpers import tiny_transformer, padded_source
+
+def reference_generate(model, src_input_ids, beam_size, beam_alpha, device):
+    """
+    Beam search loop of Transformer.generate before model/beam_search.py, without repetition penalty.
+    Every source sentence is decoded for trg_max_len steps with the whole prefix and the expanded encoder output.
+    """
+    batch_size = src_input_ids.size(0)
+    src_seq_size = src_input_ids.size(1)
+    encoder_out_dict = defaultdict(list)
+    every_batch = torch.arange(0, beam_size * batch_size, beam_size, device=device)
+
+    # Encoding
+    encoder_out = model.src_embedding(src_input_ids).transpose(0, 1) # (src_seq, batch_size, d_model)
+    src_key_padding_mask = (src_input_ids == model.pad_idx) # (batch_size, src_seq)
+    if model.parallel:
+        for i in range(len(model.encoders)):
+            encoder_out_dict[i] = model.encoders[i](encoder_out, src_key_padding_mask=src_key_padding_mask)
+    else:
+        for i in range(len(model.encoders)):
+            encoder_out = model.encoders[i](encoder_out, src_key_padding_mask=src_key_padding_mask)
+
+    # Expanding
+    src_key_padding_mask = src_key_padding_mask.view(batch_size, 1, -1).repeat(1, beam_size, 1)
+    src_key_padding_mask = src_key_padding_mask.view(-1, src_seq_size)
+    if model.parallel:
+        for i in encoder_out_dict:
+            encoder_out_dict[i] = encoder_out_dict[i].view(-1, batch_size, 1, model.d_model)
+            encoder_out_dict[i] = encoder_out_dict[i].repeat(1, 1, beam_size, 1).view(src_seq_size, -1, model.d_model)
+    else:
+        encoder_out = encoder_out.view(-1, batch_size, 1, model.d_model)
+        encoder_out = encoder_out.repeat(1, 1, beam_size, 1).view(src_seq_size, -1, model.d_model)
+
+    # Scores save vector & decoding list setting
+    scores_save = torch.zeros(beam_size * batch_size, 1, device=device) # (batch_size * k, 1)
+    top_k_scores = torch.zeros(beam_size * batch_size, 1, device=device) # (batch_size * k, 1)
+    complete_seqs = defaultdict(list)
+    complete_ind = set()
+    seqs = torch.full((beam_size * batch_size, 1), model.bos_idx, dtype=torch.long, device=device)
+
+    for step in range(model.trg_max_len):
+        tgt_mask = model.generate_square_subsequent_mask(seqs.size(1), device)
+        tgt_key_padding_mask = (seqs == model.pad_idx)
+        decoder_out = model.trg_embedding(seqs).transpose(0, 1) # (out_seq, batch_size * k, d_model)
+        for i in range(len(model.decoders)):
+            memory = encoder_out_dict[i] if model.parallel else encoder_out
+            decoder_out = model.decoders[i](decoder_out, memory, tgt_mask=tgt_mask,
+                                            memory_key_padding_mask=src_key_padding_mask,
+                                            tgt_key_padding_mask=tgt_key_padding_mask)
+        scores = F.gelu(model.trg_output_linear(decoder_out[-1]))
+        scores = F.log_softmax(model.trg_output_linear2(model.trg_output_norm(scores)), dim=1) # (batch_size * k, vocab_num)
+
+        # Add score
+        scores = top_k_scores.expand_as(scores) + scores
+        if step == 0:
+            scores = scores[::beam_size]
+            scores[:, model.eos_idx] = float('-inf')
+            top_k_scores, top_k_words = scores.topk(beam_size, 1, True, True)
+        else:
+            top_k_scores, top_k_words = scores.view(batch_size, -1).topk(beam_size, 1, True, True)
+
+        # Previous and Next word extract
+        prev_word_inds = top_k_words // model.trg_vocab_num
+        next_word_inds = top_k_words % model.trg_vocab_num
+        top_k_scores = top_k_scores.view(batch_size * beam_size, -1)
+        seqs = seqs[prev_word_inds.view(-1) + every_batch.unsqueeze(1).repeat(1, beam_size).view(-1)]
+        seqs = torch.cat([seqs, next_word_inds.view(beam_size * batch_size, -1)], dim=1)
+
+        # Find and Save Complete Sequences Score
+        if model.eos_idx in next_word_inds:
+            eos_ind = torch.where(next_word_inds.view(-1) == model.eos_idx)[0].tolist()
+            complete_ind_add = list(set(eos_ind) - complete_ind)
+            complete_ind.update(eos_ind)
+            if len(complete_ind_add) > 0:
+                scores_save[complete_ind_add] = top_k_scores[complete_ind_add]
+                for ix in complete_ind_add:
+                    complete_seqs[ix] = seqs[ix].tolist()
+
+    # If eos token doesn't exist in sequence
+    if 0 in scores_save:
+        score_save_pos = torch.where(scores_save == 0)
+        for ix in score_save_pos[0].tolist():
+            complete_seqs[ix] = seqs[ix].tolist()
+        scores_save[score_save_pos] = top_k_scores[score_save_pos]
+
+    # Beam Length Normalization
+    lp = torch.tensor([len(complete_seqs[i]) for i in range(batch_size * beam_size)], device=device)
+    lp = (((lp + beam_size) ** beam_alpha) / ((beam_size + 1) ** beam_alpha)).unsqueeze(1)
+    scores_save = scores_save / lp
+
+    _, ind = scores_save.view(batch_size, beam_size, -1).max(1)
+    return [complete_seqs[i] for i in (ind.view(-1) + every_batch).tolist()]
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('incremental_decoding', [True, False])
+@pytest.mark.parametrize('beam_size', [1, 3])
+def test_beam_search_matches_reference(parallel, incremental_decoding, beam_size):
+    # Source sentences which finish early are removed from the active batch without changing any hypothesis
+    device = torch.device('cpu')
+    model = tiny_transformer(parallel)
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5, 1, 6, 2], seed=1)
+    with torch.no_grad():
+        expected = reference_generate(model, src_input_ids, beam_size, 0.7, device)
+        predicted = model.generate(src_input_ids, src_attention_mask, beam_size=beam_size, beam_alpha=0.7,
+                                   repetition_penalty=0, device=device, incremental_decoding=incremental_decoding)
+    assert predicted == expected
+    assert len(set(len(seq) for seq in expected)) > 1
@@ -0,0 +1,51 @@
+# Import modules
+import numpy as np
+import pytest
+# Import custom modules
+pytest.importorskip('albumentations')
+from model.dataset import BucketBatchSampler
+
+def random_lengths(num_data=500, seed=0):
+    random_state = np.random.RandomState(seed)
+    return random_state.randint(1, 60, num_data), random_state.randint(1, 80, num_data)
+
+@pytest.mark.parametrize('max_tokens', [0, 300, 1000])
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_every_index_once(max_tokens, shuffle):
+    src_lengths, trg_lengths = random_lengths()
+    sampler = BucketBatchSampler(src_lengths, trg_lengths, batch_size=8, shuffle=shuffle,
+                                 bucket_size_multiplier=4, max_tokens=max_tokens)
+    for epoch in range(3):
+        indices = [ix for batch in sampler for ix in batch]
+        assert sorted(indices) == list(range(len(src_lengths)))
+
+@pytest.mark.parametrize('max_tokens', [100, 300, 1000])
+def test_token_budget(max_tokens):
+    # Padded source + target tokens fit in max_tokens unless one example alone is longer
+    src_lengths, trg_lengths = random_lengths()
+    sampler = BucketBatchSampler(src_lengths, trg_lengths, batch_size=8, bucket_size_multiplier=4,
+                                 max_tokens=max_tokens)
+    for epoch in range(3):
+        for batch in sampler:
+            padded_tokens = len(batch) * (src_lengths[batch].max() + trg_lengths[batch].max())
+            assert padded_tokens <= max_tokens or len(batch) == 1
+
+@pytest.mark.parametrize('max_tokens', [0, 300])
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_len_matches_epoch(max_tokens, drop_last):
+    # len() is the batch count of the coming epoch and stays the same while it is iterated
+    src_lengths, trg_lengths = random_lengths()
+    sampler = BucketBatchSampler(src_lengths, trg_lengths, batch_size=8, drop_last=drop_last,
+                                 bucket_size_multiplier=4, max_tokens=max_tokens)
+    num_batches = set()
+    for epoch in range(5):
+        expected = len(sampler)
+        count = 0
+        for batch in sampler:
+            count += 1
+            assert len(sampler) == expected
+        assert count == expected
+        num_batches.add(count)
+    if max_tokens > 0:
+        # Batches are re-packed every epoch
+        assert len(num_batches) > 1
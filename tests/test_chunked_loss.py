@@ -0,0 +1,51 @@
+# Import PyTorch
+import torch
+import pytest
+import torch.nn.functional as F
+# Import custom modules
+pytest.importorskip('albumentations')
+from task.utils import label_smoothing_loss
+from model.loss import ChunkedCrossEntropyLoss
+
+def loss_and_grads(loss_fn, seed=0, tokens=37, d_embedding=8, vocab_num=50, logit_scale=0.5):
+    # Loss, correct count and gradients of hidden and the output layer
+    torch.manual_seed(seed)
+    output_linear = torch.nn.Linear(d_embedding, vocab_num)
+    hidden = torch.randn(tokens, d_embedding, requires_grad=True)
+    gold = torch.randint(1, vocab_num, (tokens,))
+    loss, correct = loss_fn(hidden, output_linear, gold, logit_scale)
+    loss.backward()
+    return loss.detach(), int(correct), [hidden.grad, output_linear.weight.grad, output_linear.bias.grad]
+
+def full_loss(smoothing_eps):
+    def loss_fn(hidden, output_linear, gold, logit_scale):
+        logits = output_linear(hidden) * logit_scale
+        correct = (logits.argmax(dim=1) == gold).sum()
+        if smoothing_eps > 0:
+            # Padding index 0 is never a gold token here
+            return label_smoothing_loss(logits, gold, trg_pad_idx=0, smoothing_eps=smoothing_eps), correct
+        return F.cross_entropy(logits, gold), correct
+    return loss_fn
+
+@pytest.mark.parametrize('chunk_size', [1, 8, 37, 100])
+@pytest.mark.parametrize('smoothing_eps', [0, 0.1])
+def test_chunked_loss_matches_full_loss(chunk_size, smoothing_eps):
+    # Same token mean loss, accuracy and gradients as the loss on the full logits
+    loss, correct, grads = loss_and_grads(full_loss(smoothing_eps))
+    chunked_loss, chunked_correct, chunked_grads = loss_and_grads(ChunkedCrossEntropyLoss(chunk_size, smoothing_eps))
+    assert torch.allclose(loss, chunked_loss, atol=1e-5)
+    assert correct == chunked_correct
+    for grad, chunked_grad in zip(grads, chunked_grads):
+        assert torch.allclose(grad, chunked_grad, atol=1e-6)
+
+def test_chunked_loss_without_grad():
+    # Validation runs each chunk without checkpointing
+    loss, correct, _ = loss_and_grads(full_loss(0.1))
+    criterion = ChunkedCrossEntropyLoss(8, 0.1)
+    torch.manual_seed(0)
+    output_linear = torch.nn.Linear(8, 50)
+    hidden = torch.randn(37, 8)
+    gold = torch.randint(1, 50, (37,))
+    with torch.no_grad():
+        chunked_loss, chunked_correct = criterion(hidden, output_linear, gold, 0.5)
+    assert torch.allclose(loss, chunked_loss, atol=1e-5) and correct == int(chunked_correct)
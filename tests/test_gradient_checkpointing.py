@@ -0,0 +1,43 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+import model.custom_transformer.transformer as transformer
+from tests.helpers import tiny_transformer, variational_mode_dict, padded_source, padded_target
+
+def train_gradients(checkpoint_every, parallel=False, mode_dict=None):
+    # Loss and gradients of one training step; dropout draws the same masks with the same seed
+    model = tiny_transformer(parallel=parallel, variational_mode_dict=mode_dict,
+                             gradient_checkpointing=checkpoint_every > 0,
+                             checkpoint_every=max(checkpoint_every, 1)).train()
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5], seed=1)
+    trg_input_ids, trg_attention_mask = padded_target([6, 4, 5], seed=2)
+    tgt_subsqeunt_mask = model.generate_square_subsequent_mask(trg_input_ids.size(1) - 1, 'cpu')
+
+    torch.manual_seed(3)
+    logits, dist_loss = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                              trg_input_ids, trg_attention_mask, tgt_subsqeunt_mask=tgt_subsqeunt_mask)
+    gold = trg_input_ids[:, 1:]
+    loss = torch.nn.functional.cross_entropy(logits[gold != 0], gold[gold != 0]) + dist_loss
+    loss.backward()
+    return loss.detach(), {name: param.grad for name, param in model.named_parameters() if param.grad is not None}
+
+@pytest.mark.parametrize('checkpoint_every', [1, 2])
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('mode_dict', [None, variational_mode_dict('wae', variational_with_target=True)])
+def test_checkpointing_gradients(checkpoint_every, parallel, mode_dict, monkeypatch):
+    # Recomputed layer activations give the loss and gradients of the model without checkpointing
+    checkpoint_calls = list()
+    def counted_checkpoint(*args, **kwargs):
+        checkpoint_calls.append(len(args[1]))
+        return torch.utils.checkpoint.checkpoint(*args, **kwargs)
+    monkeypatch.setattr(transformer, 'checkpoint', counted_checkpoint)
+
+    loss, grads = train_gradients(0, parallel, mode_dict)
+    assert not checkpoint_calls
+    checkpoint_loss, checkpoint_grads = train_gradients(checkpoint_every, parallel, mode_dict)
+    assert checkpoint_calls and max(checkpoint_calls) <= checkpoint_every
+    assert torch.allclose(loss, checkpoint_loss, atol=1e-6)
+    assert grads.keys() == checkpoint_grads.keys()
+    for name in grads:
+        assert torch.allclose(grads[name], checkpoint_grads[name], atol=1e-5), name
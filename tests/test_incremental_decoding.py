@@ -0,0 +1,24 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from tests.helpers import tiny_transformer, padded_source
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('generate_kwargs', [
+    dict(repetition_penalty=0),
+    dict(repetition_penalty=1.3, no_repeat_ngram_size=2),
+    dict(repetition_penalty=0, max_len_a=0.5, max_len_b=3, min_len=2)
+])
+def test_incremental_decoding_parity(parallel, generate_kwargs):
+    # Cached decoding gives the same tokens as re-decoding the whole prefix at every step
+    model = tiny_transformer(parallel)
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5, 1, 6, 2], seed=1)
+    with torch.no_grad():
+        predicted = {
+            incremental: model.generate(src_input_ids, src_attention_mask, beam_size=3, beam_alpha=0.7,
+                                        device=torch.device('cpu'), incremental_decoding=incremental,
+                                        **generate_kwargs)
+            for incremental in [True, False]}
+    assert predicted[True] == predicted[False]
+    assert len(set(len(seq) for seq in predicted[True])) > 1
@@ -0,0 +1,127 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from model.latent_module.latent import Latent_module
+from model.latent_module.encoder_decoder import adaptive_cnn_latent_encoder, adaptive_cnn_latent_decoder
+
+def padded_batch(lengths, d_model, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    max_len = max(lengths)
+    x = torch.randn(max_len, len(lengths), d_model, generator=generator)
+    key_padding_mask = torch.arange(max_len).unsqueeze(0) >= torch.tensor(lengths).unsqueeze(1) # (batch, seq_len)
+    return x, key_padding_mask
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+def test_average_ignores_padding(variational_model):
+    # Each sentence gets the same latent variable alone and in a padded batch
+    torch.manual_seed(0)
+    latent_module = Latent_module(d_model=8, d_latent=4, variational_model=variational_model,
+                                  variational_with_target=True).eval()
+    lengths = [5, 2, 3]
+    src, src_mask = padded_batch(lengths, 8, seed=1)
+    trg, trg_mask = padded_batch(lengths[::-1], 8, seed=2)
+
+    _, batch_latent = latent_module.generate(src, src_mask, return_latent=True)
+    with torch.no_grad():
+        _, batch_loss = latent_module(src, trg, src_key_padding_mask=src_mask, trg_key_padding_mask=trg_mask)
+    for i, length in enumerate(lengths):
+        _, latent = latent_module.generate(src[:length, i:i + 1], src_mask[i:i + 1, :length], return_latent=True)
+        assert torch.allclose(batch_latent[i], latent[0], atol=1e-6)
+    assert torch.isfinite(batch_loss)
+
+def test_wae_forward_ignores_padding():
+    # The MMD of the padded batch uses the source and target means over real tokens only
+    torch.manual_seed(0)
+    latent_module = Latent_module(d_model=8, d_latent=4, variational_model='wae',
+                                  variational_with_target=True).eval()
+    lengths = [5, 2, 3]
+    src, src_mask = padded_batch(lengths, 8, seed=1)
+    trg, trg_mask = padded_batch(lengths[::-1], 8, seed=2)
+    with torch.no_grad():
+        encoder_out, dist_loss = latent_module(src, trg, src_key_padding_mask=src_mask, trg_key_padding_mask=trg_mask)
+        gen_encoder_out = latent_module.generate(src, src_mask)
+        src_latent = torch.stack([latent_module.context_to_latent(src[:length, i]).mean(dim=0)
+                                  for i, length in enumerate(lengths)])
+        trg_latent = torch.stack([latent_module.context_to_latent(trg[:length, i]).mean(dim=0)
+                                  for i, length in enumerate(lengths[::-1])])
+        expected_loss = latent_module.mmd_criterion(src_latent, trg_latent, latent_module.z_var) * 100
+    assert torch.allclose(encoder_out, gen_encoder_out, atol=1e-6)
+    assert torch.allclose(dist_loss, expected_loss, atol=1e-5)
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+def test_average_without_padding(variational_model):
+    # No padding gives the plain token mean
+    torch.manual_seed(0)
+    latent_module = Latent_module(d_model=8, d_latent=4, variational_model=variational_model).eval()
+    src, src_mask = padded_batch([4, 4], 8)
+    _, masked_latent = latent_module.generate(src, src_mask, return_latent=True)
+    _, latent = latent_module.generate(src, None, return_latent=True)
+    assert torch.allclose(masked_latent, latent, atol=1e-6)
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+def test_view_with_target_length_mismatch(variational_model):
+    # Flattened source and target latents need the same length; other lengths raise a clear error
+    torch.manual_seed(0)
+    latent_module = Latent_module(d_model=8, d_latent=4, variational_model=variational_model,
+                                  variational_token_processing='view', variational_with_target=True)
+    src, src_mask = padded_batch([5, 2, 3], 8, seed=1)
+    trg, trg_mask = padded_batch([4, 2, 3], 8, seed=2)
+    with pytest.raises(Exception, match='same length'):
+        latent_module(src, trg, src_key_padding_mask=src_mask, trg_key_padding_mask=trg_mask)
+
+    trg, trg_mask = padded_batch([5, 2, 3], 8, seed=2)
+    encoder_out, dist_loss = latent_module(src, trg, src_key_padding_mask=src_mask, trg_key_padding_mask=trg_mask)
+    assert encoder_out.shape == src.shape and torch.isfinite(dist_loss)
+
+CNN_LENGTHS = [1, 2, 3, 4, 5, 7, 8, 13]
+
+@pytest.mark.parametrize('extra_padding', [0, 3])
+def test_cnn_encoder_ignores_padding(extra_padding):
+    # Each sentence gets the same CNN latent alone and in a batch padded to any length
+    torch.manual_seed(0)
+    encoder = adaptive_cnn_latent_encoder(d_model=8, d_latent=4).eval()
+    src, src_mask = padded_batch(CNN_LENGTHS + [max(CNN_LENGTHS) + extra_padding], 8, seed=1)
+    src, src_mask = src[:, :-1], src_mask[:-1]
+
+    with torch.no_grad():
+        batch_latent = encoder(src, src_mask)
+        for i, length in enumerate(CNN_LENGTHS):
+            assert torch.allclose(batch_latent[i], encoder(src[:length, i:i + 1])[0], atol=1e-6), length
+
+@pytest.mark.parametrize('extra_padding', [0, 3])
+def test_cnn_decoder_ignores_padding(extra_padding):
+    # Each sentence gets F.interpolate of the upsampled latent to its own length and zero on padding
+    torch.manual_seed(0)
+    decoder = adaptive_cnn_latent_decoder(d_model=8, d_latent=4).eval()
+    latent = torch.randn(len(CNN_LENGTHS), 4)
+    seq_len = max(CNN_LENGTHS) + extra_padding
+    _, src_mask = padded_batch(CNN_LENGTHS + [seq_len], 8)
+    src_mask = src_mask[:-1]
+
+    with torch.no_grad():
+        batch_out = decoder(latent, seq_len, src_mask) # [seq_len, batch, d_model]
+        upsampled = latent.unsqueeze(2)
+        for conv in decoder.decoder:
+            upsampled = torch.nn.functional.gelu(conv(upsampled))
+        for i, length in enumerate(CNN_LENGTHS):
+            reference = torch.nn.functional.interpolate(upsampled[i:i + 1], size=length, mode='linear',
+                                                        align_corners=False)
+            assert torch.allclose(batch_out[:length, i], reference[0].t(), atol=1e-6), length
+            assert torch.allclose(decoder(latent[i:i + 1], length)[:, 0], reference[0].t(), atol=1e-6), length
+            assert (batch_out[length:, i] == 0).all()
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+def test_cnn_latent_module_ignores_padding(variational_model):
+    # CNN encoder and decoder give each sentence the same latent and memory alone and in a padded batch
+    torch.manual_seed(0)
+    latent_module = Latent_module(d_model=8, d_latent=4, variational_model=variational_model,
+                                  variational_token_processing='cnn', cnn_encoder=True, cnn_decoder=True).eval()
+    lengths = [5, 2, 8, 3]
+    src, src_mask = padded_batch(lengths, 8, seed=1)
+
+    batch_out, batch_latent = latent_module.generate(src, src_mask, return_latent=True)
+    for i, length in enumerate(lengths):
+        out, latent = latent_module.generate(src[:length, i:i + 1], src_mask[i:i + 1, :length], return_latent=True)
+        assert torch.allclose(batch_latent[i], latent[0], atol=1e-6)
+        assert torch.allclose(batch_out[:length, i], out[:, 0], atol=1e-5)
@@ -0,0 +1,78 @@
+# Import modules
+import os
+import h5py
+import numpy as np
+import pytest
+# Import custom modules
+pytest.importorskip('albumentations')
+from model.dataset import Seq2SeqDataset
+from task.preprocessing.ragged_format import write_token_array
+from task.utils import load_hdf5_array
+
+KEYS = ['train_src_input_ids', 'train_src_attention_mask', 'train_trg_input_ids', 'train_trg_attention_mask']
+
+def write_processed(hdf5_file, ragged, seed=0):
+    # Source and target rows which end with eos token (2) before padding
+    rng = np.random.RandomState(seed)
+    arrays = dict()
+    for name, max_len in [('train_src', 8), ('train_trg', 6)]:
+        lengths = rng.randint(2, max_len, 9)
+        attention_mask = (np.arange(max_len) < lengths[:, None]).astype(np.int32)
+        input_ids = np.where(attention_mask, rng.randint(3, 20, (9, max_len)), 0).astype(np.int32)
+        input_ids[np.arange(9), lengths - 1] = 2
+        arrays[f'{name}_input_ids'], arrays[f'{name}_attention_mask'] = input_ids, attention_mask
+    with h5py.File(hdf5_file, 'w') as f:
+        for name in ['train_src', 'train_trg']:
+            write_token_array(f, name, arrays[f'{name}_input_ids'], arrays[f'{name}_attention_mask'],
+                              ragged=ragged, chunk_size=4)
+    return arrays
+
+@pytest.mark.parametrize('ragged', [False, True])
+def test_lazy_loading_matches_eager(tmp_path, ragged):
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    arrays = write_processed(hdf5_file, ragged)
+    with h5py.File(hdf5_file, 'r') as f:
+        for key in KEYS:
+            eager = load_hdf5_array(f, key)
+            lazy = load_hdf5_array(f, key, lazy_loading=True)
+            assert isinstance(lazy, np.memmap) and not lazy.flags.writeable
+            assert os.path.exists(str(tmp_path / f'processed_{key}.npy'))
+            assert lazy.shape == eager.shape == arrays[key].shape
+            assert (lazy == eager).all() and (lazy == arrays[key]).all()
+
+def test_lazy_loading_reuses_and_refreshes_export(tmp_path):
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    write_processed(hdf5_file, ragged=False)
+    npy_file = str(tmp_path / 'processed_train_src_input_ids.npy')
+    with h5py.File(hdf5_file, 'r') as f:
+        load_hdf5_array(f, 'train_src_input_ids', lazy_loading=True)
+    # An export newer than the HDF5 file is opened as it is
+    os.utime(npy_file, (os.path.getmtime(hdf5_file) + 10,) * 2)
+    export_mtime = os.path.getmtime(npy_file)
+    with h5py.File(hdf5_file, 'r') as f:
+        load_hdf5_array(f, 'train_src_input_ids', lazy_loading=True)
+    assert os.path.getmtime(npy_file) == export_mtime
+
+    # Preprocessing again makes the export stale
+    arrays = write_processed(hdf5_file, ragged=False, seed=1)
+    os.utime(hdf5_file, (export_mtime + 10,) * 2)
+    with h5py.File(hdf5_file, 'r') as f:
+        lazy = load_hdf5_array(f, 'train_src_input_ids', lazy_loading=True)
+    assert (lazy == arrays['train_src_input_ids']).all()
+    assert not os.path.exists(npy_file + '.tmp')
+
+def test_lazy_loading_dataset(tmp_path):
+    # Seq2SeqDataset reads the same examples from memory maps and in-memory arrays
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    write_processed(hdf5_file, ragged=True)
+    with h5py.File(hdf5_file, 'r') as f:
+        eager = [load_hdf5_array(f, key) for key in KEYS]
+        lazy = [load_hdf5_array(f, key, lazy_loading=True) for key in KEYS]
+    eager_dataset = Seq2SeqDataset(eager[0], eager[1], trg_list=eager[2], trg_att_list=eager[3],
+                                   src_max_len=8, trg_max_len=6)
+    lazy_dataset = Seq2SeqDataset(lazy[0], lazy[1], trg_list=lazy[2], trg_att_list=lazy[3],
+                                  src_max_len=8, trg_max_len=6)
+    assert len(lazy_dataset) == len(eager_dataset) > 0
+    for i in range(len(eager_dataset)):
+        for lazy_item, eager_item in zip(lazy_dataset[i], eager_dataset[i]):
+            assert (lazy_item == eager_item).all()
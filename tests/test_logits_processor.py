@@ -0,0 +1,81 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from model.logits_processor import (RepetitionPenaltyLogitsProcessor, NoRepeatNGramLogitsProcessor,
+                                    MinLengthLogitsProcessor, build_logits_processor)
+
+#===================================#
+#===Loop references per hypothesis===#
+#===================================#
+
+def repetition_penalty_loop(seqs, step, scores, penalty):
+    scores = scores.clone()
+    if step == 0:
+        return scores
+    for row in range(seqs.size(0)):
+        for token in set(seqs[row, 1:].tolist()):
+            score = scores[row, token]
+            scores[row, token] = score * penalty if score < 0 else score / penalty
+    return scores
+
+def no_repeat_ngram_loop(seqs, step, scores, ngram_size):
+    scores = scores.clone()
+    for row in range(seqs.size(0)):
+        tokens = seqs[row].tolist()
+        if len(tokens) < ngram_size:
+            continue
+        prefix = tuple(tokens[len(tokens) - (ngram_size - 1):])
+        for i in range(len(tokens) - ngram_size + 1):
+            if tuple(tokens[i:i + ngram_size - 1]) == prefix:
+                scores[row, tokens[i + ngram_size - 1]] = float('-inf')
+    return scores
+
+def min_length_loop(seqs, step, scores, min_len, eos_idx):
+    scores = scores.clone()
+    if step < min_len:
+        for row in range(seqs.size(0)):
+            scores[row, eos_idx] = float('-inf')
+    return scores
+
+def random_inputs(step, rows=12, vocab_num=7, seed=0):
+    # Small vocabulary so that repeated tokens and n-grams are frequent
+    generator = torch.Generator().manual_seed(seed)
+    seqs = torch.randint(3, vocab_num, (rows, step + 1), generator=generator)
+    seqs[:, 0] = 1 # bos token
+    scores = torch.randn(rows, vocab_num, generator=generator)
+    return seqs, scores
+
+#===================================#
+#=========Equivalence tests=========#
+#===================================#
+
+@pytest.mark.parametrize('step', range(8))
+@pytest.mark.parametrize('penalty', [1.2, 0.8])
+def test_repetition_penalty(step, penalty):
+    seqs, scores = random_inputs(step, seed=step)
+    processed = RepetitionPenaltyLogitsProcessor(penalty)(seqs, step, scores.clone())
+    assert torch.allclose(processed, repetition_penalty_loop(seqs, step, scores, penalty))
+
+@pytest.mark.parametrize('step', range(8))
+@pytest.mark.parametrize('ngram_size', [1, 2, 3, 4])
+def test_no_repeat_ngram(step, ngram_size):
+    seqs, scores = random_inputs(step, seed=step)
+    processed = NoRepeatNGramLogitsProcessor(ngram_size)(seqs, step, scores.clone())
+    assert torch.equal(processed, no_repeat_ngram_loop(seqs, step, scores, ngram_size))
+
+@pytest.mark.parametrize('step', range(4))
+@pytest.mark.parametrize('min_len', [1, 2])
+def test_min_length(step, min_len):
+    seqs, scores = random_inputs(step, seed=step)
+    processed = MinLengthLogitsProcessor(min_len, 2)(seqs, step, scores.clone())
+    assert torch.equal(processed, min_length_loop(seqs, step, scores, min_len, 2))
+
+def test_processor_list():
+    logits_processor = build_logits_processor(2, repetition_penalty=1.3, no_repeat_ngram_size=2, min_len=3)
+    for step in range(6):
+        seqs, scores = random_inputs(step, seed=step)
+        expected = repetition_penalty_loop(seqs, step, scores, 1.3)
+        expected = no_repeat_ngram_loop(seqs, step, expected, 2)
+        expected = min_length_loop(seqs, step, expected, 3, 2)
+        assert torch.allclose(logits_processor(seqs, step, scores.clone()), expected)
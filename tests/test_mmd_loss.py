@@ -0,0 +1,49 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from model.latent_module.loss import MaximumMeanDiscrepancyLoss
+
+def repeat_im_kernel_sum(z1, z2, z_var, exclude_diag=True):
+    # Inverse multiquadratics kernel sum before the Gram matrix form, from two repeated (n, n, dimension) tensors
+    z_dim = z1.size(1)
+    C = 2*z_dim*z_var
+
+    z11 = z1.unsqueeze(1).repeat(1, z2.size(0), 1)
+    z22 = z2.unsqueeze(0).repeat(z1.size(0), 1, 1)
+
+    kernel_matrix = C/(1e-9+C+(z11-z22).pow(2).sum(2))
+    kernel_sum = kernel_matrix.sum()
+    if exclude_diag:
+        kernel_sum -= kernel_matrix.diag().sum()
+    return kernel_sum
+
+def repeat_mmd(z_tilde, z, z_var):
+    n = z.size(0)
+    return repeat_im_kernel_sum(z, z, z_var, exclude_diag=True).div(n*(n-1)) + \
+        repeat_im_kernel_sum(z_tilde, z_tilde, z_var, exclude_diag=True).div(n*(n-1)) + \
+        -repeat_im_kernel_sum(z, z_tilde, z_var, exclude_diag=False).div(n*n).mul(2)
+
+@pytest.mark.parametrize('block_size', [0, 1, 3, 7, 16])
+@pytest.mark.parametrize('dtype, tol', [(torch.float64, 1e-10), (torch.float32, 1e-5)])
+def test_mmd_matches_repeat_kernel(block_size, dtype, tol):
+    torch.manual_seed(0)
+    z_tilde = (torch.randn(16, 8, dtype=dtype) * 0.5 + 0.3).requires_grad_()
+    z = (torch.randn(16, 8, dtype=dtype) * 2 ** 0.5).requires_grad_()
+
+    loss = MaximumMeanDiscrepancyLoss(block_size=block_size)(z_tilde, z, 2)
+    expected = repeat_mmd(z_tilde, z, 2)
+    assert torch.allclose(loss, expected, atol=tol, rtol=tol)
+
+    grad = torch.autograd.grad(loss, (z_tilde, z))
+    expected_grad = torch.autograd.grad(expected, (z_tilde, z))
+    for g, e in zip(grad, expected_grad):
+        assert torch.allclose(g, e, atol=tol, rtol=tol)
+
+def test_mmd_of_identical_samples():
+    # Nearly identical samples, where the Gram matrix distances cancel the most
+    torch.manual_seed(0)
+    z = torch.randn(32, 4)
+    z_tilde = z + 1e-3 * torch.randn(32, 4)
+    loss = MaximumMeanDiscrepancyLoss()(z_tilde, z, 2)
+    assert torch.allclose(loss, repeat_mmd(z_tilde, z, 2), atol=1e-6)
@@ -0,0 +1,75 @@
+# Import modules
+import pytest
+# Import PyTorch
+import torch
+import torch.nn.functional as F
+from torch import nn
+# Import custom modules
+from model.output_head import AdaptiveSoftmaxHead, SampledSoftmaxHead
+from tests.helpers import tiny_transformer
+
+TOKEN_COUNT = [0, 0, 50] + list(range(40, 23, -1))
+
+def head_dict(output_head):
+    return dict(output_head=output_head, token_count=TOKEN_COUNT, adaptive_cutoffs=[4, 10], num_sampled=6)
+
+def test_adaptive_log_prob_normalizes():
+    torch.manual_seed(0)
+    head = AdaptiveSoftmaxHead(8, 20, TOKEN_COUNT, cutoffs=[4, 10])
+    log_prob = head.log_prob(torch.randn(7, 8))
+    assert log_prob.size() == (7, 20)
+    assert torch.allclose(log_prob.exp().sum(dim=1), torch.ones(7), atol=1e-5)
+
+def test_adaptive_log_prob_matches_loss():
+    # The training loss of the head is the negative log-probability of the gold token in token index order
+    torch.manual_seed(0)
+    head = AdaptiveSoftmaxHead(8, 20, TOKEN_COUNT, cutoffs=[4, 10])
+    hidden, gold = torch.randn(7, 8), torch.randint(3, 20, (7,))
+    loss, _ = head(hidden, gold)
+    expected = -head.log_prob(hidden).gather(1, gold.unsqueeze(1)).mean()
+    assert torch.allclose(loss, expected, atol=1e-5)
+
+@pytest.mark.parametrize('output_head', ['softmax', 'adaptive', 'sampled'])
+def test_model_log_prob_normalizes(output_head):
+    model = tiny_transformer(output_head_dict=head_dict(output_head))
+    src, trg = torch.randint(3, 20, (2, 6)), torch.randint(3, 20, (2, 5))
+    with torch.no_grad():
+        hidden, _ = model(src, torch.ones_like(src), None, trg[:, 1:], trg, torch.ones_like(trg),
+                          return_hidden=True)
+        log_prob = model.output_log_prob(hidden.reshape(-1, hidden.size(-1)))
+    assert log_prob.size() == (2 * 4, 20)
+    assert torch.allclose(log_prob.exp().sum(dim=1), torch.ones(2 * 4), atol=1e-5)
+
+def test_adaptive_model_has_no_output_linear():
+    assert not hasattr(tiny_transformer(output_head_dict=head_dict('adaptive')), 'trg_output_linear2')
+    assert hasattr(tiny_transformer(output_head_dict=head_dict('sampled')), 'trg_output_linear2')
+
+def test_adaptive_weight_sharing_raises():
+    with pytest.raises(Exception, match='trg_emb_prj_weight_sharing'):
+        tiny_transformer(output_head_dict=head_dict('adaptive'), trg_emb_prj_weight_sharing=True)
+
+def test_sampled_softmax_log_expected_correction(monkeypatch):
+    # Logits of the gold and sampled tokens are corrected by the log expected count and negatives equal to gold are masked
+    torch.manual_seed(0)
+    head = SampledSoftmaxHead(20, TOKEN_COUNT, num_sampled=4)
+    output_linear = nn.Linear(8, 20)
+    sampled = torch.tensor([3, 7, 7, 12])
+    monkeypatch.setattr(torch, 'multinomial', lambda *args, **kwargs: sampled)
+    hidden, gold = torch.randn(3, 8), torch.tensor([7, 5, 19])
+    logit_scale = 0.5
+    loss, correct = head(hidden, gold, output_linear, logit_scale=logit_scale)
+
+    log_expected = torch.log(head.sampling_prob * 4)
+    full_logits = output_linear(hidden) * logit_scale - log_expected
+    expected_loss = 0.
+    for i in range(3):
+        negatives = full_logits[i, sampled][sampled != gold[i]]
+        logits = torch.cat((full_logits[i, gold[i]].unsqueeze(0), negatives))
+        expected_loss += -F.log_softmax(logits, dim=0)[0] / 3
+    assert torch.allclose(loss, expected_loss, atol=1e-5)
+
+    # Without the correction the loss is different since the sampling distribution is not uniform
+    uncorrected_logits = torch.cat((output_linear(hidden).gather(1, gold.unsqueeze(1)),
+                                    output_linear(hidden)[:, sampled]), dim=1) * logit_scale
+    assert not torch.allclose(loss, F.cross_entropy(uncorrected_logits, torch.zeros_like(gold)), atol=1e-3)
+    assert 0 <= int(correct) <= 3
@@ -0,0 +1,111 @@
+# Import modules
+import numpy as np
+import pytest
+# Import PyTorch
+import torch
+import torch.nn.functional as F
+# Import custom modules
+pytest.importorskip('albumentations')
+from model.dataset import Seq2SeqDataset, PackedSeq2SeqDataset, trim_seq2seq_batch
+from model.custom_transformer.transformer import packed_attention_mask
+from tests.helpers import tiny_transformer, variational_mode_dict, padded_source, padded_target
+
+SRC_LENGTHS = [4, 3, 5, 2, 6]
+TRG_LENGTHS = [5, 3, 4, 6, 3]
+
+def packed_dataset():
+    src, src_att = padded_source(SRC_LENGTHS, seed=1)
+    trg, trg_att = padded_target(TRG_LENGTHS, seed=2)
+    dataset = Seq2SeqDataset(src.numpy(), src_att.numpy(), trg_list=trg.numpy(), trg_att_list=trg_att.numpy(),
+                             src_max_len=src.size(1), trg_max_len=trg.size(1))
+    return dataset, PackedSeq2SeqDataset(dataset, src_max_len=12, trg_max_len=12, shuffle=False)
+
+def example_logits(model, src, src_att, trg, trg_att):
+    # Logits of one example without padding, (trg_len - 1, vocab_num)
+    tgt_subsqeunt_mask = model.generate_square_subsequent_mask(trg.size(0) - 1, trg.device)
+    logits, _ = model(src.unsqueeze(0), src_att.unsqueeze(0), None, trg[1:].unsqueeze(0),
+                      trg.unsqueeze(0), trg_att.unsqueeze(0), tgt_subsqeunt_mask=tgt_subsqeunt_mask)
+    return logits[0]
+
+def test_packed_dataset_rows():
+    dataset, packed = packed_dataset()
+    assert sorted(ix for pack in packed.pack_list for ix in pack) == list(range(len(dataset)))
+    for index, pack in enumerate(packed.pack_list):
+        src, src_att, trg, trg_att, src_segment, trg_segment = packed[index]
+        src_start, trg_start = 0, 0
+        for segment, ix in enumerate(pack, 1):
+            src_len, trg_len = SRC_LENGTHS[ix], TRG_LENGTHS[ix]
+            assert (src[src_start:src_start + src_len] == dataset[ix][0][:src_len]).all()
+            assert (trg[trg_start:trg_start + trg_len] == dataset[ix][2][:trg_len]).all()
+            assert (src_segment[src_start:src_start + src_len] == segment).all()
+            assert (trg_segment[trg_start:trg_start + trg_len] == segment).all()
+            src_start, trg_start = src_start + src_len, trg_start + trg_len
+        assert (src_att == (src_segment > 0).long()).all() and src_start == int(src_att.sum())
+        assert (trg_att == (trg_segment > 0).long()).all() and trg_start == int(trg_att.sum())
+
+@pytest.mark.parametrize('mode_dict', [None, variational_mode_dict('wae'),
+                                       variational_mode_dict('wae', variational_with_target=True)])
+def test_packed_batch_matches_unpacked(mode_dict):
+    # Every packed example gets the logits and the loss of the example alone; VAE samples in forward so it is left out
+    model = tiny_transformer(variational_mode_dict=mode_dict)
+    dataset, packed = packed_dataset()
+    assert max(len(pack) for pack in packed.pack_list) > 1
+    src, src_att, trg, trg_att, src_segment, trg_segment = trim_seq2seq_batch(
+        [torch.stack(items) for items in zip(*[packed[i] for i in range(len(packed))])])
+
+    with torch.no_grad():
+        logits, _ = model(src, src_att, None, trg[:, 1:], trg, trg_att,
+                          src_segment_ids=src_segment, trg_segment_ids=trg_segment)
+        # Training loss mask; the end of a packed example does not predict the start of the next one
+        gold = trg[:, 1:]
+        non_pad = (gold != model.pad_idx) & (trg_segment[:, 1:] == trg_segment[:, :-1])
+        token_loss = torch.zeros_like(gold, dtype=torch.float)
+        token_loss[non_pad] = F.cross_entropy(logits[non_pad], gold[non_pad], reduction='none')
+
+        for row, pack in enumerate(packed.pack_list):
+            trg_start = 0
+            for ix in pack:
+                src_len, trg_len = SRC_LENGTHS[ix], TRG_LENGTHS[ix]
+                example_src, example_src_att, example_trg, example_trg_att = dataset[ix]
+                reference = example_logits(model, example_src[:src_len], example_src_att[:src_len],
+                                           example_trg[:trg_len], example_trg_att[:trg_len])
+                packed_logits = logits[row, trg_start:trg_start + trg_len - 1]
+                assert torch.allclose(packed_logits, reference, atol=1e-5), ix
+
+                reference_loss = F.cross_entropy(reference, example_trg[1:trg_len], reduction='sum')
+                packed_loss = token_loss[row, trg_start:trg_start + trg_len - 1].sum()
+                assert torch.allclose(packed_loss, reference_loss, atol=1e-5), ix
+                assert int(non_pad[row, trg_start:trg_start + trg_len - 1].sum()) == trg_len - 1
+                trg_start += trg_len
+
+def test_packed_causal_mask():
+    # Decoder queries see earlier keys of their own example only; padding queries see every key
+    segment_ids = torch.tensor([[1, 1, 1, 2, 2, 0]])
+    mask = packed_attention_mask(segment_ids, segment_ids, n_head=2, causal=True)
+    allowed = ~mask[0]
+    expected = torch.tensor([[1, 0, 0, 0, 0, 0],
+                             [1, 1, 0, 0, 0, 0],
+                             [1, 1, 1, 0, 0, 0],
+                             [0, 0, 0, 1, 0, 0],
+                             [0, 0, 0, 1, 1, 0],
+                             [1, 1, 1, 1, 1, 1]], dtype=torch.bool)
+    assert mask.size(0) == 2 and (mask[0] == mask[1]).all()
+    assert (allowed == expected).all()
+
+def test_packed_decoder_ignores_other_examples():
+    # Changing one packed example leaves the logits of the other examples in the row unchanged
+    model = tiny_transformer()
+    _, packed = packed_dataset()
+    row = next(i for i, pack in enumerate(packed.pack_list) if len(pack) > 1)
+    src, src_att, trg, trg_att, src_segment, trg_segment = [item.unsqueeze(0) for item in packed[row]]
+    changed_trg = trg.clone()
+    last = trg_segment == trg_segment.max()
+    changed_trg[last] = torch.from_numpy(np.random.RandomState(0).randint(3, 20, int(last.sum())))
+
+    with torch.no_grad():
+        logits, _ = model(src, src_att, None, trg[:, 1:], trg, trg_att, src_segment_ids=src_segment,
+                          trg_segment_ids=trg_segment)
+        changed_logits, _ = model(src, src_att, None, changed_trg[:, 1:], changed_trg, trg_att,
+                                  src_segment_ids=src_segment, trg_segment_ids=trg_segment)
+    other = (trg_segment[:, :-1] != trg_segment.max()) & (trg_segment[:, :-1] > 0)
+    assert torch.allclose(logits[other], changed_logits[other], atol=1e-6)
@@ -0,0 +1,32 @@
+# Import PyTorch
+import torch
+import pytest
+from torch.nn import functional as F
+# Import custom modules
+from tests.helpers import tiny_transformer, variational_mode_dict, padded_source
+
+def generate_scores(model, src_input_ids, src_attention_mask, incremental_decoding):
+    # Predictions and the next token log-probabilities of every decoding step
+    scores = list()
+    output_log_prob = model.output_log_prob
+    model.output_log_prob = lambda hidden: scores.append(output_log_prob(hidden)) or scores[-1]
+    with torch.no_grad():
+        predicted = model.generate(src_input_ids, src_attention_mask, beam_size=3, beam_alpha=0.7,
+                                   repetition_penalty=0, device=torch.device('cpu'),
+                                   incremental_decoding=incremental_decoding)
+    del model.output_log_prob
+    return predicted, scores
+
+@pytest.mark.parametrize('parallel', [False, True])
+@pytest.mark.parametrize('incremental_decoding', [True, False])
+def test_single_latent_slot_pad_invariance(parallel, incremental_decoding):
+    # Extra padding columns change neither the single latent slot memory nor the full-length parallel memory
+    model = tiny_transformer(parallel, variational_mode_dict=variational_mode_dict(latent_add_encoder_out=False))
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5, 1], seed=1)
+    predicted, scores = generate_scores(model, src_input_ids, src_attention_mask, incremental_decoding)
+    padded_predicted, padded_scores = generate_scores(model, F.pad(src_input_ids, (0, 4)),
+                                                      F.pad(src_attention_mask, (0, 4)), incremental_decoding)
+    assert predicted == padded_predicted
+    assert len(scores) == len(padded_scores)
+    for step_scores, padded_step_scores in zip(scores, padded_scores):
+        assert torch.allclose(step_scores, padded_step_scores, atol=1e-5)
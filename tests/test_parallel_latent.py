@@ -0,0 +1,24 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from tests.helpers import tiny_transformer, variational_mode_dict, padded_source, padded_target
+
+def forward_logits(model, seed=1):
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5], seed=seed)
+    trg_input_ids, trg_attention_mask = padded_target([6, 4, 5], seed=seed)
+    with torch.no_grad():
+        logits, _ = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                          trg_input_ids, trg_attention_mask)
+    return logits
+
+@pytest.mark.parametrize('parallel_layer_latent', [False, True])
+def test_parallel_layer_latent_input(parallel_layer_latent):
+    # The second encoder layer output only reaches the decoders with 'parallel_layer_latent';
+    # by default the later decoder layers get the latent mapping of the source embedding output
+    model = tiny_transformer(True, variational_mode_dict=variational_mode_dict(
+        parallel_layer_latent=parallel_layer_latent))
+    logits = forward_logits(model)
+    with torch.no_grad():
+        model.encoders[1].linear2.bias.add_(1.)
+    assert torch.allclose(forward_logits(model), logits) != parallel_layer_latent
@@ -0,0 +1,101 @@
+# Import modules
+import os
+import json
+import h5py
+import pytest
+# Import custom modules
+pytest.importorskip('datasets')
+from task.preprocessing.preprocess_cache import processed_cache_config, spm_cache_config, cache_lookup, \
+    cache_restore, cache_store, cache_evicting
+from tests.helpers import write_line_corpus, preprocessing_args
+
+def store_dummy_entry(args, tmp_path, config):
+    file_path = str(tmp_path / 'artifact.hdf5')
+    with open(file_path, 'w') as f:
+        f.write('artifact')
+    return cache_store(args, 'processed', config, [file_path])
+
+def test_cache_hit_and_miss(tmp_path):
+    write_line_corpus(str(tmp_path / 'data'))
+    args = preprocessing_args(str(tmp_path))
+    config = processed_cache_config(args)
+    assert cache_lookup(args, 'processed', config) is None
+
+    entry_path = store_dummy_entry(args, tmp_path, config)
+    assert cache_lookup(args, 'processed', processed_cache_config(preprocessing_args(str(tmp_path)))) == entry_path
+    restore_path = tmp_path / 'restored'
+    restore_path.mkdir()
+    assert cache_restore(entry_path, str(restore_path)) == ['artifact.hdf5']
+    assert (restore_path / 'artifact.hdf5').read_text() == 'artifact'
+
+    # Every option the artifacts depend on is part of the key
+    for option, value in [('src_max_len', 20), ('ragged_format', True), ('seed', 7), ('trg_vocab_size', 30)]:
+        changed_args = preprocessing_args(str(tmp_path), **{option: value})
+        assert cache_lookup(args, 'processed', processed_cache_config(changed_args)) is None, option
+    # Options which do not change the processed data are not
+    assert processed_cache_config(preprocessing_args(str(tmp_path), tokenizing_workers=4)) == config
+
+def test_cache_miss_on_raw_data_change(tmp_path):
+    corpus_path = write_line_corpus(str(tmp_path / 'data'))
+    args = preprocessing_args(str(tmp_path))
+    spm_config = spm_cache_config(args, 'trg')
+    store_dummy_entry(args, tmp_path, processed_cache_config(args))
+
+    with open(os.path.join(corpus_path, 'train.en'), 'a') as f:
+        f.write('one more line\n')
+    changed_args = preprocessing_args(str(tmp_path))
+    assert cache_lookup(changed_args, 'processed', processed_cache_config(changed_args)) is None
+    assert spm_cache_config(changed_args, 'trg') != spm_config
+
+def test_cache_entry_validation(tmp_path):
+    write_line_corpus(str(tmp_path / 'data'))
+    args = preprocessing_args(str(tmp_path))
+    config = processed_cache_config(args)
+    entry_path = store_dummy_entry(args, tmp_path, config)
+
+    # An entry with another config under the same key or with a missing file is not used
+    with open(os.path.join(entry_path, 'entry.json')) as f:
+        entry = json.load(f)
+    entry['config']['src_max_len'] = 20
+    with open(os.path.join(entry_path, 'entry.json'), 'w') as f:
+        json.dump(entry, f)
+    assert cache_lookup(args, 'processed', config) is None
+
+    entry_path = store_dummy_entry(args, tmp_path, config)
+    os.remove(os.path.join(entry_path, 'artifact.hdf5'))
+    assert cache_lookup(args, 'processed', config) is None
+
+    store_dummy_entry(args, tmp_path, config)
+    cache_evicting(args, 'all')
+    assert cache_lookup(args, 'processed', config) is None
+
+def test_preprocessing_cache_hit_and_miss(tmp_path, monkeypatch):
+    # The second run restores the processed files without loading the corpus; a config change preprocesses again
+    pytest.importorskip('sentencepiece')
+    from task.preprocessing import data_preprocessing as preprocessing
+    write_line_corpus(str(tmp_path / 'data'))
+    load_count = {'count': 0}
+    total_data_load = preprocessing.total_data_load
+    def counted_data_load(args):
+        load_count['count'] += 1
+        return total_data_load(args)
+    monkeypatch.setattr(preprocessing, 'total_data_load', counted_data_load)
+
+    args = preprocessing_args(str(tmp_path))
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+    save_name = 'processed_translation_unigram_src_32_trg_32.hdf5'
+    preprocessing.data_preprocessing(args)
+    with h5py.File(os.path.join(save_path, save_name), 'r') as f:
+        train_src = f['train_src_input_ids'][:]
+    assert load_count['count'] == 1
+
+    os.remove(os.path.join(save_path, save_name))
+    preprocessing.data_preprocessing(preprocessing_args(str(tmp_path)))
+    assert load_count['count'] == 1
+    with h5py.File(os.path.join(save_path, save_name), 'r') as f:
+        assert (f['train_src_input_ids'][:] == train_src).all()
+
+    preprocessing.data_preprocessing(preprocessing_args(str(tmp_path), src_max_len=8))
+    assert load_count['count'] == 2
+    with h5py.File(os.path.join(save_path, save_name), 'r') as f:
+        assert f['train_src_input_ids'].shape == (train_src.shape[0], 8)
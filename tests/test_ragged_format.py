@@ -0,0 +1,60 @@
+# Import modules
+import h5py
+import numpy as np
+import pytest
+# Import custom modules
+pytest.importorskip('albumentations')
+from task.preprocessing.ragged_format import write_token_array, TokenArrayAppender, convert_to_ragged
+from task.utils import load_hdf5_array
+
+def padded_arrays(lengths, max_len=7, pad_idx=0, vocab_num=20, seed=0):
+    # Right padded token ids of 'lengths' and their attention mask
+    rng = np.random.RandomState(seed)
+    attention_mask = (np.arange(max_len) < np.asarray(lengths)[:, None]).astype(np.int32)
+    input_ids = np.where(attention_mask, rng.randint(3, vocab_num, (len(lengths), max_len)), pad_idx)
+    return input_ids.astype(np.int32), attention_mask
+
+def assert_round_trip(hdf5_file, name, input_ids, attention_mask):
+    with h5py.File(hdf5_file, 'r') as f:
+        assert f'{name}_input_ids' not in f and f'{name}_tokens' in f
+        loaded_ids = load_hdf5_array(f, f'{name}_input_ids')
+        loaded_mask = load_hdf5_array(f, f'{name}_attention_mask')
+    assert loaded_ids.shape == input_ids.shape and (loaded_ids == input_ids).all()
+    assert loaded_mask.shape == attention_mask.shape and (loaded_mask == attention_mask).all()
+
+@pytest.mark.parametrize('vocab_num, token_dtype', [(20, np.uint16), (70000, np.int32)])
+@pytest.mark.parametrize('pad_idx', [0, 3])
+def test_write_token_array_round_trip(tmp_path, vocab_num, token_dtype, pad_idx):
+    input_ids, attention_mask = padded_arrays([3, 7, 0, 5, 1], pad_idx=pad_idx, vocab_num=vocab_num)
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    with h5py.File(hdf5_file, 'w') as f:
+        write_token_array(f, 'train_src', input_ids, attention_mask, ragged=True, chunk_size=2)
+        assert f['train_src_tokens'].dtype == token_dtype
+        assert f['train_src_tokens'].attrs['pad_idx'] == pad_idx
+        assert len(f['train_src_tokens']) == attention_mask.sum()
+    assert_round_trip(hdf5_file, 'train_src', input_ids, attention_mask)
+
+@pytest.mark.parametrize('vocab_num, token_dtype', [(20, np.uint16), (70000, np.int32)])
+@pytest.mark.parametrize('pad_idx', [0, 3])
+def test_token_array_appender_round_trip(tmp_path, vocab_num, token_dtype, pad_idx):
+    input_ids, attention_mask = padded_arrays([7, 7, 5, 1, 2], pad_idx=pad_idx, vocab_num=vocab_num)
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    with h5py.File(hdf5_file, 'w') as f:
+        appender = TokenArrayAppender(f, 'train_trg', max_len=7, vocab_size=vocab_num, ragged=True)
+        # The first chunk has no padding, so the padding index is found in a later chunk
+        for start, end in [(0, 0), (0, 2), (2, 2), (2, 5)]:
+            appender.append(input_ids[start:end], attention_mask[start:end])
+        assert f['train_trg_tokens'].dtype == token_dtype
+        assert f['train_trg_tokens'].attrs['pad_idx'] == pad_idx
+    assert_round_trip(hdf5_file, 'train_trg', input_ids, attention_mask)
+
+def test_convert_to_ragged_round_trip(tmp_path):
+    input_ids, attention_mask = padded_arrays([4, 2, 6], pad_idx=3)
+    hdf5_file = str(tmp_path / 'processed.hdf5')
+    with h5py.File(hdf5_file, 'w') as f:
+        write_token_array(f, 'valid_src', input_ids, attention_mask)
+        f.create_dataset('valid_label', data=np.arange(3))
+    convert_to_ragged(hdf5_file)
+    assert_round_trip(hdf5_file, 'valid_src', input_ids, attention_mask)
+    with h5py.File(hdf5_file, 'r') as f:
+        assert (f['valid_label'][:] == np.arange(3)).all()
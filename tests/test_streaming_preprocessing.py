@@ -0,0 +1,63 @@
+# Import modules
+import os
+import h5py
+import pickle
+import pytest
+# Import custom modules
+pytest.importorskip('datasets')
+pytest.importorskip('sentencepiece')
+import sentencepiece as spm
+from task.preprocessing.data_preprocessing import data_preprocessing, streaming_preprocessing
+from task.utils import load_hdf5_array
+from tests.helpers import write_line_corpus, preprocessing_args
+
+SAVE_NAME = 'processed_translation_unigram_src_32_trg_32.hdf5'
+
+def processed_arrays(args):
+    save_path = os.path.join(args.preprocess_path, args.data_name, args.tokenizer)
+    arrays = dict()
+    for file_name in [SAVE_NAME, 'test_' + SAVE_NAME]:
+        with h5py.File(os.path.join(save_path, file_name), 'r') as f:
+            for phase in ['train', 'valid', 'test']:
+                for domain in ['src', 'trg']:
+                    for field in ['input_ids', 'attention_mask']:
+                        key = f'{phase}_{domain}_{field}'
+                        if key in f or f'{phase}_{domain}_tokens' in f:
+                            arrays[key] = load_hdf5_array(f, key)
+    with open(os.path.join(save_path, SAVE_NAME[:-5] + '_word2id.pkl'), 'rb') as f:
+        word2id = pickle.load(f)
+    return arrays, word2id
+
+def decoded_lines(args, domain, input_ids):
+    spm_model = spm.SentencePieceProcessor()
+    spm_model.Load(os.path.join(args.preprocess_path, args.data_name, args.tokenizer, f'm_{domain}_unigram_32.model'))
+    return [spm_model.DecodeIds([int(i) for i in ids if i not in [args.pad_id, args.bos_id, args.eos_id]])
+            for ids in input_ids]
+
+@pytest.mark.parametrize('ragged_format', [False, True])
+@pytest.mark.parametrize('stream_chunk_size', [5, 1000])
+def test_streaming_matches_in_memory(tmp_path, ragged_format, stream_chunk_size):
+    # Both runs have their own preprocess path so that the second one is not restored from the cache
+    corpus_path = write_line_corpus(str(tmp_path / 'data'))
+    option_dict = dict(src_max_len=64, trg_max_len=64, ragged_format=ragged_format, stream_chunk_size=stream_chunk_size)
+    memory_args = preprocessing_args(str(tmp_path), preprocess_path=str(tmp_path / 'memory'), **option_dict)
+    stream_args = preprocessing_args(str(tmp_path), preprocess_path=str(tmp_path / 'stream'), **option_dict)
+    data_preprocessing(memory_args)
+    streaming_preprocessing(stream_args)
+    memory_arrays, memory_word2id = processed_arrays(memory_args)
+    stream_arrays, stream_word2id = processed_arrays(stream_args)
+
+    assert memory_word2id == stream_word2id
+    assert sorted(memory_arrays.keys()) == sorted(stream_arrays.keys()) and len(memory_arrays) == 12
+    for key, memory_array in memory_arrays.items():
+        assert stream_arrays[key].shape == memory_array.shape, key
+        # Train sentences are encoded with subword sampling, so they are compared as decoded text below
+        if not key.startswith('train'):
+            assert (stream_arrays[key] == memory_array).all(), key
+
+    for domain, language in [('src', 'de'), ('trg', 'en')]:
+        with open(os.path.join(corpus_path, f'train.{language}')) as f:
+            lines = [line.replace('\n', '') for line in f]
+        key = f'train_{domain}_input_ids'
+        assert decoded_lines(stream_args, domain, stream_arrays[key]) == lines
+        assert decoded_lines(memory_args, domain, memory_arrays[key]) == lines
@@ -0,0 +1,101 @@
+# Import PyTorch
+import torch
+import pytest
+# Import custom modules
+from tests.helpers import tiny_transformer, variational_mode_dict, padded_source, padded_target
+
+def forward_loss(model, seed=1):
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5], seed=seed)
+    trg_input_ids, trg_attention_mask = padded_target([6, 4, 5], seed=seed)
+    logits, dist_loss = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                              trg_input_ids, trg_attention_mask)
+    return logits.sum() + dist_loss
+
+@pytest.mark.parametrize('batched_src_trg_encoding', [False, True])
+@pytest.mark.parametrize('trg_encoder_mode', ['shared', 'no_grad', 'ema'])
+def test_no_target_pass_without_target(batched_src_trg_encoding, trg_encoder_mode):
+    # Without variational_with_target, the target embedding only embeds the decoder input
+    model = tiny_transformer(variational_mode_dict=variational_mode_dict(
+        batched_src_trg_encoding=batched_src_trg_encoding, trg_encoder_mode=trg_encoder_mode))
+    def no_target_encoding(*args, **kwargs):
+        raise AssertionError('target encoder pass without variational_with_target')
+    model.target_encoding = no_target_encoding
+
+    trg_embedding_calls = list()
+    model.trg_embedding.register_forward_hook(lambda module, inputs, output: trg_embedding_calls.append(output))
+    forward_loss(model).backward()
+    assert len(trg_embedding_calls) == 1
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+def test_batched_src_trg_encoding(variational_model):
+    # One encoder pass over source and target gives the same loss and gradients as two passes
+    losses, grads = list(), list()
+    for batched_src_trg_encoding in [False, True]:
+        model = tiny_transformer(variational_mode_dict=variational_mode_dict(
+            variational_model, variational_with_target=True, batched_src_trg_encoding=batched_src_trg_encoding))
+        loss = forward_loss(model)
+        loss.backward()
+        losses.append(loss.detach())
+        grads.append({name: param.grad.clone() for name, param in model.named_parameters()
+                      if param.grad is not None})
+    assert torch.allclose(losses[0], losses[1], atol=1e-4)
+    assert grads[0].keys() == grads[1].keys()
+    for name in grads[0]:
+        assert torch.allclose(grads[0][name], grads[1][name], atol=1e-4), name
+
+@pytest.mark.parametrize('variational_model', ['vae', 'wae'])
+@pytest.mark.parametrize('cnn', [False, True])
+def test_cached_target_posterior(variational_model, cnn):
+    # Cached posterior gives the latent loss of the target pass, and the target encoder is not run
+    mode_dict = variational_mode_dict(variational_model, variational_with_target=True, trg_encoder_mode='cache')
+    if cnn:
+        mode_dict.update(variational_token_processing='cnn', cnn_encoder=True)
+    model = tiny_transformer(variational_mode_dict=mode_dict)
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5], seed=1)
+    trg_input_ids, trg_attention_mask = padded_target([6, 4, 5], seed=2)
+
+    with torch.no_grad():
+        torch.manual_seed(3)
+        logits, dist_loss = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                                  trg_input_ids, trg_attention_mask)
+        trg_posterior = model.target_posterior(trg_input_ids, trg_attention_mask)
+    assert trg_posterior.shape == (3, 2 if variational_model == 'vae' else 1, 4)
+
+    def no_target_encoding(*args, **kwargs):
+        raise AssertionError('target encoder pass with a cached posterior')
+    model.target_encoding = no_target_encoding
+    with torch.no_grad():
+        torch.manual_seed(3)
+        cached_logits, cached_dist_loss = model(src_input_ids, src_attention_mask, None, trg_input_ids[:, 1:],
+                                                trg_input_ids, trg_attention_mask, trg_posterior=trg_posterior)
+    assert torch.allclose(dist_loss, cached_dist_loss, atol=1e-5)
+    assert torch.allclose(logits, cached_logits, atol=1e-5)
+
+def test_target_posterior_caching(tmp_path):
+    # Every example gets the posterior of its own target, also through a trimmed index batch
+    pytest.importorskip('albumentations')
+    from model.dataset import Seq2SeqDataset, TargetPosteriorDataset, trim_seq2seq_batch
+    from task.utils import target_posterior_caching
+    model = tiny_transformer(variational_mode_dict=variational_mode_dict(
+        'vae', variational_with_target=True, trg_encoder_mode='cache')).train()
+    # Sources of the maximum length without eos token are left out of Seq2SeqDataset
+    src_input_ids, src_attention_mask = padded_source([7, 3, 5, 4, 6], seed=1)
+    trg_input_ids, trg_attention_mask = padded_target([6, 4, 5, 3, 8], seed=2)
+    dataset = TargetPosteriorDataset(Seq2SeqDataset(src_input_ids.numpy(), src_attention_mask.numpy(),
+                                                    trg_list=trg_input_ids.numpy(),
+                                                    trg_att_list=trg_attention_mask.numpy(),
+                                                    src_max_len=7, trg_max_len=8))
+    cache_file = str(tmp_path / 'checkpoint_trg_posterior.npy')
+    target_posterior_caching(model, dataset, cache_file, batch_size=2, device='cpu')
+    assert model.training
+
+    model.eval()
+    with torch.no_grad():
+        for i in range(len(dataset)):
+            _, _, trg, trg_att, trg_posterior = dataset[i]
+            length = int(trg_att.sum())
+            expected = model.target_posterior(trg[None, :length], trg_att[None, :length])
+            assert torch.allclose(trg_posterior, expected[0], atol=1e-5)
+    batch = trim_seq2seq_batch(dataset[[2, 0]])
+    assert len(batch) == 5 and batch[2].size(1) == max(int(dataset[i][3].sum()) for i in [2, 0])
+    assert torch.equal(batch[4], torch.stack((dataset[2][4], dataset[0][4])))
@@ -0,0 +1,69 @@
+# Import modules
+import h5py
+import numpy as np
+import pytest
+# Import PyTorch
+import torch
+from torch import nn
+# Import custom modules
+pytest.importorskip('albumentations')
+from model.custom_plm.utils import trimmed_index, trim_embedding
+from task.preprocessing.ragged_format import write_token_array
+from task.preprocessing.vocab_trimming import vocab_trimming
+from task.utils import load_hdf5_array
+
+SPECIAL_IDS = [0, 1, 2, 95]
+
+def write_split(hdf5_file, input_ids, attention_mask, ragged):
+    with h5py.File(hdf5_file, 'w') as f:
+        write_token_array(f, 'train_src', input_ids, attention_mask, ragged=ragged)
+        write_token_array(f, 'train_trg', input_ids[::-1], attention_mask[::-1], ragged=ragged)
+
+@pytest.mark.parametrize('ragged', [False, True])
+def test_vocab_trimming_round_trip(tmp_path, ragged):
+    # Padding index 7 is not a special id; it is kept since the padded arrays or the ragged 'pad_idx' attribute use it
+    lengths = np.array([3, 5, 2, 6])
+    attention_mask = (np.arange(6) < lengths[:, None]).astype(np.int32)
+    rng = np.random.RandomState(0)
+    input_ids = np.where(attention_mask, rng.choice([10, 30, 31, 64, 80, 1, 2], (4, 6)), 7).astype(np.int32)
+    test_input_ids = np.where(attention_mask, rng.choice([12, 30, 90], (4, 6)), 7).astype(np.int32)
+    hdf5_files = [str(tmp_path / 'processed.hdf5'), str(tmp_path / 'test_processed.hdf5')]
+    write_split(hdf5_files[0], input_ids, attention_mask, ragged)
+    write_split(hdf5_files[1], test_input_ids, attention_mask, ragged)
+
+    vocab_map = vocab_trimming(hdf5_files, special_ids=SPECIAL_IDS, chunk_size=3)
+    original_ids = np.unique(np.concatenate([input_ids[attention_mask == 1], test_input_ids[attention_mask == 1]]))
+    assert set(SPECIAL_IDS) <= set(vocab_map) and set(original_ids) <= set(vocab_map)
+    assert (np.diff(vocab_map) > 0).all()
+    for special_id in SPECIAL_IDS:
+        assert vocab_map[trimmed_index(vocab_map, special_id)] == special_id
+
+    for hdf5_file, original in zip(hdf5_files, [input_ids, test_input_ids]):
+        with h5py.File(hdf5_file, 'r') as f:
+            assert (f['vocab_map'][:] == vocab_map).all()
+            if ragged:
+                assert vocab_map[f['train_src_tokens'].attrs['pad_idx']] == 7
+            for name, expected_ids, expected_mask in [('train_src', original, attention_mask),
+                                                      ('train_trg', original[::-1], attention_mask[::-1])]:
+                trimmed = load_hdf5_array(f, f'{name}_input_ids')
+                assert trimmed.max() < len(vocab_map)
+                assert (vocab_map[trimmed] == expected_ids).all()
+                assert (load_hdf5_array(f, f'{name}_attention_mask') == expected_mask).all()
+
+    with pytest.raises(Exception, match='already trimmed'):
+        vocab_trimming(hdf5_files, special_ids=SPECIAL_IDS)
+
+def test_trimmed_index_missing_index():
+    vocab_map = np.array([0, 1, 2, 10, 30])
+    assert trimmed_index(vocab_map, 10) == 3 and trimmed_index(vocab_map, None) is None
+    for index in [5, 31]:
+        with pytest.raises(Exception, match='not kept'):
+            trimmed_index(vocab_map, index)
+
+def test_trim_embedding():
+    embedding = nn.Embedding(40, 4, padding_idx=1)
+    vocab_map = np.array([0, 1, 2, 10, 30])
+    weight = embedding.weight.data.clone()
+    trim_embedding(embedding, vocab_map)
+    assert embedding.num_embeddings == 5 and embedding.padding_idx == 1
+    assert torch.equal(embedding.weight.data, weight[torch.as_tensor(vocab_map)])
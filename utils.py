@@ -21,6 +21,11 @@ def str2bool(v):
     else: 
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
+def positive_int(v):
+    if int(v) < 1:
+        raise argparse.ArgumentTypeError('Positive integer expected.')
+    return int(v)
+
 def path_check(args):
     # Preprocessing Path Checking
     #(args.preprocess_path, args.task, args.data_name, args.tokenizer)